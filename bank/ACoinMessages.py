@@ -23,24 +23,14 @@ eventLogger = BankEventLogger({"PAYMENTS":  BankPayment,
                                "DEPOSITS":  BankDeposit},
                                "/mnt/logs/bank/bank_events.out")
 
-def get_correct_set(s):
-  """converts a char to a number between 0 and Globals.numberOfSets (typically 8)"""
-  return struct.unpack('B', s)[0]%Globals.numberOfSets
-
 def deposit_acoin(blob, currentInterval):
   coin = BankACoin()
   blob = coin.read_binary(blob)
   #did the bank sign it and is the interval ok?
   if not coin.is_valid(currentInterval):
     return '1', coin, blob
-  #has the coin already been deposited?
-  store = coin.store()
-  #the coin goes in a specific set based on the leading entry of the hash 
-  set = get_correct_set(store[0])
-  #the dict has a key for this interval
-  if not store in Globals.Acoins[coin.interval][set]:
-    Globals.Acoins[coin.interval][set].add(store)
-  else:
+  #has the coin already been deposited?  (this also records it in the index)
+  if not Globals.SPENT_COINS.add(coin.interval, coin.store()):
     return '2', coin, blob
   #the acoin was good!
   return '0', coin, blob
@@ -59,6 +49,7 @@ class Request():
     log_msg('ACoin signing request received',  3)
     d = self.unpack_and_mint(msg)
     d.addCallback(self.update_account)
+    return d
       
   def unpack_and_mint(self, msg):
     """unpacks the request retreiving the number of coins packed and the total value desired.
@@ -73,47 +64,43 @@ class Request():
       raise ValueError('coins must have a positive, integer value')
       
     self.bill = 0
-    self.signatures = ""
+    blobs = []
     for i in range(0, self.number):
-      #TODO: move to a worker pool or something
-      sig = Globals.ACOIN_KEY.decrypt(msg[:Globals.ACOIN_KEY_BYTES], False)
-      self.signatures += struct.pack('!%ss'%(Globals.ACOIN_KEY_BYTES), sig)
+      blobs.append(msg[:Globals.ACOIN_KEY_BYTES])
       msg = msg[Globals.ACOIN_KEY_BYTES:]
       self.bill += value
-      
-    #TODO: move this constraint to postgres to get rid of any potential race conditions
-    sql = "SELECT balance FROM Accounts WHERE Username = %s"
-    inj = (self.user,)
+    #the signing happens in the worker processes, batched with any other requests
+    d = Globals.SIGNING_POOL.sign(blobs)
+    d.addCallback(self.got_signatures)
+    return d
+    
+  def got_signatures(self, sigs):
+    """stores the signatures for the reply, then pays for them"""
+    sigFormat = '!%ss' % (Globals.ACOIN_KEY_BYTES)
+    self.signatures = "".join([struct.pack(sigFormat, sig) for sig in sigs])
+    #checks the balance and deducts the bill in a single statement (see account_functions.sql)
+    sql = "SELECT success, new_balance FROM debit_account(%s, %s)"
+    inj = (self.user, self.bill)
     d = db.read(sql, inj)
     return d
     
   def update_account(self, tup):
-    """checks to see if the user has enough money to pay for the acoin signature, 
-    though this should be a db constraint-
-    attempts to deduct the value from the user's account"""
+    """the debit either happened, or the user did not have enough money for the acoin signatures"""
     assert len(tup) == 1
-    balance = int(tup[0][0])
-    proposedBalance = balance - self.bill 
-    if proposedBalance >= 0:
-      sql = "UPDATE Accounts SET Balance = %s WHERE Username = %s"
-      inj = (proposedBalance, self.user)
-      d = db.write(sql, inj)
-      d.addCallback(self.send_reply, True, proposedBalance, balance)
-      return
-    else:
-      self.send_reply(None, False, proposedBalance, balance)
+    success, balance = tup[0]
+    self.send_reply(success, int(balance))
       
-  def send_reply(self, result, success, proposedBalance, balance):
+  def send_reply(self, success, balance):
     """creates response for the clients"""
     if success:
-      log_msg("%s's account now has %s money" % (self.user, proposedBalance),  4)
-      reply = struct.pack('!BII', 0, proposedBalance, self.number) + self.signatures
+      log_msg("%s's account now has %s money" % (self.user, balance),  4)
+      reply = struct.pack('!BII', 0, balance, self.number) + self.signatures
+      #log the event:
+      eventLogger.aggregate_event("REQUESTS", self.user, self.bill)
     else:
-      log_msg("%s's account did not have enough money: %s" % (self.user, proposedBalance),  4)
+      log_msg("%s's account did not have enough money: %s" % (self.user, balance),  4)
       reply = struct.pack('!BI', 1, balance)
     self.encrypted_reply(reply)
-    #log the event:
-    eventLogger.aggregate_event("REQUESTS", self.user, balance-proposedBalance)
     
 class Payment():
   def __init__(self, send_func, address):
@@ -127,18 +114,31 @@ class Payment():
     current = Globals.CURRENT_ACOIN_INTERVAL[0]
     #read the number of payments:
     numPayments, msg = Basic.read_byte(msg)
-    reply = ""
+    results = []
+    tokens = []
     for i in range(0, numPayments):
       #read the payment:
       result, coin, msg = deposit_acoin(msg, current)
-      reply += struct.pack('!s', result)
+      results.append(result)
       token, msg = msg[:Globals.ACOIN_KEY_BYTES], msg[Globals.ACOIN_KEY_BYTES:]
-      #if the coin is valid...
+      #if the coin is valid, the token gets signed
+      if result == '0':
+        tokens.append(token)
+    #the deposits must be on disk before the client gets their payment
+    d = Globals.SPENT_COINS.sync_soon()
+    d.addCallback(lambda result: Globals.SIGNING_POOL.sign(tokens))
+    d.addCallback(self.send_reply, results)
+    return d
+    
+  def send_reply(self, sigs, results):
+    """builds the reply- a result for each coin, followed by the signature if it was valid"""
+    sigFormat = '!%ss' % (Globals.ACOIN_KEY_BYTES)
+    sigs = iter(sigs)
+    reply = ""
+    for result in results:
+      reply += struct.pack('!s', result)
       if result == '0':
-        sig = Globals.ACOIN_KEY.decrypt(token, False)
-        #~ print "token:  " + repr(token)
-        #~ print "sig:  " + repr(sig)
-        reply += struct.pack('!%ss' % (Globals.ACOIN_KEY_BYTES), sig)
+        reply += struct.pack(sigFormat, sigs.next())
     #and finally, send it back to the client:
     self.send_func(reply)
     #log the event:
@@ -159,7 +159,10 @@ class Deposit():
   def on_message(self, msg):
     log_msg('ACoin deposit request received',  3)
     total = self.unpack_and_verify(msg)
-    self.update_account(total)
+    #the deposits must be on disk before the account is credited
+    d = Globals.SPENT_COINS.sync_soon()
+    d.addCallback(lambda result: self.update_account(total))
+    return d
 
   def unpack_and_verify(self, blob):
     """verifies that...
@@ -185,14 +188,15 @@ class Deposit():
   def update_account(self, credit):
     """adds any money to the user's account"""
     if credit > 0:
-      sql = "UPDATE Accounts SET Balance = Balance + %s WHERE Username = %s"
+      #returns the new balance too, so there is no need to look it up again
+      sql = "UPDATE Accounts SET Balance = Balance + %s WHERE Username = %s RETURNING Balance"
       inj = (credit, self.user)
-      d = db.write(sql, inj)
-      d.addCallback(self.get_balance)
+      d = db.read(sql, inj)
       d.addCallback(self.reply)
     else:
       d = self.get_balance(None)
       d.addCallback(self.reply)
+    return d
     
   def get_balance(self, result):  
     sql = "SELECT Balance FROM Accounts WHERE Username = %s"
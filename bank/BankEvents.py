@@ -5,7 +5,7 @@ import time
 from twisted.internet import reactor, threads
 
 import BankUtil
-from serverCommon import EventLogging
+from serverCommon import EventBatch
 
 class BankEventLogger():
   """Used to aggregate very frequent events per user, then flush them to disk periodically"""
@@ -14,8 +14,8 @@ class BankEventLogger():
     self._eventTypes = eventTypes
     #: used to track events, so they can be logged hourly, for better anonymity and performance
     self._reset_events()
-    #open the logs:
-    EventLogging.open_logs(logName)
+    #: where each batch of events gets saved.  Defaults to the normal event log
+    self._sink = EventBatch.LogFileSink(logName)
     #schedule a flush of the logs for the end of the hour:
     self._schedule_next_flush()
     
@@ -35,6 +35,10 @@ class BankEventLogger():
     #timeLeft = 30
     self._next_flush_event = reactor.callLater(timeLeft, self._flush_event_logs)
 
+  def set_sink(self, sink):
+    """Change where events are saved (see serverCommon.EventBatch)"""
+    self._sink = sink
+
   def aggregate_event(self, collectionName, key, amount):
     """Updates statistics in memory.  They get pushed to disk periodically"""
     collection = self._events.get(collectionName)
@@ -52,13 +56,16 @@ class BankEventLogger():
       self._next_flush_event.cancel()
     #and do a final flush:
     self._flush_thread(self._events)
+    self._sink.close()
   
   def _flush_thread(self, recentEvents):
-    """Log an event for each message type and user, essentially"""
+    """Log an event for each message type and user, essentially.  They are all saved as one batch."""
+    batch = []
     for collectionName, events in recentEvents.iteritems():
       eventType = self._eventTypes.get(collectionName)
       for key, value in events.iteritems():
-        EventLogging.save_event(eventType(source=key, amount=value))
+        batch.append(eventType(source=key, amount=value))
+    self._sink.save(batch)
 
   def _flush_event_logs(self):
     """Save all aggregated events to the disk"""
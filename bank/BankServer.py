@@ -9,9 +9,11 @@ import signal
 import binascii
 import optparse
 import os
+import socket
 from cPickle import dumps, loads
 
-from twisted.internet import reactor, defer, threads, protocol
+import psycopg2 as cyborg
+from twisted.internet import reactor, defer, threads, protocol, tcp, udp
 from twisted.protocols.basic import Int32StringReceiver
 
 from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
@@ -20,11 +22,16 @@ from common.utils import Basic
 from common.utils import Twisted
 from common.classes import Logger
 from common.classes import EncryptedDatagram
-from common.classes import SymmetricKey
 from common.classes import PrivateKey
 from serverCommon import db
+from serverCommon import EventBatch
+from serverCommon import DbAccessConfig
 import BankUtil
 import ACoinMessages
+import SigningPool
+import SpentCoinIndex
+import ReplyCache
+import RelaySessions
 
 if os.path.exists("THIS_IS_DEBUG"):
   from common.conf import Dev as Conf
@@ -41,14 +48,24 @@ parser.add_option('-p', '--port', dest='port', type='int', default=Conf.SERVER_P
 parser.add_option('-t', '--time', dest='time', type='int', default=15, 
                   metavar='15', help='minutes between memory dumps')
 parser.add_option('-s', '--sets', dest='sets', type='int', default=8, 
-                  metavar='8', help='number of sets per interval to cache acoins in- \
-                  total sets will be twice this number (which should be devisable by 2)')
+                  metavar='8', help='number of shards per new interval to store deposited acoins in (existing intervals keep their own)')
+parser.add_option('--spent-coin-dir', dest='spentdir', default='spent_acoins', type='str', metavar='DIR', 
+                  help='folder for the persistent index of deposited acoins')
 parser.add_option('-n', '--non-daemon-mode', dest='mode', action="store_true", default=False, metavar='False',
                   help='specify to run in non-daemon-mode')
 parser.add_option('--acoin-key-file', dest='akf', default=None, type='str', metavar='FILE', 
                   help='location of acoin private key RSA pem file')
 parser.add_option('--bank-key-file', dest='bkf', default=None, type ='str', metavar='FILE', 
                   help='location of bank private key RSA pem file')
+parser.add_option('-w', '--signing-workers', dest='workers', type='int', default=None, 
+                  metavar='NUM', help='number of processes to do RSA signing in (defaults to one per core, 0 to sign in the reactor)')
+parser.add_option('-P', '--processes', dest='processes', type='int', default=1, 
+                  metavar='1', help='number of bank worker processes to run (sharing the port with SO_REUSEPORT).  ' + \
+                  'They share payment replies through a log in the spent coin folder, so it must be on a local filesystem that supports flock')
+parser.add_option('--worker-id', dest='workerId', type='int', default=None, 
+                  metavar='ID', help='used internally when the supervisor launches worker processes')
+parser.add_option('--event-sink', dest='eventSink', default='log', type='choice', choices=['log', 'segment', 'copy'], 
+                  metavar='log', help='where to save the hourly payment events:  log (text event log), segment (compressed segment files) or copy (straight into postgres)')
 parser.add_option('-d', '--debug', dest='debug', type='int', default=2, 
                   metavar='2', help='debug lvl- int from 0 to 4')
 (options, args) = parser.parse_args()
@@ -59,62 +76,104 @@ if '--acoin-key-file' not in args:
   options.akf = 'private_keys/acoin.key'
 if '--bank-key-file' not in args:
   options.bfk = 'private_keys/bank.key'
-#number of current and previous acoin interval sets to be stored in memory
-Globals.numberOfSets = options.sets
 Globals.CURRENT_ACOIN_INTERVAL = []
+#record of all deposited acoins, for the current and previous intervals
+Globals.SPENT_COINS = SpentCoinIndex.SpentCoinIndex(options.spentdir, options.sets)
 #create all keys
 Globals.ACOIN_KEY = PrivateKey.PrivateKey(options.akf)
 Globals.GENERIC_KEY = PrivateKey.PrivateKey(options.bfk)
 #is the reactor listening?
 Globals.isListening = False
-Globals.isInitialize = False
+#: whether this is the supervisor process, which launches the workers but serves no clients
+IS_SUPERVISOR = options.processes > 1 and options.workerId is None
+#: whether this is one of several processes listening on the same port
+IS_WORKER = options.workerId is not None
+#: Linux value, in case this python does not define the constant
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+#: how long to wait before replacing a worker that died
+WORKER_RESTART_DELAY = 5.0
 
-#used to cache responses for dropped packets
-cache = {}
-#used to enforce a max size on the cache
-queue = []
-#max requests in the cache
-MAX_SIZE = 500
-#TODO: this system is stupid, but only costs a MB of ram...
+#: replies to payments (over UDP or TCP), in case the reply is dropped and the client retransmits
+replyCache = ReplyCache.ReplyCache()
+#: session keys and message numbers of relays, so they need not be looked up for every message
+relaySessions = RelaySessions.RelaySessionCache()
+#: decrypts every UDP payment, reusing the same cipher contexts
+udpSymKey = EncryptedDatagram.ServerSymKey(Globals.GENERIC_KEY)
+#: the interval that on_new_interval last set things up for
+lastInterval = None
 
-def initialize():
-  """initialize coins and locks"""
-  log_msg('Initializing cache.', 3)
-  previous, current = BankUtil.get_intervals()
-  Globals.Acoins = {previous: [], current: []}
-  for i in range(Globals.numberOfSets+1):
-    Globals.Acoins[previous].append(set())
-    Globals.Acoins[current].append(set())
-    
 def on_new_interval():
-  """removes expired acoins and locks from the cache and makes new ones"""
+  """loads the spent acoins for the valid intervals and drops any that expired.
+  Called after every interval lookup, so it returns right away unless the interval changed."""
+  global lastInterval
   previous, current = BankUtil.get_intervals()
+  if current == lastInterval:
+    return
+  lastInterval = current
   log_msg('New interval learned: %s!'%current, 3)
-  if Globals.isInitialize:
-    Globals.Acoins[current] = []
-    for repo in range(Globals.numberOfSets+1):
-      #create new ones
-      Globals.Acoins[current].append(set())
-    del(Globals.Acoins[previous-1])
-  else:
-    initialize()
-    Globals.isInitialize = True
+  replyCache.expire()
+  log_msg('Reply cache:  %s' % (replyCache.get_stats()), 2)
+  log_msg('Relay sessions:  %s' % (relaySessions.get_stats()), 2)
+  if IS_SUPERVISOR:
+    #make the workers look up the new interval right away
+    for worker in workers.values():
+      worker.signal_new_interval()
+  #the files are shared by all processes, so only the supervisor deletes them
+  Globals.SPENT_COINS.drop_all_except((previous, current), deleteFiles=not IS_WORKER)
+  if not IS_SUPERVISOR:
+    Globals.SPENT_COINS.open_interval(previous)
+    Globals.SPENT_COINS.open_interval(current)
+  if IS_WORKER:
+    #retransmitted payments usually reach a different worker than the original, see ReplyCache
+    replyCache.share(os.path.join(Globals.SPENT_COINS.get_interval_dir(current), "replies.log"))
 
 def start_listening():
   """called when we learn the current acoin interval"""
   #flush_scheduler()
+  if IS_SUPERVISOR:
+    for workerId in range(options.processes):
+      start_worker(workerId)
+    return
   factory = protocol.ServerFactory()
   factory.protocol = TCPServer
-  reactor.listenTCP(options.port, factory)
-  reactor.listenUDP(options.port, UDPServer())
+  if IS_WORKER:
+    #every worker binds the same port, and the kernel balances clients between them
+    ReusePortTCP(options.port, factory, reactor=reactor).startListening()
+    ReusePortUDP(options.port, UDPServer(), reactor=reactor).startListening()
+  else:
+    reactor.listenTCP(options.port, factory)
+    reactor.listenUDP(options.port, UDPServer())
   log_msg('Server is listening on port: %s!' % (options.port), 2)
+  
+def on_interval_signal(signum, frame):
+  """the supervisor sends SIGUSR1 to workers when the ACoin interval rolls over"""
+  reactor.callFromThread(BankUtil.update_local_acoin_interval, start_listening, on_new_interval)
         
 def main():
   """Launches the Serverfactoryprotocolthing """
   #run as a daemon
   Globals.logger = Logger.Logger(options.debug)
-  Globals.logger.start_logs(["BANK", "errors"], "BANK", ".")
+  if IS_WORKER:
+    Globals.logger.start_logs(["BANK", "errors"], "BANK", "worker_%s" % (options.workerId))
+    signal.signal(signal.SIGUSR1, on_interval_signal)
+  else:
+    Globals.logger.start_logs(["BANK", "errors"], "BANK", ".")
   Twisted.install_exception_handlers()
+  if IS_SUPERVISOR:
+    reactor.addSystemEventTrigger('before', 'shutdown', stop_workers)
+  else:
+    #all ACoin signing happens in these worker processes.  If there are several 
+    #bank processes, they already spread over the cores, so sign in process by default
+    numSigningWorkers = options.workers
+    if numSigningWorkers is None and IS_WORKER:
+      numSigningWorkers = 0
+    Globals.SIGNING_POOL = SigningPool.SigningPool(options.akf, numSigningWorkers)
+    if options.eventSink == 'segment':
+      ACoinMessages.eventLogger.set_sink(EventBatch.SegmentFileSink("/mnt/logs/bank/bank_events"))
+    elif options.eventSink == 'copy':
+      def connect():
+        return cyborg.connect(user=DbAccessConfig.user, password=DbAccessConfig.password, database=DbAccessConfig.database)
+      ACoinMessages.eventLogger.set_sink(EventBatch.CopySink(connect))
   BankUtil.update_local_acoin_interval(start_listening, on_new_interval)
   Globals.reactor = reactor
   log_msg('Server started: fail is imminent (not an error)!', 0)
@@ -128,8 +187,71 @@ def main():
     reactor.callLater(15.0, start_profiler)
     reactor.callLater(75.0, stop_profiler)
   reactor.run()
+  if not IS_SUPERVISOR:
+    Globals.SIGNING_POOL.stop()
+  Globals.SPENT_COINS.close()
   ACoinMessages.eventLogger.on_shutdown()
   log_msg("Shutdown cleanly", 2)
+  
+#: mapping from worker id to BankWorkerProcess, for the supervisor
+workers = {}
+  
+def start_worker(workerId):
+  """Launch a copy of this program as a worker process"""
+  args = [sys.executable] + sys.argv + ['--worker-id', str(workerId)]
+  worker = BankWorkerProcess(workerId)
+  reactor.spawnProcess(worker, sys.executable, args, env=os.environ, path=os.getcwd(), 
+                       childFDs={0: "w", 1: 1, 2: 2})
+  workers[workerId] = worker
+  
+def stop_workers():
+  for worker in workers.values():
+    worker.stop()
+    
+class BankWorkerProcess(protocol.ProcessProtocol):
+  """Used by the supervisor to track a worker process, and restart it if it dies"""
+  def __init__(self, workerId):
+    self.workerId = workerId
+    self.isStopping = False
+    
+  def connectionMade(self):
+    log_msg('Started bank worker %s (pid %s)' % (self.workerId, self.transport.pid), 2)
+    
+  def signal_new_interval(self):
+    if self.transport.pid:
+      self.transport.signalProcess('USR1')
+      
+  def stop(self):
+    self.isStopping = True
+    if self.transport.pid:
+      self.transport.signalProcess('TERM')
+    
+  def processEnded(self, reason):
+    if workers.get(self.workerId) is self:
+      del workers[self.workerId]
+    if self.isStopping:
+      log_msg('Bank worker %s stopped' % (self.workerId), 2)
+      return
+    log_msg('Bank worker %s died (%s), restarting' % (self.workerId, reason.value), 0)
+    reactor.callLater(WORKER_RESTART_DELAY, start_worker, self.workerId)
+    
+class ReusePortTCP(tcp.Port):
+  """A TCP port that other processes can also bind"""
+  def createInternetSocket(self):
+    s = tcp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+    
+class ReusePortUDP(udp.Port):
+  """A UDP port that other processes can also bind.  The kernel picks the process
+  for each datagram by its source address, so retransmissions from a client (which
+  uses a new port for each retry) are not sent to the same worker.  Anything that a
+  worker remembers about earlier datagrams must be shared (like replyCache) or
+  safe to miss (like relaySessions, which checks message numbers in the database)."""
+  def createInternetSocket(self):
+    s = udp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
     
 class UDPServer(protocol.DatagramProtocol):
   MAX_LENGTH = 1024
@@ -137,61 +259,62 @@ class UDPServer(protocol.DatagramProtocol):
   """responsible for handling payment requests from the clients"""
   
   def datagramReceived(self, datagram, address):
+    #NOTE:  payments are signed asynchronously, so replies must not depend on 
+    #per-datagram state stored on this (shared) protocol instance
+    key = None
     try:
-      self.address = address
       log_msg('Datagram received from %s:%s!'%address, 3)
+      #is it a replay?
+      key = ReplyCache.get_key(datagram)
+      response = replyCache.get(key)
+      if response:
+        self.reply(response, address)
+        return
+      #the original is still being processed, the client will retransmit again later
+      if replyCache.is_pending(key):
+        return
       msgType, msg = Basic.read_byte(datagram)
       #for compatability really
       if msgType == 1:
-        #is it a replay?
-        if not cache.has_key(msg):
-          self.request = msg
-          self.symKey = EncryptedDatagram.ServerSymKey(Globals.GENERIC_KEY)
-          msg = self.symKey.decrypt(msg)
-          #for compatability really
-          request_type, msg = Basic.read_byte(msg)
-          if request_type == 3:
-            self.handler = ACoinMessages.Payment(self.reply, self.address) 
-            self.handler.on_message(msg)
-          else:
-            raise Exception("Unknown request_type:  %s" % (request_type))
+        msg = udpSymKey.decrypt(msg)
+        #for compatability really
+        request_type, msg = Basic.read_byte(msg)
+        if request_type == 3:
+          def send_func(response):
+            self.reply(response, address, key)
+          #another worker might have just started or answered it
+          if not replyCache.start(key):
+            return
+          handler = ACoinMessages.Payment(send_func, address) 
+          d = handler.on_message(msg)
+          d.addErrback(self.err, address, key)
         else:
-          self.reply(cache[msg], putInQueue=False)
-          return
+          raise Exception("Unknown request_type:  %s" % (request_type))
       else:
         raise Exception("Unknown msgType:  %s" % (msgType))
     except Exception, e:
-      self.err(e)
+      self.err(e, address, key)
     
-  def reply(self, response, putInQueue=True, wasSuccess=True):
-    """returns string msg to client"""
-    #should this item go into the temporary cache for dropped packets?
-    if putInQueue:
-      global queue, cache
-      if self.request not in cache:
-        queue.append(self.request)
-        cache[self.request] = response
-        #kept while for jash, though only we element is ever added at a time
-        while len(queue) > MAX_SIZE:
-          del cache[queue.pop(0)]
-    self.transport.write(response, self.address)
+  def reply(self, response, address, key=None):
+    """returns string msg to client
+    @param key:  if set, the response is cached for this request in case the reply is dropped"""
+    if key:
+      replyCache.put(key, response)
+    self.transport.write(response, address)
     log_msg('msg returned to client',  3)
     
-  def err(self, err, optional=None):
+  def err(self, err, address, key=None):
+    if key:
+      replyCache.cancel(key)
     #TODO: move this over to an error log file
-    log_msg('ERROR in request from ADDRESS:: %s:%s \n%s' %(self.address +(err,)))
+    log_msg('ERROR in request from ADDRESS:: %s:%s \n%s' %(address +(err,)))
     rep = str("An error was encountered with your request; contact kans or contact jash to get kans.")
-    self.reply(rep, False, False)
+    self.reply(rep, address)
   
   def drop_connection(self, reason = None):
     #log_msg('connection dropped by server', 2)
     self.transport.loseConnection()
   
-  def connectionLost(self, reason):
-    """is called when a connection is lost"""
-    del(self.handler) #helping the garbage collector out...
-    log_msg('connection lost: %s'%(reason.value), 2)
-    
 class TCPServer(Int32StringReceiver):
   MAX_LENGTH = 128 * 1024 * 1024 #128 megabytes
   """responsible for handling basic requests from the clients"""
@@ -200,19 +323,36 @@ class TCPServer(Int32StringReceiver):
     self.handler = None
     #: symmetric key associated with the relay
     self.symKey = None
+    #: RelaySession of the relay sending the request (for type 0 messages)
+    self.session = None
     #: tor hex id of the user sending the request
     self.hexId = 'unknown'
+    #: reply cache key for payment requests
+    self.cacheKey = None
 
   def stringReceived(self, data):
     try:
       #if this is the first request on the connection, the data gets a handler
       if not self.handler:
+        #payments might be retransmitted, possibly after first trying over UDP
+        key = ReplyCache.get_key(data)
+        response = replyCache.get(key)
+        if response:
+          self.reply(response)
+          return
+        if replyCache.is_pending(key):
+          #let the client retry later
+          self.drop_connection()
+          return
+        self.cacheKey = key
         d = self.sym_decrypt(data)
         d.addCallback(self.handle_message)
         d.addErrback(self.err, optional="INVALID REQUEST")
       else:
         msg = self.symKey.decrypt(data)
-        self.handler.on_message(msg)
+        d = self.handler.on_message(msg)
+        if d:
+          d.addErrback(self.err)
     except Exception, e:
       self.err(e)
     
@@ -225,13 +365,19 @@ class TCPServer(Int32StringReceiver):
       self.handler = ACoinMessages.Deposit(self.encrypted_reply, self.owner, self.hexId)
     elif request_type == 3:
       self.owner = self.transport.getPeer()
-      self.handler =  ACoinMessages.Payment(self.reply, self.owner) 
+      if not replyCache.start(self.cacheKey):
+        #let the client retry later
+        self.cacheKey = None
+        self.drop_connection()
+        return
+      self.handler =  ACoinMessages.Payment(self.cached_reply, self.owner) 
     else:
       log_msg('invalid request: %s, %s' % (request_type, msg), 1)
       self.reply('invalid request: %s' % (request_type))
       #self.drop_connection()
       return
-    self.handler.on_message(msg)
+    #may return a Deferred, in which case errors will propagate to our errback
+    return self.handler.on_message(msg)
     
   def reply(self, msg):
     """returns string msg to client"""
@@ -241,12 +387,20 @@ class TCPServer(Int32StringReceiver):
     self.drop_connection()
     return
   
+  def cached_reply(self, msg):
+    """returns msg to the client, and remembers it in case the request is retransmitted"""
+    msg = str(msg)
+    replyCache.put(self.cacheKey, msg)
+    self.reply(msg)
+    
   def encrypted_reply(self,  msg):
     """returns an encrypted reply to the client"""
     msg = self.symKey.encrypt(msg)
     self.reply(msg)
     
   def err(self, err, optional=None):
+    if self.cacheKey:
+      replyCache.cancel(self.cacheKey)
     #TODO: move this over to an error log file
     log_msg('ERROR in request from ADDRESS: %s with HEXID: %s\n%s ' % (self.transport.getPeer(), self.hexId, err),  )
     rep = str("An error was encountered with your request; contact kans or contact jash to get kans.")
@@ -278,12 +432,9 @@ class TCPServer(Int32StringReceiver):
         (binId,), msg = Basic.read_message('!20s', msg)
         #convert the tor fingerprint back into hex
         self.hexId = binascii.hexlify(binId).upper()
-        #get the symmetric key out of the database:
-        sql = "SELECT Owner, Public_Key, Msgnum, auth_blob FROM Relays WHERE Tor_Id = %s"
-        inj = (self.hexId,)
-        d = db.read(sql, inj)
-        #get the sym key from the db and decrypt the msg
-        d.addCallback(self.fetch_sym_key, msg)
+        #get the sym key (cached, or from the db) and decrypt the msg
+        d = relaySessions.decrypt(self.hexId, msg)
+        d.addCallback(self.fetch_sym_key)
         #update the message number in the database
         d.addCallback(self.update_db)
       elif msgType is 1:
@@ -295,12 +446,12 @@ class TCPServer(Int32StringReceiver):
       raise Exception('Passing more than one message per tcp connection is currently not supported')
     return d
     
-  def fetch_sym_key(self, tup, encrypted):
-    """utility function to get the authblob from the database which is set at time of login"""
-    assert len(tup) == 1
-    self.owner, n, self.previousMsgnum, authBlob = tup[0]
-    self.symKey = SymmetricKey.SymmetricKey(authBlob)
-    return self.symKey.decrypt(encrypted)
+  def fetch_sym_key(self, result):
+    """utility function to remember the session (which holds the key set at time of login)"""
+    self.session, msg = result
+    self.owner = self.session.owner
+    self.symKey = self.session
+    return msg
     
   def update_db(self, blob):
     """utility function that updates verifies the nonce in the msg and then updates the nonce in the db"""
@@ -308,17 +459,10 @@ class TCPServer(Int32StringReceiver):
     if protocol is not 1:
       raise Exception('change protocol')
     msgNum, blob = Basic.read_short(blob)
-    #the msgNum is a nonce to prevent replay attacks- 
-    #the client always increases it by one, we just check that it is bigger
-    if msgNum > self.previousMsgnum:
-      #update the msgnum in the db to be this msgnum of course - 
-      #not generally threadsafe
-      sql = "UPDATE Relays SET Msgnum = %s WHERE tor_id = %s"
-      inj = (msgNum, self.hexId)
-      d = db.write(sql, inj)
-    else:
-      raise Exception('replay attack or something')
-    return blob
+    #the nonce is written (in a batch with other relays) before the message is acted on
+    d = relaySessions.use_msgnum(self.session, msgNum)
+    d.addCallback(lambda result: blob)
+    return d
     
   def get_sym_key_value(self, msg):
     """utility function that does a decrypt with the one time key"""
@@ -13,6 +13,8 @@ from serverCommon import db
 
 MAX_BANK_CLOCK_SKEW = 1.0*60.0
 EXPIRED_CHECK_INTERVAL = 1.0*60.0
+#: the scheduled lookup of the next acoin interval
+_nextLookup = None
 
 def get_interval_time_deltas():
   curTime = int(time.time())
@@ -81,7 +83,11 @@ def learned_current_acoin_interval(tup, onAcoinInterval=None, onNewIntervalCallb
   lookupTime = expires-now + (MAX_BANK_CLOCK_SKEW)
   if lookupTime <= 0:
     lookupTime = EXPIRED_CHECK_INTERVAL
-  Globals.reactor.callLater(lookupTime, update_local_acoin_interval, onAcoinInterval, onNewIntervalCallback)
+  #there might already be a lookup scheduled, if this one was triggered early
+  global _nextLookup
+  if _nextLookup and _nextLookup.active():
+    _nextLookup.cancel()
+  _nextLookup = Globals.reactor.callLater(lookupTime, update_local_acoin_interval, onAcoinInterval, onNewIntervalCallback)
 
 def add_time_tuple_to_ctime(now, dif):
   """
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Cache of the session keys and message numbers of relays that are logged in to the bank.
+Saves looking up the relay in the database for every message.  The message numbers are
+still written to the database (so that replays are rejected even after a restart, or by
+other bank processes), but in batches, and before the message is acted on."""
+
+from twisted.internet import reactor, defer
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+from common.classes import SymmetricKey
+from serverCommon import db
+
+class ReplayError(Exception):
+  """The message number was not larger than the last one from this relay"""
+
+class RelaySession():
+  """The login session of a single relay"""
+  def __init__(self, hexId, owner, msgNum, authBlob):
+    #: tor hex id of the relay
+    self.hexId = hexId
+    #: username of the account that owns the relay
+    self.owner = owner
+    #: highest message number that we have accepted
+    self.msgNum = msgNum
+    #: the key that was created when the relay logged in
+    self.symKey = SymmetricKey.SymmetricKey(authBlob)
+
+  def decrypt(self, encrypted):
+    #each message is encrypted from the start of the stream
+    self.symKey.reset()
+    return self.symKey.decrypt(encrypted)
+
+  def encrypt(self, msg):
+    self.symKey.reset()
+    return self.symKey.encrypt(msg)
+
+class RelaySessionCache():
+  """Maps from tor id to RelaySession.  When a relay logs in again, it gets a new key,
+  so its messages will fail to authenticate with the cached session.  That causes the
+  session to be reloaded from the database."""
+  def __init__(self, maxEntries=20000):
+    self.maxEntries = maxEntries
+    #: mapping from hexId to RelaySession
+    self._sessions = {}
+    #: mapping from hexId to (msgNum, list of Deferreds) waiting to be written
+    self._pendingMsgNums = {}
+    #: the delayed call that will write self._pendingMsgNums
+    self._flushEvent = None
+    #: statistics:
+    self.hits = 0
+    self.misses = 0
+    self.numWrites = 0
+
+  def invalidate(self, hexId):
+    """Forget about this relay, so it will be loaded from the database next time"""
+    if hexId in self._sessions:
+      del self._sessions[hexId]
+
+  def decrypt(self, hexId, encrypted):
+    """Decrypt a message from a relay
+    @returns:  Deferred that fires with (RelaySession, decrypted message)"""
+    session = self._sessions.get(hexId)
+    if session:
+      try:
+        msg = session.decrypt(encrypted)
+        self.hits += 1
+        return defer.succeed((session, msg))
+      except Exception, e:
+        #probably logged in again since we cached their key
+        log_msg("Reloading session for %s:  %s" % (hexId, e), 3)
+        self.invalidate(hexId)
+    self.misses += 1
+    d = self._load(hexId)
+    def decrypt_with_new_session(session):
+      return (session, session.decrypt(encrypted))
+    d.addCallback(decrypt_with_new_session)
+    return d
+
+  def _load(self, hexId):
+    sql = "SELECT Owner, Msgnum, auth_blob FROM Relays WHERE Tor_Id = %s"
+    inj = (hexId,)
+    d = db.read(sql, inj)
+    def loaded(tup):
+      assert len(tup) == 1
+      owner, msgNum, authBlob = tup[0]
+      session = RelaySession(hexId, owner, msgNum, str(authBlob))
+      if len(self._sessions) >= self.maxEntries:
+        self._sessions.popitem()
+      self._sessions[hexId] = session
+      return session
+    d.addCallback(loaded)
+    return d
+
+  def use_msgnum(self, session, msgNum):
+    """The msgNum is a nonce to prevent replay attacks- the client always increases
+    it by one, we just check that it is bigger.
+    @returns:  Deferred that fires once the new msgNum has been written to the database,
+    or fails with ReplayError"""
+    if msgNum <= session.msgNum:
+      return defer.fail(ReplayError('replay attack or something'))
+    session.msgNum = msgNum
+    #several messages from the same relay in one batch only need the highest number
+    oldNum, deferreds = self._pendingMsgNums.get(session.hexId, (0, []))
+    d = defer.Deferred()
+    deferreds.append(d)
+    self._pendingMsgNums[session.hexId] = (max(oldNum, msgNum), deferreds)
+    if not self._flushEvent:
+      self._flushEvent = reactor.callLater(0, self._flush_msgnums)
+    return d
+
+  def _flush_msgnums(self):
+    """Write all pending message numbers in a single statement.  Only rows where the number
+    increases are updated, so a replay sent to another bank process is still caught."""
+    self._flushEvent = None
+    pending, self._pendingMsgNums = self._pendingMsgNums, {}
+    values = []
+    inj = []
+    for hexId, (msgNum, deferreds) in pending.iteritems():
+      values.append("(%s, %s)")
+      inj += [hexId, msgNum]
+    sql = "UPDATE Relays SET Msgnum = v.msgnum FROM (VALUES " + ", ".join(values) + ") AS v(tor_id, msgnum) " + \
+          "WHERE Relays.Tor_Id = v.tor_id AND Relays.Msgnum < v.msgnum RETURNING Relays.Tor_Id"
+    self.numWrites += 1
+    d = db.read(sql, tuple(inj))
+    def written(rows):
+      updated = set([row[0] for row in rows])
+      for hexId, (msgNum, deferreds) in pending.iteritems():
+        if hexId in updated:
+          for waiting in deferreds:
+            waiting.callback(msgNum)
+        else:
+          #someone else already used this number, so our cached session is stale
+          self.invalidate(hexId)
+          for waiting in deferreds:
+            waiting.errback(ReplayError('replay attack or something'))
+    def failed(reason):
+      for hexId, (msgNum, deferreds) in pending.iteritems():
+        self.invalidate(hexId)
+        for waiting in deferreds:
+          waiting.errback(reason)
+    d.addCallbacks(written, failed)
+
+  def get_stats(self):
+    return "%s sessions, %s hits, %s misses, %s msgnum writes" % (len(self._sessions), self.hits, self.misses, self.numWrites)
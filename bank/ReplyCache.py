@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Cache of replies to payment messages, so that retransmitted payments (because the
+reply was dropped) get the same reply again instead of being processed twice.
+When several bank worker processes share the port, a retransmission usually reaches a
+different worker than the original did (SO_REUSEPORT picks the worker by source address,
+and clients send each retry from a new port).  So the workers also share their replies,
+and which requests are being processed, through a log next to the spent coin index.
+The log is compacted down to what is still in the cache whenever it grows past
+LOG_SIZE_FACTOR times the cache's byte limit."""
+
+import os
+import time
+import fcntl
+import struct
+from hashlib import sha1
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+from common import Globals
+
+#: rough per entry overhead, so that lots of tiny replies still count against the byte limit
+ENTRY_OVERHEAD = 100
+#: after this many seconds, a request that is still pending is assumed to be abandoned
+#: (whoever was processing it probably died).  Clients stop retransmitting after 60 seconds.
+PENDING_TIMEOUT = 60
+#: record types in a SharedReplyLog
+START, DONE, CANCEL = 1, 2, 3
+#: header of each record in a SharedReplyLog:  type, key, time, length of the reply that follows
+RECORD_HEADER = struct.Struct("!B20sII")
+#: a SharedReplyLog is compacted once it is this many times bigger than ReplyCache.maxBytes
+LOG_SIZE_FACTOR = 2
+
+def get_key(request):
+  """@returns:  the cache key for a request (the raw message from the client)"""
+  return sha1(request).digest()
+
+class CacheEntry():
+  """Node in the doubly linked recency list"""
+  __slots__ = ("key", "response", "expiresAt", "prev", "next")
+  def __init__(self, key, response, expiresAt):
+    self.key = key
+    self.response = response
+    self.expiresAt = expiresAt
+    self.prev = None
+    self.next = None
+
+class SharedReplyLog():
+  """Append-only log of the requests that were started, finished (with their replies) 
+  and cancelled by all bank worker processes.  Like SpentCoinShard, it is locked with 
+  flock while being read and appended to, and each process reads the records appended
+  by the others before using it.
+  rewrite replaces the whole file (by renaming a new one over it), and the other
+  processes notice when they next lock it, and start over from the beginning of the new file."""
+  def __init__(self, fileName):
+    self.fileName = fileName
+    #: the file descriptor, opened for appending
+    self.fd = self._open(fileName)
+    #: how much of the file has been read (or written by us)
+    self.offset = 0
+
+  def _open(self, fileName):
+    return os.open(fileName, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0600)
+
+  def lock(self):
+    while True:
+      fcntl.flock(self.fd, fcntl.LOCK_EX)
+      try:
+        current = os.stat(self.fileName)
+      except OSError:
+        #the whole interval was deleted, nobody else will use it either
+        return
+      ours = os.fstat(self.fd)
+      if (current.st_dev, current.st_ino) == (ours.st_dev, ours.st_ino):
+        return
+      #another process rewrote the log while we were waiting
+      os.close(self.fd)
+      self.fd = self._open(self.fileName)
+      self.offset = 0
+
+  def unlock(self):
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def read_new(self):
+    """Must be called with the lock held.
+    @returns:  list of (type, key, time, reply) for the records written since we last looked"""
+    size = os.fstat(self.fd).st_size
+    if size <= self.offset:
+      return []
+    os.lseek(self.fd, self.offset, os.SEEK_SET)
+    data = os.read(self.fd, size - self.offset)
+    records = []
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+      recordType, key, recordTime, length = RECORD_HEADER.unpack_from(data, pos)
+      end = pos + RECORD_HEADER.size + length
+      if end > len(data):
+        break
+      records.append((recordType, key, recordTime, data[pos+RECORD_HEADER.size:end]))
+      pos = end
+    #a crash in the middle of a write can leave a partial record at the end
+    if pos < len(data):
+      log_msg("Truncating partial record from %s" % (self.fileName), 1)
+      os.ftruncate(self.fd, self.offset + pos)
+    self.offset += pos
+    return records
+
+  def append(self, recordType, key, recordTime, response=""):
+    """Must be called with the lock held, after read_new"""
+    record = _pack_record(recordType, key, recordTime, response)
+    os.write(self.fd, record)
+    self.offset += len(record)
+
+  def rewrite(self, records):
+    """Replace the log with just records (a list of (type, key, time, reply)).
+    Must be called with the lock held, after read_new.  The lock is still held afterward."""
+    tempName = "%s.%s.tmp" % (self.fileName, os.getpid())
+    fd = self._open(tempName)
+    try:
+      #so nobody can use the new file until we are done with it
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      os.ftruncate(fd, 0)
+      data = "".join([_pack_record(*record) for record in records])
+      os.write(fd, data)
+      os.rename(tempName, self.fileName)
+    except:
+      os.close(fd)
+      raise
+    #closing the old file releases its lock, and anyone waiting for it will move to the new file
+    os.close(self.fd)
+    self.fd = fd
+    self.offset = len(data)
+
+  def close(self):
+    os.close(self.fd)
+
+def _pack_record(recordType, key, recordTime, response=""):
+  return RECORD_HEADER.pack(recordType, key, int(recordTime), len(response)) + response
+
+class ReplyCache():
+  """Least recently used cache of replies, bounded by number of entries and total bytes.
+  Entries expire once the coins in the request could no longer be deposited anyway."""
+  def __init__(self, maxEntries=5000, maxBytes=8*1024*1024):
+    self.maxEntries = maxEntries
+    self.maxBytes = maxBytes
+    #: compact the SharedReplyLog when it gets bigger than this
+    self.maxLogBytes = LOG_SIZE_FACTOR * maxBytes
+    #: mapping from key to CacheEntry
+    self._entries = {}
+    #: mapping from the key of each request that is being processed right now to when it started
+    self._pending = {}
+    #: keys of the pending requests that this process is processing
+    self._started = set()
+    #: SharedReplyLog, if the replies are shared with other processes
+    self.sharedLog = None
+    #: sentinel for the recency list.  _head.next is the most recently used entry
+    self._head = CacheEntry(None, None, 0)
+    self._head.prev = self._head.next = self._head
+    #: total size of everything in the cache
+    self.numBytes = 0
+    #: statistics:
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.compactions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _unlink(self, entry):
+    entry.prev.next = entry.next
+    entry.next.prev = entry.prev
+
+  def _push_front(self, entry):
+    entry.prev = self._head
+    entry.next = self._head.next
+    self._head.next.prev = entry
+    self._head.next = entry
+
+  def _remove(self, entry):
+    self._unlink(entry)
+    del self._entries[entry.key]
+    self.numBytes -= len(entry.response) + ENTRY_OVERHEAD
+
+  def share(self, fileName):
+    """Share replies with the other processes that use the log in fileName, instead
+    of the previous log (if any).  Called for each new ACoin interval."""
+    if self.sharedLog:
+      self.sharedLog.close()
+    self.sharedLog = SharedReplyLog(fileName)
+    self._lock()
+    try:
+      self._catch_up()
+    finally:
+      self._unlock()
+
+  def _lock(self):
+    if self.sharedLog:
+      self.sharedLog.lock()
+
+  def _unlock(self):
+    if self.sharedLog:
+      self.sharedLog.unlock()
+
+  def _catch_up(self):
+    """Learn about the requests and replies from other processes.  Must be called with the lock held."""
+    if not self.sharedLog:
+      return
+    for recordType, key, recordTime, response in self.sharedLog.read_new():
+      if recordType == START:
+        self._pending[key] = recordTime
+      else:
+        self._pending.pop(key, None)
+        if recordType == DONE:
+          self._store(key, response)
+
+  def _log(self, recordType, key, response=""):
+    if not self.sharedLog:
+      return
+    self._lock()
+    try:
+      self._catch_up()
+      self.sharedLog.append(recordType, key, time.time(), response)
+      self._check_log_size()
+    finally:
+      self._unlock()
+
+  def _check_log_size(self):
+    """Rewrite the log with only what is still cached or pending, if it got too big.
+    Must be called with the lock held, right after catching up."""
+    if self.sharedLog.offset <= self.maxLogBytes:
+      return
+    now = time.time()
+    records = []
+    for key, startTime in self._pending.iteritems():
+      if startTime + PENDING_TIMEOUT > now:
+        records.append((START, key, startTime, ""))
+    #least recently used first, so replaying the log keeps the same order
+    entry = self._head.prev
+    while entry is not self._head:
+      if entry.expiresAt >= now:
+        records.append((DONE, entry.key, now, entry.response))
+      entry = entry.prev
+    self.sharedLog.rewrite(records)
+    self.compactions += 1
+    log_msg("Compacted %s to %s records" % (self.sharedLog.fileName, len(records)), 3)
+
+  def _get_entry(self, key):
+    """@returns:  the CacheEntry for key, or None if there is none or it expired"""
+    entry = self._entries.get(key)
+    if entry and entry.expiresAt < time.time():
+      self._remove(entry)
+      self.expirations += 1
+      return None
+    return entry
+
+  def get(self, key):
+    """@returns:  the cached reply for key, or None"""
+    entry = self._get_entry(key)
+    if not entry and self.sharedLog:
+      #maybe another process replied to it
+      self._lock()
+      try:
+        self._catch_up()
+      finally:
+        self._unlock()
+      entry = self._get_entry(key)
+    if not entry:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._unlink(entry)
+    self._push_front(entry)
+    return entry.response
+
+  def is_pending(self, key):
+    """@returns:  True if the request is still being processed (ie, this is a retransmission
+    that arrived before we replied to the original)"""
+    startTime = self._pending.get(key)
+    return startTime is not None and startTime + PENDING_TIMEOUT > time.time()
+
+  def start(self, key):
+    """Mark the request as being processed.  This is atomic across the processes
+    sharing the log, so only one of them will process any request.
+    @returns:  False if the request was already replied to or is being processed"""
+    self._lock()
+    try:
+      self._catch_up()
+      if self._get_entry(key) or self.is_pending(key):
+        return False
+      now = time.time()
+      self._pending[key] = now
+      self._started.add(key)
+      if self.sharedLog:
+        self.sharedLog.append(START, key, now)
+        self._check_log_size()
+      return True
+    finally:
+      self._unlock()
+
+  def cancel(self, key):
+    """The request failed, so nothing will be cached"""
+    #might have failed before it was started (and another process might be processing it)
+    if key in self._started:
+      self._started.remove(key)
+      self._pending.pop(key, None)
+      self._log(CANCEL, key)
+
+  def put(self, key, response):
+    """Store the reply to a request"""
+    self._pending.pop(key, None)
+    self._store(key, response)
+    if key in self._started:
+      self._started.remove(key)
+      self._log(DONE, key, response)
+
+  def _store(self, key, response):
+    size = len(response) + ENTRY_OVERHEAD
+    if size > self.maxBytes:
+      return
+    old = self._entries.get(key)
+    if old:
+      self._remove(old)
+    #coins from the current interval can be deposited until the next interval spoils
+    if Globals.CURRENT_ACOIN_INTERVAL:
+      expiresAt = Globals.CURRENT_ACOIN_INTERVAL[2]
+    else:
+      expiresAt = time.time()
+    entry = CacheEntry(key, response, expiresAt)
+    self._entries[key] = entry
+    self._push_front(entry)
+    self.numBytes += size
+    #evict from the least recently used end
+    while len(self._entries) > self.maxEntries or self.numBytes > self.maxBytes:
+      self._remove(self._head.prev)
+      self.evictions += 1
+
+  def expire(self):
+    """Remove everything that has expired.  Called when the ACoin interval rolls over."""
+    now = time.time()
+    for entry in self._entries.values():
+      if entry.expiresAt < now:
+        self._remove(entry)
+        self.expirations += 1
+    #and forget about requests that were abandoned
+    for key, startTime in self._pending.items():
+      if startTime + PENDING_TIMEOUT < now and key not in self._started:
+        del self._pending[key]
+
+  def get_stats(self):
+    return "%s entries (%s bytes), %s hits, %s misses, %s evictions, %s expirations, %s log compactions" % \
+           (len(self._entries), self.numBytes, self.hits, self.misses, self.evictions, self.expirations, self.compactions)
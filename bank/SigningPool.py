@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Worker process pool for the blind RSA signatures done by the bank.
+Every coin minted or paid costs one private key operation.  Instead of doing those
+on the reactor, blobs from all requests received during one reactor iteration are
+batched together, split into chunks, and signed by a pool of worker processes."""
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+from twisted.internet import reactor, defer
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+from common import Globals
+from common.classes import PrivateKey
+
+#: the most blobs that will be sent to a worker in a single task
+DEFAULT_CHUNK_SIZE = 32
+
+#: the ACoin key, as loaded in each worker process
+_workerKey = None
+
+def _init_worker(keyFileName):
+  """Called once in each worker process to load the private key.
+  M2Crypto keys cannot be pickled, so each worker loads its own copy from disk."""
+  global _workerKey
+  #the supervisor is responsible for shutting the workers down
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGHUP, signal.SIG_IGN)
+  _workerKey = PrivateKey.PrivateKey(keyFileName)
+
+def _sign_chunk(blobs):
+  """Runs in a worker process.  Exceptions are returned instead of raised, since
+  apply_async has no way to report them back to us otherwise.
+  @returns:  (True, list of signatures) or (False, error string)"""
+  try:
+    return True, _workerKey.decrypt_batch(blobs)
+  except Exception, e:
+    return False, "%s: %s" % (e.__class__.__name__, e)
+
+class SigningJob():
+  """The signatures requested by a single message, which may be spread over many chunks"""
+  def __init__(self, numBlobs):
+    #: signatures, in the same order as the blobs that were submitted
+    self.results = [None] * numBlobs
+    #: how many signatures we are still waiting on
+    self.remaining = numBlobs
+    #: whether this job already failed (so we only errback once)
+    self.failed = False
+    #: fired with self.results when every blob has been signed
+    self.deferred = defer.Deferred()
+
+  def got_signature(self, index, sig):
+    if self.failed:
+      return
+    self.results[index] = sig
+    self.remaining -= 1
+    if self.remaining <= 0:
+      self.deferred.callback(self.results)
+
+  def got_error(self, reason):
+    if self.failed:
+      return
+    self.failed = True
+    self.deferred.errback(Exception("Signing failed:  %s" % (reason)))
+
+class SigningPool():
+  """Signs blinded blobs with the ACoin key in a pool of worker processes"""
+  def __init__(self, keyFileName, numWorkers=None, chunkSize=DEFAULT_CHUNK_SIZE):
+    """@param keyFileName:  location of the private key RSA pem file
+    @param numWorkers:  how many processes to sign in.  Defaults to one per core.
+    0 means to sign in this process instead (useful for debugging)
+    @param chunkSize:  the most blobs to hand to a worker at once"""
+    if numWorkers is None:
+      numWorkers = multiprocessing.cpu_count()
+    self.numWorkers = numWorkers
+    self.chunkSize = chunkSize
+    #: (job, blobs) submitted during this reactor iteration
+    self._pending = []
+    #: the delayed call that will flush self._pending
+    self._flushEvent = None
+    if self.numWorkers > 0:
+      self._pool = multiprocessing.Pool(self.numWorkers, _init_worker, (keyFileName,))
+      self._key = None
+    else:
+      self._pool = None
+      self._key = PrivateKey.PrivateKey(keyFileName)
+    #: statistics, for logging
+    self.numSigned = 0
+    self.numBatches = 0
+
+  def sign(self, blobs):
+    """Sign each blob with the private key (no padding, as for blinding)
+    @param blobs:  the blinded messages to sign
+    @type blobs:  list of strings
+    @returns:  Deferred that fires with a list of signatures in the same order"""
+    if not blobs:
+      return defer.succeed([])
+    if not self._pool:
+      return defer.succeed(self._key.decrypt_batch(blobs))
+    job = SigningJob(len(blobs))
+    self._pending.append((job, blobs))
+    #wait until the end of this reactor iteration so other requests can join the batch
+    if not self._flushEvent:
+      self._flushEvent = reactor.callLater(0, self._flush)
+    return job.deferred
+
+  def _flush(self):
+    """Send every pending blob to the workers, spread evenly across them"""
+    self._flushEvent = None
+    pending, self._pending = self._pending, []
+    entries = []
+    blobs = []
+    for job, jobBlobs in pending:
+      for index, blob in enumerate(jobBlobs):
+        entries.append((job, index))
+        blobs.append(blob)
+    #use smaller chunks when there is not enough work to keep every worker busy
+    perWorker = (len(blobs) + self.numWorkers - 1) / self.numWorkers
+    chunkSize = max(1, min(self.chunkSize, perWorker))
+    for start in range(0, len(blobs), chunkSize):
+      end = start + chunkSize
+      self._submit(entries[start:end], blobs[start:end])
+    self.numBatches += 1
+
+  def _submit(self, entries, blobs):
+    def on_done(result):
+      #called from the pool's result thread
+      reactor.callFromThread(self._chunk_done, entries, result)
+    self._pool.apply_async(_sign_chunk, (blobs,), callback=on_done)
+
+  def _chunk_done(self, entries, result):
+    success, value = result
+    if not success:
+      log_msg("Worker failed to sign %s blobs:  %s" % (len(entries), value), 0)
+      for job, index in entries:
+        job.got_error(value)
+      return
+    self.numSigned += len(value)
+    for (job, index), sig in zip(entries, value):
+      job.got_signature(index, sig)
+
+  def stop(self):
+    """Shut down the worker processes"""
+    if self._flushEvent and self._flushEvent.active():
+      self._flushEvent.cancel()
+    self._flushEvent = None
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+if __name__ == "__main__":
+  #benchmark:  signatures per second for increasing numbers of worker processes
+  import tempfile
+  from random import getrandbits
+  from common.utils import Basic
+
+  NUM_REQUESTS = 40
+  COINS_PER_REQUEST = 50
+  fd, keyFile = tempfile.mkstemp(".pem")
+  os.close(fd)
+  key = PrivateKey.PrivateKey(Globals.ACOIN_KEY_BYTES*8)
+  key.key.save_key(keyFile, None)
+  requests = []
+  for i in range(NUM_REQUESTS):
+    requests.append([key.blind("\0"*8, getrandbits(256)) for j in range(COINS_PER_REQUEST)])
+  total = NUM_REQUESTS * COINS_PER_REQUEST
+  workerCounts = range(0, multiprocessing.cpu_count()+1)
+
+  def run_next(result=None):
+    if not workerCounts:
+      reactor.stop()
+      return
+    numWorkers = workerCounts.pop(0)
+    pool = SigningPool(keyFile, numWorkers)
+    startTime = time.time()
+    d = defer.DeferredList([pool.sign(blobs) for blobs in requests], fireOnOneErrback=True)
+    def report(results):
+      elapsed = time.time() - startTime
+      pool.stop()
+      print "%2d workers:  %6d signatures in %.2fs = %.1f signatures/sec" % (numWorkers, total, elapsed, total / elapsed)
+      #sanity check one of the signatures:
+      sig = results[0][1][0]
+      assert key.encrypt(sig, False) == requests[0][0]
+    d.addCallback(report)
+    d.addCallback(run_next)
+    d.addErrback(lambda reason: (sys.stderr.write(str(reason)), reactor.stop()))
+
+  reactor.callWhenRunning(run_next)
+  reactor.run()
+  os.remove(keyFile)
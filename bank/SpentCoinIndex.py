@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Persistent record of every ACoin that has been deposited, to prevent double spending.
+Each ACoin interval gets its own directory, split into shards by the leading byte of
+the coin digest.  The number of shards is stored in each interval directory when it is
+created, so changing it only affects new intervals.  Each shard is an append-only log of fixed width digests, which is
+replayed into an in-memory set.  Shards are locked with flock while being checked and
+appended to, and any records appended by other processes are read first, so several
+bank processes can safely share one index.  Deposits are made durable with group
+commits:  every coin recorded during a reactor iteration is fsynced together, in a
+thread, so the reactor never waits for the disk."""
+
+import os
+import fcntl
+import shutil
+import struct
+from twisted.internet import reactor, threads, defer
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+#: md5 digest, see ACoin.store()
+DIGEST_SIZE = 16
+#: file extension for shard logs
+SHARD_EXTENSION = ".spent"
+#: file in each interval directory that says how many shards it is split into
+SHARD_COUNT_FILE = "shards"
+
+def _fsync_all(fds):
+  """Called in a thread, see SpentCoinIndex.sync_soon"""
+  try:
+    for fd in fds:
+      os.fsync(fd)
+  finally:
+    for fd in fds:
+      os.close(fd)
+
+class SpentCoinShard():
+  """One append-only log of digests, and the set of digests that it contains"""
+  def __init__(self, fileName):
+    self.fileName = fileName
+    #: the file descriptor, opened for appending
+    self.fd = os.open(fileName, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0600)
+    #: digests of every coin that was deposited
+    self.digests = set()
+    #: how much of the file has been read into self.digests
+    self.offset = 0
+    #: whether there are writes that have not been fsynced yet
+    self.isDirty = False
+    self._lock()
+    try:
+      self._catch_up()
+    finally:
+      self._unlock()
+
+  def _lock(self):
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+  def _unlock(self):
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def _catch_up(self):
+    """Read any records written since we last looked (possibly by another process).
+    Must be called with the lock held."""
+    size = os.fstat(self.fd).st_size
+    #a crash in the middle of a write can leave a partial record at the end
+    remainder = size % DIGEST_SIZE
+    if remainder:
+      log_msg("Truncating partial record from %s" % (self.fileName), 1)
+      size -= remainder
+      os.ftruncate(self.fd, size)
+    if size <= self.offset:
+      return
+    os.lseek(self.fd, self.offset, os.SEEK_SET)
+    data = os.read(self.fd, size - self.offset)
+    for i in range(0, len(data), DIGEST_SIZE):
+      self.digests.add(data[i:i+DIGEST_SIZE])
+    self.offset += len(data)
+
+  def add(self, digest):
+    """@returns:  True if the digest was added, False if it was already present"""
+    #quick check, no need to lock for coins we already know about
+    if digest in self.digests:
+      return False
+    self._lock()
+    try:
+      self._catch_up()
+      if digest in self.digests:
+        return False
+      os.write(self.fd, digest)
+      self.offset += DIGEST_SIZE
+      self.digests.add(digest)
+      self.isDirty = True
+      return True
+    finally:
+      self._unlock()
+
+  def sync(self):
+    if self.isDirty:
+      os.fsync(self.fd)
+      self.isDirty = False
+
+  def start_sync(self):
+    """For syncing from another thread.  The shard might be closed before that
+    finishes, so the caller gets (and must close) a copy of the descriptor.
+    @returns:  the copy, or None if there is nothing to sync"""
+    if not self.isDirty:
+      return None
+    self.isDirty = False
+    return os.dup(self.fd)
+
+  def close(self):
+    self.sync()
+    os.close(self.fd)
+
+class SpentCoinIndex():
+  """The set of deposited coins, for each ACoin interval"""
+  def __init__(self, baseDir, numShards):
+    """@param baseDir:  folder to store the interval directories in
+    @param numShards:  how many shards to split each new interval into"""
+    self.baseDir = baseDir
+    self.numShards = numShards
+    #: mapping from interval to list of SpentCoinShards
+    self.intervals = {}
+    #: Deferreds waiting for the next group commit
+    self._syncWaiters = []
+    #: the delayed call that will start the next group commit
+    self._syncEvent = None
+    #: whether a group commit is being written right now
+    self._isSyncing = False
+    #: statistics, for logging
+    self.numSyncs = 0
+    if not os.path.exists(self.baseDir):
+      os.makedirs(self.baseDir)
+
+  def get_interval_dir(self, interval):
+    return os.path.join(self.baseDir, str(interval))
+
+  def open_interval(self, interval):
+    """Load (or create) the index for interval"""
+    if interval in self.intervals:
+      return
+    dirName = self.get_interval_dir(interval)
+    if not os.path.exists(dirName):
+      try:
+        os.makedirs(dirName)
+      except OSError:
+        #another process might have just made it
+        if not os.path.exists(dirName):
+          raise
+    numShards = self._get_shard_count(dirName)
+    shards = []
+    for i in range(numShards):
+      shards.append(SpentCoinShard(os.path.join(dirName, "%s%s" % (i, SHARD_EXTENSION))))
+    self.intervals[interval] = shards
+    log_msg("Loaded %s spent coins for interval %s" % (sum([len(s.digests) for s in shards]), interval), 3)
+
+  def _get_shard_count(self, dirName):
+    """@returns:  how many shards the interval in dirName is split into.  If it is new,
+    that is self.numShards, which is recorded for every process that opens it later."""
+    fileName = os.path.join(dirName, SHARD_COUNT_FILE)
+    if not os.path.exists(fileName):
+      #intervals from before the count was stored have every shard file already
+      numShards = len([name for name in os.listdir(dirName) if name.endswith(SHARD_EXTENSION)])
+      if not numShards:
+        numShards = self.numShards
+      tempName = "%s.%s" % (fileName, os.getpid())
+      f = open(tempName, "wb")
+      f.write(str(numShards))
+      f.close()
+      #if another process just stored it, keep theirs
+      try:
+        os.link(tempName, fileName)
+      except OSError:
+        pass
+      os.remove(tempName)
+    f = open(fileName, "rb")
+    numShards = int(f.read())
+    f.close()
+    if numShards != self.numShards:
+      log_msg("Interval %s is split into %s shards instead of %s" % (os.path.basename(dirName), numShards, self.numShards), 1)
+    return numShards
+
+  def drop_interval(self, interval, deleteFiles=True):
+    """Forget about every coin from interval, and delete its files.
+    Costs the same regardless of how many coins were deposited.
+    @param deleteFiles:  whether to delete the files too.  When several processes
+    share the index, only one of them should do that."""
+    shards = self.intervals.pop(interval, None)
+    if shards:
+      for shard in shards:
+        shard.close()
+    dirName = self.get_interval_dir(interval)
+    if deleteFiles and os.path.exists(dirName):
+      shutil.rmtree(dirName, True)
+
+  def drop_all_except(self, keepIntervals, deleteFiles=True):
+    """Drop every interval, whether loaded or only on the disk, that is not in keepIntervals"""
+    stored = set(self.intervals.keys())
+    if deleteFiles:
+      for name in os.listdir(self.baseDir):
+        if name.isdigit():
+          stored.add(int(name))
+    for interval in stored:
+      if interval not in keepIntervals:
+        log_msg("Dropping spent coins for expired interval %s" % (interval), 3)
+        self.drop_interval(interval, deleteFiles)
+
+  def add(self, interval, digest):
+    """Record that the coin with this digest was deposited.
+    @param digest:  from ACoin.store()
+    @returns:  True if this is the first time the coin was deposited, False otherwise"""
+    assert len(digest) == DIGEST_SIZE, "digests must be %s bytes" % (DIGEST_SIZE)
+    if interval not in self.intervals:
+      self.open_interval(interval)
+    shards = self.intervals[interval]
+    shardNum = struct.unpack('B', digest[0])[0] % len(shards)
+    return shards[shardNum].add(digest)
+
+  def sync(self):
+    """Make sure that every recorded coin is on the disk.  Blocks until it is, so
+    the reactor should use sync_soon instead."""
+    for shards in self.intervals.values():
+      for shard in shards:
+        shard.sync()
+
+  def sync_soon(self):
+    """Make sure that every recorded coin is on the disk, without blocking.  Every
+    caller during this reactor iteration shares one fsync per dirty shard, which
+    happens in a thread.  Callers must not tell clients that their deposit succeeded
+    until it fires.
+    @returns:  Deferred that fires once the coins recorded so far are on the disk"""
+    d = defer.Deferred()
+    self._syncWaiters.append(d)
+    #wait until the end of this reactor iteration so other deposits can join the batch
+    if not self._syncEvent and not self._isSyncing:
+      self._syncEvent = reactor.callLater(0, self._group_commit)
+    return d
+
+  def _group_commit(self):
+    self._syncEvent = None
+    waiters, self._syncWaiters = self._syncWaiters, []
+    shards = []
+    fds = []
+    for intervalShards in self.intervals.values():
+      for shard in intervalShards:
+        fd = shard.start_sync()
+        if fd is not None:
+          shards.append(shard)
+          fds.append(fd)
+    if not fds:
+      for waiting in waiters:
+        waiting.callback(None)
+      return
+    self._isSyncing = True
+    self.numSyncs += 1
+    d = threads.deferToThread(_fsync_all, fds)
+    def synced(result):
+      self._isSyncing = False
+      for waiting in waiters:
+        waiting.callback(None)
+      self._start_next_commit()
+    def failed(reason):
+      self._isSyncing = False
+      log_msg("Failed to sync spent coins:  %s" % (reason.getErrorMessage()), 0)
+      #they are still not known to be on the disk
+      for shard in shards:
+        shard.isDirty = True
+      for waiting in waiters:
+        waiting.errback(reason)
+      self._start_next_commit()
+    d.addCallbacks(synced, failed)
+
+  def _start_next_commit(self):
+    #anything that was recorded while the last commit was being written goes in the next one
+    if self._syncWaiters and not self._syncEvent:
+      self._syncEvent = reactor.callLater(0, self._group_commit)
+
+  def close(self):
+    if self._syncEvent and self._syncEvent.active():
+      self._syncEvent.cancel()
+    self._syncEvent = None
+    for shards in self.intervals.values():
+      for shard in shards:
+        shard.close()
+    self.intervals = {}
@@ -49,3 +49,17 @@ DROP FUNCTION drop_trigger();
 
 CREATE TRIGGER safe_insert_new_user_trigger BEFORE INSERT ON accounts
    FOR EACH ROW EXECUTE PROCEDURE safe_insert_new_user();
+
+CREATE OR REPLACE FUNCTION debit_account(user_name VARCHAR, amount INT, OUT success BOOLEAN, OUT new_balance INT) AS $$
+BEGIN
+  UPDATE accounts SET balance = balance - amount
+    WHERE username = user_name AND balance >= amount
+    RETURNING balance INTO new_balance;
+  IF FOUND THEN
+    success := true;
+  ELSE
+    success := false;
+    SELECT balance INTO new_balance FROM accounts WHERE username = user_name;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Load test for debiting accounts when ACoins are requested.  Compares the old way
+(SELECT the balance, then UPDATE it) with the debit_account function from
+account_functions.sql, and prints the database round trips and time per request.
+Needs a database with account_functions.sql loaded.  Creates and deletes its own account."""
+
+import sys
+import time
+
+from twisted.internet import reactor, defer
+
+from serverCommon import db
+
+USERNAME = "debit_load_test"
+NUM_REQUESTS = 2000
+CONCURRENCY = 20
+BILL = 1
+
+def old_debit():
+  d = db.read("SELECT balance FROM Accounts WHERE Username = %s", (USERNAME,))
+  def update(tup):
+    proposedBalance = int(tup[0][0]) - BILL
+    if proposedBalance >= 0:
+      return db.write("UPDATE Accounts SET Balance = %s WHERE Username = %s", (proposedBalance, USERNAME))
+  d.addCallback(update)
+  return d
+  
+def new_debit():
+  return db.read("SELECT success, new_balance FROM debit_account(%s, %s)", (USERNAME, BILL))
+
+def run(name, debitFunc):
+  remaining = [NUM_REQUESTS]
+  startTrips = db.get_round_trips()
+  startTime = time.time()
+  def worker():
+    if remaining[0] <= 0:
+      return defer.succeed(None)
+    remaining[0] -= 1
+    d = debitFunc()
+    d.addCallback(lambda result: worker())
+    return d
+  d = defer.DeferredList([worker() for i in range(CONCURRENCY)], fireOnOneErrback=True)
+  def report(result):
+    elapsed = time.time() - startTime
+    trips = db.get_round_trips() - startTrips
+    print "%s:  %.2f round trips/request, %.1f requests/sec" % (name, float(trips) / NUM_REQUESTS, NUM_REQUESTS / elapsed)
+  d.addCallback(report)
+  return d
+  
+@defer.inlineCallbacks
+def main():
+  try:
+    yield db.write("DELETE FROM Accounts WHERE Username = %s", (USERNAME,))
+    yield db.write("INSERT INTO Accounts (Username, Balance) VALUES (%s, %s)", (USERNAME, 10 * NUM_REQUESTS))
+    yield run("SELECT + UPDATE", old_debit)
+    yield run("debit_account()", new_debit)
+    yield db.write("DELETE FROM Accounts WHERE Username = %s", (USERNAME,))
+  except Exception, e:
+    print >> sys.stderr, e
+  reactor.stop()
+  
+if __name__ == "__main__":
+  reactor.callWhenRunning(main)
+  reactor.run()
@@ -0,0 +1,515 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Load generator and latency benchmark for the bank.  Simulates relays that send a
+mix of ACoin requests, deposits and UDP payments to BankServer (and logins to
+LoginSSLserver, if one is given with --login-port), with --concurrency relays
+active at once.  Prints requests/sec and p50/p99 latency for each message type.
+
+With --local-postgres, a throwaway postgres cluster is made with initdb, loaded
+with db_backups/schema.out and account_functions.sql, and a BankServer is started
+against it with fresh keys.  Otherwise, the bank at --host/--port is used, with the
+database from DbAccessConfig, and the keys from --acoin-key-file/--bank-key-file.
+Either way, accounts and relays named loadtest_* are created first and deleted after.
+
+Example:  python load_test.py --local-postgres --pg-bin /usr/lib/postgresql/8.3/bin -c 50 -d 60"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import struct
+import random
+import binascii
+import tempfile
+import optparse
+import subprocess
+
+import psycopg2 as cyborg
+from twisted.internet import reactor, defer, protocol, ssl
+from twisted.protocols.basic import Int32StringReceiver, Int16StringReceiver
+
+from common import Globals
+from common.utils import Basic
+from common.utils import TorUtils
+from common.classes import ACoin
+from common.classes import PrivateKey
+from common.classes import SymmetricKey
+from common.classes import EncryptedDatagram
+from serverCommon import DbAccessConfig
+from serverCommon.DBUtil import format_auth
+
+parser = optparse.OptionParser()
+parser.add_option('--host', dest='host', default='127.0.0.1', metavar='HOST', help='address of the bank')
+parser.add_option('-p', '--port', dest='port', type='int', default=33348, metavar='33348', help='port of the bank (TCP and UDP)')
+parser.add_option('--login-host', dest='loginHost', default='127.0.0.1', metavar='HOST', help='address of the login server')
+parser.add_option('--login-port', dest='loginPort', type='int', default=None, metavar='PORT',
+                  help='port of a running LoginSSLserver.  Logins are only sent if this is set')
+parser.add_option('-c', '--concurrency', dest='concurrency', type='int', default=20, metavar='20', help='number of simulated relays sending messages at once')
+parser.add_option('-d', '--duration', dest='duration', type='float', default=30.0, metavar='30', help='seconds to generate load for')
+parser.add_option('--mix', dest='mix', default='request=3,deposit=2,payment=5,login=1', metavar='MIX',
+                  help='relative weight of each message type')
+parser.add_option('--coins-per-request', dest='coinsPerRequest', type='int', default=20, metavar='20', help='ACoins in each request')
+parser.add_option('--coins-per-deposit', dest='coinsPerDeposit', type='int', default=10, metavar='10', help='ACoins in each deposit')
+parser.add_option('--coins-per-payment', dest='coinsPerPayment', type='int', default=1, metavar='1', help='ACoins in each UDP payment (at most 4 fit)')
+parser.add_option('--timeout', dest='timeout', type='float', default=30.0, metavar='30', help='seconds before a message counts as failed')
+parser.add_option('--local-postgres', dest='localPostgres', action='store_true', default=False,
+                  help='run against a throwaway postgres cluster and bank server')
+parser.add_option('--pg-bin', dest='pgBin', default='', metavar='DIR', help='folder with initdb and pg_ctl (if not on the PATH)')
+parser.add_option('--pg-port', dest='pgPort', type='int', default=55432, metavar='55432', help='port for the throwaway postgres cluster')
+parser.add_option('--bank-args', dest='bankArgs', default='', metavar='ARGS', help='extra arguments for the local BankServer')
+parser.add_option('--acoin-key-file', dest='akf', default='private_keys/acoin.key', metavar='FILE', help='ACoin private key of the bank')
+parser.add_option('--bank-key-file', dest='bkf', default='private_keys/bank.key', metavar='FILE', help='private key of the bank')
+
+#: the message types, in the order they are reported
+MESSAGE_TYPES = ("login", "request", "deposit", "payment")
+#: prefix for the accounts and relays that get created
+NAME_PREFIX = "loadtest_"
+#: starting balance of each account.  Large enough that requests never run out
+STARTING_BALANCE = 1000000000
+#: bank key sizes, as used by BankServer
+ACOIN_KEY_BITS = Globals.ACOIN_KEY_BYTES * 8
+BANK_KEY_BITS = EncryptedDatagram.BANK_KEY_LENGTH * 8
+
+class LatencyStats():
+  """Latency of every completed message, per message type"""
+  def __init__(self):
+    #: mapping from message type to list of latencies (in seconds)
+    self.latencies = {}
+    #: mapping from message type to number of failures
+    self.failures = {}
+    #: mapping from message type to the last error (to help figure out what is wrong)
+    self.lastErrors = {}
+    self.startTime = None
+    self.endTime = None
+
+  def start(self):
+    self.startTime = time.time()
+
+  def stop(self):
+    self.endTime = time.time()
+
+  def record(self, msgType, latency):
+    self.latencies.setdefault(msgType, []).append(latency)
+
+  def record_failure(self, msgType, error):
+    self.failures[msgType] = self.failures.get(msgType, 0) + 1
+    self.lastErrors[msgType] = error
+
+  def get_percentile(self, values, fraction):
+    """@param values:  sorted list"""
+    if not values:
+      return 0.0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+  def report(self):
+    elapsed = self.endTime - self.startTime
+    lines = ["%-10s %8s %8s %10s %10s %10s" % ("message", "ok", "failed", "req/s", "p50 ms", "p99 ms")]
+    for msgType in MESSAGE_TYPES:
+      values = sorted(self.latencies.get(msgType, []))
+      failures = self.failures.get(msgType, 0)
+      if not values and not failures:
+        continue
+      lines.append("%-10s %8d %8d %10.1f %10.1f %10.1f" % (msgType, len(values), failures, len(values) / elapsed,
+                   1000.0 * self.get_percentile(values, 0.50), 1000.0 * self.get_percentile(values, 0.99)))
+    for msgType, error in self.lastErrors.iteritems():
+      lines.append("last %s failure:  %s" % (msgType, error))
+    return "\n".join(lines)
+
+class LocalPostgres():
+  """A throwaway postgres cluster, with the bank schema loaded.  Listens only on a unix
+  socket, and sets PGHOST/PGPORT so that everything in this process (and any children)
+  connects to it instead of the real database."""
+  def __init__(self, baseDir, port, binDir=""):
+    self.baseDir = baseDir
+    self.port = port
+    self.binDir = binDir
+    self.dataDir = os.path.join(baseDir, "pgdata")
+
+  def _run(self, program, args, inputData=None):
+    command = [os.path.join(self.binDir, program)] + args
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate(inputData)[0]
+    if process.returncode != 0:
+      raise Exception("%s failed:\n%s" % (" ".join(command), output))
+    return output
+
+  def _psql(self, database, sql=None, fileName=None):
+    args = ["-q", "-U", "postgres", "-d", database]
+    if fileName:
+      args += ["-f", fileName]
+    return self._run("psql", args, sql)
+
+  def start(self):
+    self._run("initdb", ["-D", self.dataDir, "-A", "trust", "-U", "postgres"])
+    self._run("pg_ctl", ["-D", self.dataDir, "-w", "-l", os.path.join(self.baseDir, "postgres.log"),
+                         "-o", "-k %s -p %s -c listen_addresses=''" % (self.baseDir, self.port), "start"])
+    os.environ["PGHOST"] = self.baseDir
+    os.environ["PGPORT"] = str(self.port)
+    #the cluster is thrown away afterward, so the bank user may as well be a superuser
+    #(account_functions.sql needs to be able to create plpgsql)
+    self._psql("postgres", "CREATE ROLE innominet; CREATE ROLE %s LOGIN SUPERUSER PASSWORD '%s'; CREATE DATABASE %s OWNER %s;" %
+               (DbAccessConfig.user, DbAccessConfig.password, DbAccessConfig.database, DbAccessConfig.user))
+    bankDir = os.path.dirname(os.path.abspath(__file__))
+    self._psql(DbAccessConfig.database, fileName=os.path.join(bankDir, "db_backups", "schema.out"))
+    #added to the relays table since the schema was dumped:
+    self._psql(DbAccessConfig.database, "ALTER TABLE relays ADD COLUMN auth_blob bytea;")
+    self._psql(DbAccessConfig.database, fileName=os.path.join(bankDir, "account_functions.sql"))
+    #one interval that is valid now, and the next one
+    now = int(time.time())
+    sql = "INSERT INTO acoin_interval (interval_id, valid_after, fresh_until, spoils_on) VALUES (1, '%s', '%s', '%s');" % \
+          (gm_ctime(now - 3600), gm_ctime(now + 3600), gm_ctime(now + 3600))
+    sql += "INSERT INTO acoin_interval (interval_id, valid_after, fresh_until, spoils_on) VALUES (2, '%s', '%s', '%s');" % \
+           (gm_ctime(now + 3600), gm_ctime(now + 2*3600), gm_ctime(now + 2*3600))
+    self._psql(DbAccessConfig.database, sql)
+
+  def stop(self):
+    try:
+      self._run("pg_ctl", ["-D", self.dataDir, "-w", "-m", "fast", "stop"])
+    except Exception, e:
+      print >> sys.stderr, e
+
+def gm_ctime(t):
+  return time.asctime(time.gmtime(t))
+
+class SimulatedRelay():
+  """A relay with an account at the bank, that sends messages like the client would"""
+  def __init__(self, index, acoinKey, bankKey, interval):
+    self.username = "%s%s" % (NAME_PREFIX, index)
+    self.password = "password%s" % (index)
+    #: used to sign the fingerprint when logging in
+    self.relayKey = PrivateKey.PrivateKey(1024)
+    self.hexId = TorUtils.fingerprint(self.relayKey.n)
+    #: shared with the bank.  Set by seed_database (or by logging in)
+    self.symKey = SymmetricKey.SymmetricKey()
+    #: nonce, increased for every message
+    self.msgNum = 0
+    #: public ACoin key of the bank
+    self.acoinKey = acoinKey
+    #: public key of the bank, for UDP payments
+    self.bankKey = bankKey
+    #: the ACoin interval to request coins for
+    self.interval = interval
+    #: ACoins (in binary form) that can be spent or deposited
+    self.coins = []
+
+  def seed(self, cur):
+    """Create the account and relay rows for this relay"""
+    cur.execute("INSERT INTO Accounts (Username, Balance, Password) VALUES (%s, %s, %s)",
+                (self.username, STARTING_BALANCE, cyborg.Binary(format_auth(self.username, self.password))))
+    cur.execute("INSERT INTO Relays (Tor_Id, Owner, Public_Key, auth_blob, Msgnum) VALUES (%s, %s, %s, %s, %s)",
+                (self.hexId, self.username, str(self.relayKey.n), cyborg.Binary(self.symKey.pack()), 0))
+
+  def _encrypt(self, requestType, body):
+    self.msgNum += 1
+    msg = Basic.write_byte(1) + Basic.write_short(self.msgNum) + Basic.write_byte(requestType) + body
+    self.symKey.reset()
+    return struct.pack('!B20s', 0, binascii.unhexlify(self.hexId)) + self.symKey.encrypt(msg)
+
+  def _decrypt(self, data):
+    self.symKey.reset()
+    return self.symKey.decrypt(data)
+
+  def request(self):
+    """Ask the bank to sign some ACoins"""
+    number = options.coinsPerRequest
+    factors = self.acoinKey.get_blinding_factors(Globals.ACOIN_BYTES * 8, number)
+    receipts = [os.urandom(Globals.ACOIN_BYTES) for i in range(number)]
+    msgs = [ACoin.ACoin.pack_acoin_for_signing(receipt, self.interval) for receipt in receipts]
+    blobs = self.acoinKey.blind_batch(msgs, factors, Globals.ACOIN_KEY_BYTES)
+    body = Basic.write_short(number) + Basic.write_int(ACoin.VALUE) + "".join(blobs)
+    d = send_tcp(self._encrypt(1, body))
+    def got_reply(data):
+      data = self._decrypt(data)
+      returnCode, data = Basic.read_byte(data)
+      if returnCode != 0:
+        raise Exception("Request failed with code %s" % (returnCode))
+      (balance, numSigned), data = Basic.read_message('!II', data)
+      sigs = [data[i*Globals.ACOIN_KEY_BYTES:(i+1)*Globals.ACOIN_KEY_BYTES] for i in range(numSigned)]
+      sigs = self.acoinKey.unblind_batch(sigs, factors, Globals.ACOIN_KEY_BYTES)
+      for receipt, sig in zip(receipts, sigs):
+        self.coins.append(struct.pack(ACoin.MESSAGE_FORMAT, receipt, self.interval, sig))
+    d.addCallback(got_reply)
+    return d
+
+  def _take_coins(self, number):
+    coins, self.coins = self.coins[:number], self.coins[number:]
+    return coins
+
+  def deposit(self):
+    """Deposit some ACoins into our account"""
+    coins = self._take_coins(options.coinsPerDeposit)
+    body = Basic.write_short(len(coins)) + "".join(coins)
+    d = send_tcp(self._encrypt(2, body))
+    def got_reply(data):
+      data = self._decrypt(data)
+      (balance, interval, curExp, nextExp), data = Basic.read_message('!IIII', data)
+      if data != '0' * len(coins):
+        raise Exception("Deposit results were %s" % (repr(data)))
+    d.addCallback(got_reply)
+    return d
+
+  def payment(self):
+    """Pay with some ACoins, over UDP, as a relay would for a circuit"""
+    coins = self._take_coins(options.coinsPerPayment)
+    msg = Basic.write_byte(len(coins))
+    for coin in coins:
+      token = os.urandom(Globals.ACOIN_KEY_BYTES - 1)
+      msg += coin + "\0" + token
+    key = EncryptedDatagram.ClientSymKey(self.bankKey)
+    datagram = Basic.write_byte(1) + key.encrypt(Basic.write_byte(3) + msg)
+    d = send_udp(datagram)
+    def got_reply(data):
+      for i in range(len(coins)):
+        result, data = data[0], data[1:]
+        if result != '0':
+          raise Exception("Payment result was %s" % (repr(result)))
+        data = data[Globals.ACOIN_KEY_BYTES:]
+    d.addCallback(got_reply)
+    return d
+
+  def login(self):
+    """Log in, which makes the bank issue a new session key"""
+    signedFingerprint = self.relayKey.sign(self.hexId)
+    publicKey = Basic.long_to_bytes(long(self.relayKey.n), 128)
+    msg = struct.pack('!B128s50s50s128s', 1, signedFingerprint, self.username, self.password, publicKey)
+    d = send_ssl(msg)
+    def got_reply(data):
+      protocolVersion, data = Basic.read_byte(data)
+      returnCode, data = Basic.read_byte(data)
+      if returnCode != 1:
+        raise Exception("Login failed")
+      values, data = Basic.read_message('!IIII4sI', data)
+      size = struct.calcsize(SymmetricKey.MESSAGE_FORMAT)
+      self.symKey = SymmetricKey.SymmetricKey(data[:size])
+      self.msgNum = 0
+    d.addCallback(got_reply)
+    return d
+
+class OneMessageProtocol():
+  """Sends the factory's message as soon as it connects, and hands the reply to the factory"""
+  def connectionMade(self):
+    self.sendString(self.factory.msg)
+
+  def stringReceived(self, data):
+    self.factory.got_reply(data)
+    self.transport.loseConnection()
+
+class TCPProtocol(OneMessageProtocol, Int32StringReceiver):
+  MAX_LENGTH = 128 * 1024 * 1024
+
+class LoginProtocol(OneMessageProtocol, Int16StringReceiver):
+  pass
+
+class OneMessageFactory(protocol.ClientFactory):
+  """Makes a single connection, and fires self.deferred with the reply"""
+  def __init__(self, msg, protocolClass):
+    self.msg = msg
+    self.protocol = protocolClass
+    self.deferred = defer.Deferred()
+    self.timeoutEvent = reactor.callLater(options.timeout, self.failed, Exception("Timed out"))
+
+  def got_reply(self, data):
+    if not self.deferred.called:
+      self.timeoutEvent.cancel()
+      self.deferred.callback(data)
+
+  def failed(self, reason):
+    if not self.deferred.called:
+      if self.timeoutEvent.active():
+        self.timeoutEvent.cancel()
+      self.deferred.errback(reason)
+
+  def clientConnectionFailed(self, connector, reason):
+    self.failed(reason)
+
+  def clientConnectionLost(self, connector, reason):
+    self.failed(reason)
+
+def send_tcp(msg):
+  factory = OneMessageFactory(msg, TCPProtocol)
+  reactor.connectTCP(options.host, options.port, factory)
+  return factory.deferred
+
+def send_ssl(msg):
+  factory = OneMessageFactory(msg, LoginProtocol)
+  reactor.connectSSL(options.loginHost, options.loginPort, factory, ssl.ClientContextFactory())
+  return factory.deferred
+
+class UDPProtocol(protocol.DatagramProtocol):
+  """Sends a single datagram from its own port, and fires self.deferred with the reply"""
+  def __init__(self, msg):
+    self.msg = msg
+    self.deferred = defer.Deferred()
+    self.port = None
+    self.timeoutEvent = reactor.callLater(options.timeout, self.finish, None, Exception("Timed out"))
+
+  def startProtocol(self):
+    self.transport.write(self.msg, (options.host, options.port))
+
+  def datagramReceived(self, data, address):
+    self.finish(data)
+
+  def finish(self, data, error=None):
+    if self.deferred.called:
+      return
+    if self.timeoutEvent.active():
+      self.timeoutEvent.cancel()
+    self.port.stopListening()
+    if error:
+      self.deferred.errback(error)
+    else:
+      self.deferred.callback(data)
+
+def send_udp(msg):
+  udpProtocol = UDPProtocol(msg)
+  udpProtocol.port = reactor.listenUDP(0, udpProtocol)
+  return udpProtocol.deferred
+
+def parse_mix(mix):
+  """@returns:  list of (message type, weight)"""
+  weights = []
+  for item in mix.split(","):
+    msgType, weight = item.split("=")
+    assert msgType in MESSAGE_TYPES, "Unknown message type %s" % (msgType)
+    #logins need a login server
+    if msgType == "login" and not options.loginPort:
+      continue
+    weights.append((msgType, float(weight)))
+  return weights
+
+def choose_message(weights, relay):
+  total = sum([weight for msgType, weight in weights])
+  choice = random.random() * total
+  msgType = weights[-1][0]
+  for msgType, weight in weights:
+    choice -= weight
+    if choice < 0:
+      break
+  #need coins before they can be spent
+  if msgType == "deposit" and len(relay.coins) < options.coinsPerDeposit:
+    return "request"
+  if msgType == "payment" and len(relay.coins) < options.coinsPerPayment:
+    return "request"
+  return msgType
+
+@defer.inlineCallbacks
+def drive(relay, weights, stats, endTime):
+  """Send messages from relay, one at a time, until endTime"""
+  while time.time() < endTime:
+    msgType = choose_message(weights, relay)
+    startTime = time.time()
+    try:
+      yield getattr(relay, msgType)()
+    except Exception, e:
+      stats.record_failure(msgType, e)
+    else:
+      stats.record(msgType, time.time() - startTime)
+
+def get_current_interval(cur):
+  now = gm_ctime(time.time())
+  cur.execute("SELECT interval_id FROM acoin_interval WHERE valid_after < %s and spoils_on > %s ORDER BY interval_id", (now, now))
+  return cur.fetchone()[0]
+
+def connect():
+  return cyborg.connect(user=DbAccessConfig.user, password=DbAccessConfig.password, database=DbAccessConfig.database)
+
+def seed_database(relays):
+  conn = connect()
+  try:
+    cur = conn.cursor()
+    clean_database(cur)
+    for relay in relays:
+      relay.seed(cur)
+    conn.commit()
+  finally:
+    conn.close()
+
+def clean_database(cur=None):
+  """Delete everything that seed_database made"""
+  if cur:
+    cur.execute("DELETE FROM Relays WHERE Owner LIKE %s", (NAME_PREFIX + "%",))
+    cur.execute("DELETE FROM Accounts WHERE Username LIKE %s", (NAME_PREFIX + "%",))
+    return
+  conn = connect()
+  try:
+    clean_database(conn.cursor())
+    conn.commit()
+  finally:
+    conn.close()
+
+def start_bank_server(workDir):
+  """Launch a BankServer in workDir, with new keys"""
+  keyDir = os.path.join(workDir, "private_keys")
+  os.makedirs(keyDir)
+  PrivateKey.PrivateKey(ACOIN_KEY_BITS).key.save_key(os.path.join(keyDir, "acoin.key"), None)
+  PrivateKey.PrivateKey(BANK_KEY_BITS).key.save_key(os.path.join(keyDir, "bank.key"), None)
+  bankServer = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BankServer.py")
+  args = [sys.executable, bankServer, "-n", "-p", str(options.port), "--spent-coin-dir", os.path.join(workDir, "spent_acoins")]
+  args += options.bankArgs.split()
+  process = subprocess.Popen(args, cwd=workDir)
+  options.akf = os.path.join(keyDir, "acoin.key")
+  options.bkf = os.path.join(keyDir, "bank.key")
+  return process
+
+def wait_for_port(host, port, timeout=60.0):
+  """Block until something is listening on host:port"""
+  startTime = time.time()
+  while time.time() < startTime + timeout:
+    s = socket.socket()
+    try:
+      s.connect((host, port))
+      return
+    except socket.error:
+      time.sleep(0.2)
+    finally:
+      s.close()
+  raise Exception("Nothing listening on %s:%s after %s seconds" % (host, port, timeout))
+
+def main():
+  workDir = tempfile.mkdtemp(prefix="bank_load_test")
+  database = None
+  bankProcess = None
+  stats = LatencyStats()
+  try:
+    if options.localPostgres:
+      database = LocalPostgres(workDir, options.pgPort, options.pgBin)
+      database.start()
+      bankProcess = start_bank_server(workDir)
+      wait_for_port(options.host, options.port)
+    acoinKey = PrivateKey.PrivateKey(options.akf).publickey()
+    bankKey = PrivateKey.PrivateKey(options.bkf).publickey()
+    conn = connect()
+    try:
+      interval = get_current_interval(conn.cursor())
+    finally:
+      conn.close()
+    print "Creating %s relays..." % (options.concurrency)
+    relays = [SimulatedRelay(i, acoinKey, bankKey, interval) for i in range(options.concurrency)]
+    seed_database(relays)
+    weights = parse_mix(options.mix)
+    def run():
+      stats.start()
+      endTime = time.time() + options.duration
+      d = defer.DeferredList([drive(relay, weights, stats, endTime) for relay in relays])
+      def done(result):
+        stats.stop()
+        reactor.stop()
+      d.addCallback(done)
+    print "Sending messages for %s seconds..." % (options.duration)
+    reactor.callWhenRunning(run)
+    reactor.run()
+    print stats.report()
+    clean_database()
+  finally:
+    if bankProcess:
+      os.kill(bankProcess.pid, signal.SIGTERM)
+      bankProcess.wait()
+    if database:
+      database.stop()
+    shutil.rmtree(workDir, True)
+
+if __name__ == "__main__":
+  (options, args) = parser.parse_args()
+  main()
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""For saving and loading many events at once.  Events are grouped by type into
+columnar chunks, which can be appended to compressed segment files, or bulk loaded
+into postgres with COPY instead of inserting each event as a separate row.
+#NOTE:  only works with postgres"""
+
+import os
+import time
+import glob
+import zlib
+import threading
+from cStringIO import StringIO
+
+import Events
+import DBUtil
+import EventLogging
+
+#: file extension for segment files
+SEGMENT_EXTENSION = ".seg"
+
+class EventChunk():
+  """A list of events of a single type, stored as one list of values per attribute"""
+  def __init__(self, eventType):
+    self.eventType = eventType
+    #: names of the attributes that get saved, in a fixed order
+    self.columns = _get_columns(eventType())
+    #: mapping from column name to list of values
+    self.values = {}
+    for column in self.columns:
+      self.values[column] = []
+
+  def __len__(self):
+    return len(self.values[self.columns[0]])
+
+  def add(self, event):
+    assert event.__class__ == self.eventType
+    for column in self.columns:
+      self.values[column].append(getattr(event, column))
+
+  def extend(self, chunk):
+    """Append every event from another chunk of the same type"""
+    assert chunk.eventType == self.eventType
+    for column in self.columns:
+      self.values[column] += chunk.values[column]
+
+  def get_events(self):
+    """@returns:  a list of the events in this chunk"""
+    events = []
+    for i in range(len(self)):
+      event = self.eventType()
+      for column in self.columns:
+        setattr(event, column, self.values[column][i])
+      events.append(event)
+    return events
+
+  def save(self):
+    """Save to a string.  The first line is the event name and number of events,
+    then there is one tab separated line per column"""
+    data = "%s %s\n" % (self.eventType.__name__, len(self))
+    for column in self.columns:
+      strValues = [str(value) for value in self.values[column]]
+      for strValue in strValues:
+        assert '\t' not in strValue, "tabs are not allowed in event strings!"
+        assert '\n' not in strValue, "newlines are not allowed in event strings!"
+      data += column + "\t" + "\t".join(strValues) + "\n"
+    return data
+
+def load_chunk(data):
+  """Load an EventChunk from the string made by EventChunk.save()
+  @returns:  (EventChunk, the rest of data)"""
+  header, data = data.split("\n", 1)
+  eventName, numRows = header.split(" ")
+  numRows = int(numRows)
+  chunk = EventChunk(getattr(Events, eventName))
+  event = chunk.eventType()
+  for i in range(len(chunk.columns)):
+    line, data = data.split("\n", 1)
+    column, line = line.split("\t", 1)
+    assert column in chunk.values, "%s is not a column of %s" % (column, eventName)
+    if numRows > 0:
+      strValues = line.split("\t")
+    else:
+      strValues = []
+    assert len(strValues) == numRows, "Wrong number of values for %s.%s" % (eventName, column)
+    dataType = type(getattr(event, column))
+    if dataType == bool:
+      chunk.values[column] = [value == "True" for value in strValues]
+    else:
+      chunk.values[column] = [dataType(value) for value in strValues]
+  return chunk, data
+
+def make_chunks(events):
+  """Group events by type
+  @returns:  a list of EventChunks"""
+  chunks = {}
+  for event in events:
+    eventType = event.__class__
+    chunk = chunks.get(eventType)
+    if not chunk:
+      chunk = EventChunk(eventType)
+      chunks[eventType] = chunk
+    chunk.add(event)
+  return chunks.values()
+
+def save_segment(chunks):
+  """@returns:  a single compressed record, containing every chunk, to append to a segment file"""
+  data = zlib.compress("".join([chunk.save() for chunk in chunks]))
+  return "%s\n%s" % (len(data), data)
+
+def load_segments(fileName, numRecords=0):
+  """Read the records from a segment file, skipping the first numRecords.
+  A partial record at the end (because the file is still being written or copied) is ignored.
+  @returns:  (list of EventChunks, one per event type, total number of complete records in the file)"""
+  chunks = {}
+  recordNum = 0
+  f = open(fileName, "rb")
+  try:
+    while True:
+      header = f.readline()
+      if not header.endswith("\n"):
+        break
+      size = int(header)
+      data = f.read(size)
+      if len(data) < size:
+        break
+      recordNum += 1
+      #already loaded this record before
+      if recordNum <= numRecords:
+        continue
+      data = zlib.decompress(data)
+      while data:
+        chunk, data = load_chunk(data)
+        if chunk.eventType in chunks:
+          chunks[chunk.eventType].extend(chunk)
+        else:
+          chunks[chunk.eventType] = chunk
+  finally:
+    f.close()
+  return chunks.values(), recordNum
+
+def _get_columns(event):
+  columns = []
+  for key, value in event.__dict__.iteritems():
+    if Events._isCallable(value):
+      continue
+    if key == "eventName":
+      continue
+    columns.append(key)
+  columns.sort()
+  return columns
+
+def _escape_copy_value(value):
+  """Format a value for the postgres COPY text format"""
+  if value is None:
+    return "\\N"
+  value = str(value).replace("\\", "\\\\")
+  return value.replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _copy_rows(cur, tableName, columns, rows):
+  data = StringIO("".join(["\t".join([_escape_copy_value(value) for value in row]) + "\n" for row in rows]))
+  cur.copy_from(data, tableName, columns=[column.lower() for column in columns])
+
+def insert_chunk(cur, chunk):
+  """Add all events in chunk to the database with one COPY.  Aggregate events are
+  summed per hour and source first, then merged into the existing rows."""
+  if len(chunk) <= 0:
+    return
+  tableName = chunk.eventType()._get_table_name()
+  if issubclass(chunk.eventType, Events.AggregateEvent):
+    _insert_aggregate_chunk(cur, tableName, chunk)
+  else:
+    columns = chunk.columns
+    times = [DBUtil.int_to_ctime(t) for t in chunk.values["eventTime"]]
+    columnValues = [chunk.values[column] for column in columns if column != "eventTime"] + [times]
+    columns = [column for column in columns if column != "eventTime"] + ["eventTime"]
+    _copy_rows(cur, tableName, columns, zip(*columnValues))
+
+def _insert_aggregate_chunk(cur, tableName, chunk):
+  #figure out what hour each event happened in, and add up the amounts:
+  totals = {}
+  for eventTime, source, amount in zip(chunk.values["eventTime"], chunk.values["source"], chunk.values["amount"]):
+    exactTime = eventTime - (eventTime % Events._AGGREGATE_INTERVAL)
+    key = (exactTime, source)
+    totals[key] = totals.get(key, 0) + amount
+  rows = [(source, amount, DBUtil.int_to_ctime(exactTime)) for (exactTime, source), amount in totals.iteritems()]
+  #load them into a temporary table:
+  tempName = "%s_batch" % (tableName)
+  cur.execute("DROP TABLE IF EXISTS %s" % (tempName))
+  cur.execute("CREATE TEMP TABLE %s (source text, amount bigint, eventtime timestamp without time zone)" % (tempName))
+  _copy_rows(cur, tempName, ("source", "amount", "eventTime"), rows)
+  #then update the existing rows, and insert any that are new:
+  sql = "UPDATE %s SET amount = %s.amount + b.amount FROM %s b" % (tableName, tableName, tempName)
+  sql += " WHERE %s.eventTime = b.eventtime AND %s.source = b.source" % (tableName, tableName)
+  cur.execute(sql)
+  sql = "INSERT INTO %s (source, amount, eventTime) SELECT b.source, b.amount, b.eventtime FROM %s b" % (tableName, tempName)
+  sql += " WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE t.eventTime = b.eventtime AND t.source = b.source)" % (tableName)
+  cur.execute(sql)
+  cur.execute("DROP TABLE %s" % (tempName))
+
+def insert_events(cur, events):
+  """Add a list of events to the database, with one bulk load per event type"""
+  for chunk in make_chunks(events):
+    insert_chunk(cur, chunk)
+
+class EventSink():
+  """Base class for the places that BankEventLogger can send its batches of events to
+  (see BankEventLogger.set_sink).  Subclasses implement save, and close if they hold
+  on to anything (files, connections) between batches.
+  save is called from a thread in the reactor's pool, and from the main thread on
+  shutdown, so it must be safe to call from any thread.  It should raise if the
+  events could not be saved, so the failure gets logged."""
+  def save(self, events):
+    """Must override this function to store every event in the batch
+    @param events:  the events to save, of any types
+    @type  events:  list"""
+    raise NotImplementedError()
+
+  def close(self):
+    """Called once on shutdown, after the last batch was saved"""
+    pass
+
+class LogFileSink(EventSink):
+  """Appends the events as lines of text to the normal event log (see EventLogging)"""
+  def __init__(self, fileName):
+    EventLogging.open_logs(fileName)
+
+  def save(self, events):
+    EventLogging.save_events(events)
+
+class SegmentFileSink(EventSink):
+  """Appends each batch as a single compressed record to an hourly segment file.
+  File names include the pid, so that several processes can share a folder."""
+  def __init__(self, baseFileName):
+    self.baseFileName = baseFileName
+    pathName = os.path.split(baseFileName)[0]
+    if pathName and not os.path.exists(pathName):
+      os.makedirs(pathName)
+    self._lock = threading.Lock()
+    #: the file that we last wrote to, so old ones can be deleted when it changes
+    self._lastFileName = None
+
+  def _get_file_name(self):
+    return "%s.%s.%s%s" % (self.baseFileName, os.getpid(), time.strftime("%Y-%m-%d_%H"), SEGMENT_EXTENSION)
+
+  def save(self, events):
+    if not events:
+      return
+    record = save_segment(make_chunks(events))
+    self._lock.acquire()
+    try:
+      fileName = self._get_file_name()
+      if fileName != self._lastFileName:
+        self._lastFileName = fileName
+        self._delete_old_segments()
+      f = open(fileName, "ab")
+      try:
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+    finally:
+      self._lock.release()
+
+  def _delete_old_segments(self):
+    cutoffTime = time.time() - (EventLogging.NUM_BACKUP_DAYS * 60.0 * 60.0 * 24.0)
+    for fileName in glob.glob(self.baseFileName + ".*" + SEGMENT_EXTENSION):
+      try:
+        if os.path.getmtime(fileName) < cutoffTime:
+          os.remove(fileName)
+      #NOTE:  this is because multiple processes might do this at the same time...
+      except OSError:
+        pass
+
+class CopySink(EventSink):
+  """Bulk loads each batch straight into the event tables with COPY"""
+  def __init__(self, connect):
+    """@param connect:  function that returns a new DBAPI connection"""
+    self._connect = connect
+    self._conn = None
+    self._lock = threading.Lock()
+
+  def save(self, events):
+    if not events:
+      return
+    self._lock.acquire()
+    try:
+      if not self._conn:
+        self._conn = self._connect()
+      try:
+        cur = self._conn.cursor()
+        try:
+          insert_events(cur, events)
+        finally:
+          cur.close()
+        self._conn.commit()
+      except:
+        #reconnect next time, in case the connection was the problem
+        try:
+          self._conn.close()
+        except:
+          pass
+        self._conn = None
+        raise
+    finally:
+      self._lock.release()
+
+  def close(self):
+    if self._conn:
+      self._conn.close()
+      self._conn = None
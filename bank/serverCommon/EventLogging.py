@@ -17,6 +17,7 @@ except ImportError:
   codecs = None
 
 import Events
+import EventBatch
 from DBUtil import get_current_gmtime
 
 #: whether the module is ready for calls to log_event
@@ -69,6 +70,21 @@ def save_event(event):
     EVENT_LOGGER.info(event)
   finally:
     LOG_SEM.release()
+
+def save_events(events):
+  """Save a list of events to the log file, as a single write"""
+  assert _IS_READY
+  if not events:
+    return
+  lines = []
+  for event in events:
+    assert isinstance(event, Events.ServerEvent)
+    lines.append(event.save())
+  LOG_SEM.acquire()
+  try:
+    EVENT_LOGGER.info("\n".join(lines))
+  finally:
+    LOG_SEM.release()
   
 def load_event(data):
   """Load an event from some data that came from a log file"""
@@ -78,7 +94,13 @@ def load_event(data):
   return event
   
 def parse_events(cur, fileName, numLines=0):
+  """Insert all events after the first numLines lines of fileName into the database.
+  Segment files (see EventBatch) are counted in records instead of lines.
+  @returns:  (time of the earliest new event, number of lines parsed in total)"""
+  if fileName.endswith(EventBatch.SEGMENT_EXTENSION):
+    return parse_segments(cur, fileName, numLines)
   earliestTime = None
+  events = []
   lineNum = 0
   #for each line in the file
   f = open(fileName, "rb")
@@ -99,12 +121,28 @@ def parse_events(cur, fileName, numLines=0):
     #is this the earliest event that we've learned of?
     if earliestTime is None:
       earliestTime = event.get_time()
-    #and stick it in the database
-    event.insert(cur)
+    events.append(event)
   f.close()
+  #and stick them all in the database at once
+  EventBatch.insert_events(cur, events)
   if earliestTime is None:
     earliestTime = get_current_gmtime()
   return earliestTime, lineNum-1
+
+def parse_segments(cur, fileName, numRecords=0):
+  """Like parse_events, for a segment file
+  @returns:  (time of the earliest new event, number of records parsed in total)"""
+  chunks, numRecords = EventBatch.load_segments(fileName, numRecords)
+  earliestTime = None
+  for chunk in chunks:
+    if len(chunk) > 0:
+      chunkTime = min(chunk.values["eventTime"])
+      if earliestTime is None or chunkTime < earliestTime:
+        earliestTime = chunkTime
+    EventBatch.insert_chunk(cur, chunk)
+  if earliestTime is None:
+    earliestTime = get_current_gmtime()
+  return earliestTime, numRecords
   
 class TimeStampFileHandler(logging.handlers.TimedRotatingFileHandler):
   """
@@ -21,12 +21,16 @@ class DB_Pool():
                                             password = pw, 
                                             database = db,
                                             )
+    #: how many round trips to the database have been made (for benchmarking)
+    self.numReads = 0
+    self.numWrites = 0
 
   def read_db(self, sql, tup=None):
     """simple wrapper for read only database calls
     sql: string of sql command to execute 
     tup: string or tuple containing string arguments to use with python dbapi for escaping
     """
+    self.numReads += 1
     if tup:
       d = self.conn_pool.runQuery(sql, tup)
     else:
@@ -38,6 +42,7 @@ class DB_Pool():
     sql: string sql commands to execute in one commit
     tup: string, tuple ( list of strings), or None: contains string arguments to use
     """
+    self.numWrites += 1
     #nothing to escape
     if not tup:
       d = self.conn_pool.runOperation(sql)
@@ -56,6 +61,10 @@ Pool = DB_Pool(DbAccessConfig.user,
 write = Pool.write_db
 read = Pool.read_db
 
+def get_round_trips():
+  """@returns:  total number of queries sent to the database so far"""
+  return Pool.numReads + Pool.numWrites
+
 if __name__ == "__main__":
   from twisted.internet import reactor
   
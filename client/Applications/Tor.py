@@ -5,7 +5,6 @@
 import os
 import re
 import time
-import random
 import struct
 import copy
 import types
@@ -39,6 +38,7 @@ from core.tor import TorMessages
 from core.tor import TorCtl
 from core.tor import EventHandler
 from core.tor import Relay
+from core.tor import RelayIndex
 from core.network import dht
 from core.network import ForwardedPort
 from core.bank import Bank
@@ -57,6 +57,8 @@ RELAY_HEX_ID_RE = re.compile(r"^[A-F0-9]{40}$")
 MIN_BW_RATE = 21
 #: if there are FEWER than this many relays that will exit to a given address, and we allow exits there, allow our own relay as an exit:
 RARE_EXIT_POLICY_CUTOFF = 4
+#: how many relays to ask Tor about in a single GETINFO when loading relays
+MAX_RELAYS_PER_QUERY = 50
 
 _instance = None
 def get():
@@ -283,6 +285,8 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
     self.conn = None
     #: dictionary mapping from desc.hexid -> obj for all Relays
     self.relays = {}
+    #: which of self.relays can be used in paths.  Must be updated whenever a Relay's descriptor or flags change
+    self.relayIndex = RelayIndex.RelayIndex()
     #: process ID for Tor (so we can shut it down when we quit, or at will)
     self._set_tor_id(0)
     #: will be triggered when Tor finishes starting up and is ready to use.  Is None when Tor is not in the process of starting up
@@ -320,6 +324,12 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
     self.orCircuits = {}
     #: the public keys of other relays and clients:
     self.relayKeys = {}
+    #: the base64 encoded keys of relays that have not been decoded into relayKeys yet (see get_relay_key)
+    self.relayKeyData = {}
+    #: hexids of the relays that load_relay will ask Tor about next
+    self.pendingRelayLoads = set()
+    #: the scheduled call to _load_pending_relays, if any relays are pending
+    self.relayLoadEvent = None
     #: if is_server, the time that we were most recently marked as reachable, otherwise, None
     self.relayReachableTime = None
     #: whether your descriptor has ever been accepted by the authority servers
@@ -632,7 +642,12 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
     if self.nextBWUpdateEvent and self.nextBWUpdateEvent.active():
       self.nextBWUpdateEvent.cancel()
     self.nextBWUpdateEvent = None
+    if self.relayLoadEvent and self.relayLoadEvent.active():
+      self.relayLoadEvent.cancel()
+    self.relayLoadEvent = None
+    self.pendingRelayLoads = set()
     self.relays = {}
+    self.relayIndex = RelayIndex.RelayIndex()
     self.eventHandler = None
     self.conn = None
     #TODO:  standardize this?
@@ -1075,6 +1090,7 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
       self._add_relays([relay])
       
     self.relayKeys[Globals.FINGERPRINT] = Globals.PUBLIC_KEY
+    self.relayKeyData.pop(Globals.FINGERPRINT, None)
         
     #set the types of events that we will recieve, and start listening
     self.eventHandler.start_listening_basic()
@@ -1133,8 +1149,8 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
     @type networkStatusMapping:  a mapping from hexid to NetworkStatus objects
     @return: Router instance or None if there was no proper NetworkStatus"""
     
-    #load the public key
-    publicKey, descriptorData = PublicKey.load_public_key(descriptorData)
+    #find the public key.  It is only decoded when it is needed for PAR (see get_relay_key), which saves a lot of time when starting up
+    encodedKey, descriptorData = PublicKey.split_public_key(descriptorData)
     
     #the rest of the data is delimited by "|"
     vals = descriptorData.split("|")
@@ -1187,11 +1203,19 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
       log_msg("Relay has deprecated bindExits flag set:  %s" % (fingerprint), 4)
       
     #build the descriptor
-    self.relayKeys[fingerprint] = publicKey
+    self.relayKeyData[fingerprint] = encodedKey
     descriptor = TorCtl.Router(relayNetworkStatus.idhex, relayNetworkStatus.nickname, bw_observed, dead, exitpolicy, relayNetworkStatus.flags, ipAddress, version, osName, uptime, country, isExit, allowDHT)
     
     return descriptor
   
+  def get_relay_key(self, hexId):
+    """@param hexId:  the hexid of the relay
+    @type hexId:  str
+    @return: the PublicKey from the relay's descriptor"""
+    if hexId in self.relayKeyData:
+      self.relayKeys[hexId] = PublicKey.decode_public_key(self.relayKeyData.pop(hexId))
+    return self.relayKeys[hexId]
+  
   def get_relay(self, hexId=None):
     """Get a Relay object that corresponds to hexid.  Will load the relay info
     from the TorCtl if it is not loaded already.  Will still return None occasionally,
@@ -1239,51 +1263,82 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
     for relay in relayList:
       if not self.relays.has_key(relay.desc.idhex):
         self.relays[relay.desc.idhex] = relay
+        self.relayIndex.update(relay)
         GlobalEvents.throw_event("new_relay", relay)
       else:
         raise Exception("Please dont add relays that are already in .relays!  Just update the existing one instead")
   
   def load_relay(self, hexId):
     """Get relay data for a single relay from the Tor control connection.
-    Called when we try to get a relay that we dont know about.
+    Called when we try to get a relay that we dont know about.  Relays are
+    requested from Tor in batches, after the current event is handled.
     @param hexId:  the hexid of the descriptor to load
     @type hexId:  str"""
-    
-    #get the network status document from Tor
-    statusQuery = "ns/id/"+hexId
-    statusDeferred = self.conn.get_info(statusQuery)
-    statusDeferred.addErrback(self._silent_tor_errback, "Failed to get network status from Tor for %s" % (statusQuery))
-    
-    #and get the descriptor
-    descriptorQuery = "desc_short/id/"+hexId
-    descriptorDeferred = self.conn.get_info(descriptorQuery)
-    descriptorDeferred.addErrback(self._silent_tor_errback, "Failed to get descriptor from Tor for %s" % (descriptorQuery))
-    
-    def response(result, descriptorQuery=descriptorQuery, statusQuery=statusQuery):
+    self.pendingRelayLoads.add(hexId)
+    if not self.relayLoadEvent:
+      self.relayLoadEvent = Scheduler.schedule_once(0, self._load_pending_relays)
+      
+  def _load_pending_relays(self):
+    """Request all relays that were passed to load_relay since the last call"""
+    self.relayLoadEvent = None
+    hexIds = list(self.pendingRelayLoads)
+    self.pendingRelayLoads = set()
+    if not self.conn:
+      return
+    for i in range(0, len(hexIds), MAX_RELAYS_PER_QUERY):
+      self._load_relays(hexIds[i:i+MAX_RELAYS_PER_QUERY])
+      
+  def _load_relays(self, hexIds):
+    """Get the network status and descriptor for each of hexIds with a single GETINFO.
+    If that fails (Tor rejects the whole query if it does not know about any one
+    of them), ask about each relay separately instead.
+    @param hexIds:  the hexids of the descriptors to load
+    @type hexIds:  list"""
+    queries = []
+    for hexId in hexIds:
+      queries.append("ns/id/"+hexId)
+      queries.append("desc_short/id/"+hexId)
+    infoDeferred = self.conn.get_info(queries)
+    
+    def response(result):
       """parse the responses from Tor"""
-      #if either of the callbacks failed, just print a simple warning notice, this happens fairly frequently
-      if not result[0][0] or not result[1][0] or not result[0][1] or not result[1][1]:
-        log_msg("Failed to get relay info from Tor for %s" % (hexId), 2)
+      for hexId in hexIds:
+        statusQuery = "ns/id/"+hexId
+        descriptorQuery = "desc_short/id/"+hexId
+        if not result.get(statusQuery) or not result.get(descriptorQuery):
+          log_msg("Failed to get relay info from Tor for %s" % (hexId), 2)
+          continue
+        #read the network status and descriptors from the response
+        networkStatus = TorCtl.parse_ns_body(result[statusQuery])[0]
+        descriptorData = result[descriptorQuery].replace('DESC:\n', "", 1)
+        descriptorData = descriptorData[:-1]
+        descriptor = self._build_descriptor(descriptorData, {networkStatus.idhex: networkStatus})
+        if not descriptor:
+          log_msg("Relay descriptor had no matching network status.", 1)
+          continue
+        #add a Relay if the descriptor is new
+        if not self.relays.has_key(descriptor.idhex):
+          relay = Relay.Relay()
+          relay.set_descriptor(descriptor)
+          self._add_relays([relay])
+        #otherwise, just update it
+        else:
+          relay = self.relays[descriptor.idhex]
+          relay.set_descriptor(descriptor)
+          self.relayIndex.update(relay)
+          
+    def failure(reason):
+      """try the relays one at a time, or just print a simple warning notice, this happens fairly frequently"""
+      if len(hexIds) > 1 and self.conn and Basic.exception_is_a(reason, [TorCtl.ErrorReply]):
+        for hexId in hexIds:
+          self._load_relays([hexId])
         return
-      #read the network status and descriptors from the response
-      networkStatus = TorCtl.parse_ns_body(result[1][1][statusQuery])[0]
-      descriptorData = result[0][1][descriptorQuery].replace('DESC:\n', "", 1)
-      descriptorData = descriptorData[:-1]
-      descriptor = self._build_descriptor(descriptorData, {networkStatus.idhex: networkStatus})
-      #add a Relay if the descriptor is new
-      if not self.relays.has_key(descriptor.idhex):
-        relay = Relay.Relay()
-        relay.set_descriptor(descriptor)
-        self._add_relays([relay])
-      #otherwise, just update it
-      else:
-        self.relays[descriptor.idhex].set_descriptor(descriptor)
+      self._silent_tor_errback(reason, "Failed to get relay info from Tor for %s" % (hexIds[0]))
         
     #add the callbacks
-    dList = defer.DeferredList([descriptorDeferred, statusDeferred])
-    dList.addCallback(response)
-    dList.addErrback(Basic.log_ex, "Failed while parsing relay information from Tor")
-      
+    infoDeferred.addCallbacks(response, failure)
+    infoDeferred.addErrback(Basic.log_ex, "Failed while parsing relay information from Tor")
+    
   def _silent_tor_errback(self, reason, messageString=None):
     """Just log_msg any TorCtlClosed or ErrorReply exceptions.
     This is useful for places where we are querying Tor but don't really care about the answer."""
@@ -1296,32 +1351,6 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
         messageString = "Failure during Tor communication"
       log_ex(reason, messageString)
 
-  def _pick_random_relay_by_score(self, allowableRelays):
-    """Randomly select a relay, weighted by the score of each relay.
-    @param allowableRelays:  how many relays to include in the path
-    @type allowableRelays:   list (of Relay instances)
-    @return: Relay instance (from the list)"""
-    
-    #return if there's nothing to pick from:
-    if len(allowableRelays) <= 0:
-      return None
-      
-    #calculate the sum of all relay scores:
-    totalScore = 0
-    for relay in allowableRelays:
-      totalScore += relay.score
-      
-    #pick randomly, but weight by bw of each relay:
-    selectedScoreIdx = random.random() * float(totalScore)
-    scoreSoFar = 0
-    for relay in allowableRelays:
-      scoreSoFar += relay.score
-      if scoreSoFar >= selectedScoreIdx:
-        return relay
-        
-    #should only make it here because of floating rounding errors
-    return allowableRelays[-1]
-    
   def _get_allowable_relays(self, host=None, port=None, exitCountry=None, ignoreExits=None, protocol="TCP"):
     """Returns two lists of allowable relays--one of those that will exit with the given parameters, and one of those that will not.
     @param length:  how many relays to include in the path
@@ -1339,36 +1368,22 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
     @return: Tuple of 2 lists of allowable relays--one of those that will exit with the given parameters, and one of those that will not"""
     
     #convert arguments to the right types
-    if not ignoreExits:
-      ignoreExits = []
     intHost = None
     if host and type(host) != types.IntType:
       #check if this is an IP, or if it is a hostname that has yet to be resolved:
       if isIPAddress(str(host)):
         intHost = struct.unpack(">I", socket.inet_aton(host))[0]
-    flags = ["Running"]
     
     #figure out which relays are allowable exits and which are allowable middle relays
+    #(the index caches this for each port, until some relay changes)
     ourRelay = self.get_relay()
-    middleRelays = []
-    exitRelays = []
-    for relay in self.relays.values():
-      #is this relay allowable at all?
-      relayIsAuthority = relay.desc.nickname.lower().find("innominetauth") != -1
-      relayIsAllowed = not relayIsAuthority and relay.has_flags(flags)
-      if relayIsAllowed:
-        relayIsUs = ourRelay == relay
-        #is this relay an allowable exit relay?
-        relayWillExitToCountry = not exitCountry or relay.desc.country == exitCountry
-        relayWillExitToHost = relay.will_exit_to(intHost, port, protocol)
-        relayShouldBeIgnored = relay not in ignoreExits
-        relayIsAllowableExit = relayWillExitToCountry and relayWillExitToHost and relayShouldBeIgnored
-        if relayIsAllowableExit:
-          exitRelays.append(relay)
-        #otherwise, use it as a middle relay (unless it's our relay, which can never be a middle relay)
-        elif not relayIsUs:
-          middleRelays.append(relay)
-          
+    exitRelays, middleRelays = self.relayIndex.get_allowable_relays(intHost, port, exitCountry, protocol, ourRelay)
+    if not ignoreExits:
+      return (exitRelays, middleRelays)
+    #ignored exits become middle relays (unless it's our relay, which can never be a middle relay)
+    ignoreExits = set(ignoreExits)
+    middleRelays += [relay for relay in exitRelays if relay in ignoreExits and relay != ourRelay]
+    exitRelays = [relay for relay in exitRelays if relay not in ignoreExits]
     return (exitRelays, middleRelays)
     
   def make_path(self, length, host=None, port=None, exitCountry=None, ignoreExits=None, protocol="TCP"):
@@ -1398,10 +1413,9 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
       if ourRelay in exitRelays:
         exitRelays.remove(ourRelay)
           
-    #pick an exit:
-    for relay in exitRelays:
-      relay.score = relay.get_score()
-    exitRelay = self._pick_random_relay_by_score(exitRelays)
+    #pick an exit, weighted by the score of each relay:
+    exitScores = [relay.get_score() for relay in exitRelays]
+    exitRelay = RelayIndex.ScoreSampler(exitRelays, exitScores).pick()
 #    #for testing:  use sylph as exit for easier debugging
 #    exitRelay = self.get_relay("0FA7BA1F266BDB109BF292D6256F388D48324832")
     
@@ -1416,21 +1430,20 @@ class Tor(Application.Application, ListenerMixin.ListenerMixin):
       
     #otherwise, prepare and score the list of middle relays
     ratio = 2.0 + (float(len(middleRelays)) / float(len(exitRelays)))
-    for relay in middleRelays:
-      relay.score = ratio * relay.get_score()
-    #prevent the exit relay from being used again
-    exitRelays.remove(exitRelay)
+    middleScores = [ratio * relay.get_score() for relay in middleRelays]
     #allow the exit relays to be used as middle relays as well, even though they will be less likely:
-    middleRelays += exitRelays
+    middleSampler = RelayIndex.ScoreSampler(middleRelays + exitRelays, middleScores + exitScores)
+    #prevent the exit relay from being used again
+    middleSampler.remove(exitRelay)
       
     #pick each of the (length-1) remaining relays for the path
     path = [exitRelay]
     for i in range(1, length):
-      nextRelay = self._pick_random_relay_by_score(middleRelays)
+      nextRelay = middleSampler.pick()
       if not nextRelay:
         log_msg("Not enough relays to create a path!", 1, "circuit")
         return None
-      middleRelays.remove(nextRelay)
+      middleSampler.remove(nextRelay)
       path.insert(0, nextRelay)
       
     return path
@@ -5,9 +5,12 @@ from binascii import b2a_hex
 from urllib import quote
 from BitTorrent.BTcrypto import Crypto as CRYPTO
 from BitTorrent.BT1 import ClientIdentifier
+from BitTorrent.BT1.Framing import MessageBuffer
 
 from twisted.internet import protocol
 
+from common import Globals
+
 import BitTorrent.BitTorrentClient
 from core import BWHistory
 from common.utils import Basic
@@ -48,7 +51,7 @@ class BTProtocol(protocol.Protocol):
         self.keepalive = lambda: None
         self.closed = False
         self.buffer = ''
-        self.bufferlen = None
+        self.framed = False
         self.log = None
         self.clientName = None
         self.cryptmode = 0
@@ -60,6 +63,10 @@ class BTProtocol(protocol.Protocol):
         self.btApp = BitTorrent.BitTorrentClient.get()
         self._read = self.read
         self._write = self.write
+        #: messages written during this reactor iteration, sent together by _flush_outgoing
+        self.outgoing = []
+        #: the scheduled call to _flush_outgoing, if there are messages waiting
+        self.flushEvent = None
 
     def _log_start(self):   # only called with DEBUG = True
         self.log = open('peerlog.'+self.get_ip()+'.txt','a')
@@ -380,6 +387,8 @@ class BTProtocol(protocol.Protocol):
     def close(self):
         if not self.closed:
             #self.connection.close()
+            #anything that was written before closing still has to go out
+            self._flush_outgoing()
             self.transport.loseConnection()
             self.sever()
 
@@ -401,14 +410,33 @@ class BTProtocol(protocol.Protocol):
         self.write(message)
 
     def write(self, message):
+      """Queue message to be sent at the end of this reactor iteration, so that
+      bursts of small messages (HAVE, REQUEST, etc) become one transport write,
+      with bandwidth accounted for once"""
       if not self.closed:
-        #Need to record bw when we are not being proxied:
-        if not self.isProxied:
-          BWHistory.localBandwidth.handle_bw_event(0, len(message))
-          self.btApp.handle_bw_event(0, len(message))
-        self.transport.write(message)
-        if self.readyToFlush:
-          self.connecter.connection_flushed(self)
+        self.outgoing.append(message)
+        if not self.flushEvent:
+          self.flushEvent = Globals.reactor.callLater(0, self._flush_outgoing)
+
+    def _flush_outgoing(self):
+      if self.flushEvent:
+        if self.flushEvent.active():
+          self.flushEvent.cancel()
+        self.flushEvent = None
+      if self.closed or not self.outgoing:
+        return
+      if len(self.outgoing) == 1:
+        data = self.outgoing[0]
+      else:
+        data = ''.join(self.outgoing)
+      self.outgoing = []
+      #Need to record bw when we are not being proxied:
+      if not self.isProxied:
+        BWHistory.localBandwidth.handle_bw_event(0, len(data))
+        self.btApp.handle_bw_event(0, len(data))
+      self.transport.write(data)
+      if self.readyToFlush:
+        self.connecter.connection_flushed(self)
 
     #def data_came_in(self, connection, s):
     #    self.read(s)
@@ -456,7 +484,7 @@ class BTProtocol(protocol.Protocol):
               self.next_len, self.next_func = x
             if self.next_len < 0:  # already checked buffer
                 return             # wait for additional data
-            if self.bufferlen is not None:
+            if self.framed:
                 self._read2('')
                 return
 
@@ -466,8 +494,10 @@ class BTProtocol(protocol.Protocol):
             self.encrypter.setrawaccess(self._read2,self._write)
         else:
             self.read = self._read2
-        self.bufferlen = len(self.buffer)
-        self.buffer = [self.buffer]
+        buf = MessageBuffer()
+        buf.append(self.buffer)
+        self.buffer = buf
+        self.framed = True
 
     def _read2(self, s):
         """handles reading raw data from actual torrenting (not handshakes"""
@@ -477,35 +507,15 @@ class BTProtocol(protocol.Protocol):
         if not self.isProxied:
           self.btApp.handle_bw_event(len(s), 0)
           BWHistory.localBandwidth.handle_bw_event(len(s), 0)
+        self.buffer.append(s)
         while True:
             if self.closed:
                 return
-            p = self.next_len-self.bufferlen
             if self.next_len == 0:
                 m = ''
-            elif s:
-                if p > len(s):
-                    self.buffer.append(s)
-                    self.bufferlen += len(s)
-                    return
-                self.bufferlen = len(s)-p
-                self.buffer.append(s[:p])
-                m = ''.join(self.buffer)
-                if p == len(s):
-                    self.buffer = []
-                else:
-                    self.buffer=[s[p:]]
-                s = ''
-            elif p <= 0:
-                # assert len(self.buffer) == 1
-                s = self.buffer[0]
-                self.bufferlen = len(s)-self.next_len
-                m = s[:self.next_len]
-                if p == 0:
-                    self.buffer = []
-                else:
-                    self.buffer = [s[self.next_len:]]
-                s = ''
+            elif len(self.buffer) >= self.next_len:
+                #large messages come back as buffers into the received data, not copies
+                m = self.buffer.take(self.next_len)
             else:
                 return
             try:
@@ -521,6 +531,11 @@ class BTProtocol(protocol.Protocol):
                 return             # wait for additional data
               
     def connectionLost(self, reason):
+      if self.flushEvent:
+        if self.flushEvent.active():
+          self.flushEvent.cancel()
+        self.flushEvent = None
+      self.outgoing = []
       
       peerId = self.readable_id
       try:
@@ -78,9 +78,7 @@ class DownloadPeer:
         if self.have.complete():
             self.downloader.picker.lost_seed()
         else:
-            for i in xrange(len(self.have)):
-                if self.have[i]:
-                    self.downloader.picker.lost_have(i)
+            self.downloader.picker.lost_haves(self.have)
         if self.have.complete() and self.downloader.storage.is_endgame():
             self.downloader.add_disconnected_seed(self.connection.get_readable_id())
         self._letgo()
@@ -286,8 +284,13 @@ class DownloadPeer:
     def _check_interests(self):
         if self.interested or self.downloader.paused:
             return
-        for i in xrange(len(self.have)):
-            if ( self.have[i] and not self.downloader.picker.is_blocked(i)
+        if self.downloader.endgamemode:
+            pieces = self.have.set_indices()
+        else:
+            # only pieces that we do not have yet can have requests left
+            pieces = self.have.difference_indices(self.downloader.storage.have)
+        for i in pieces:
+            if ( not self.downloader.picker.is_blocked(i)
                  and ( self.downloader.endgamemode
                        or self.downloader.storage.do_I_have_requests(i) ) ):
                 self.send_interested()
@@ -304,10 +307,7 @@ class DownloadPeer:
         if have.complete():
             self.downloader.picker.got_seed()
         else:
-            temp = 4
-            for i in xrange(len(have)):
-                if have[i]:
-                    self.downloader.picker.got_have(i)
+            self.downloader.picker.got_haves(have)
         if self.downloader.endgamemode and not self.downloader.paused:
             for piece, begin, length in self.downloader.all_requests:
                 if self.have[piece]:
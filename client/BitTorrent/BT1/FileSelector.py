@@ -113,6 +113,9 @@ class FileSelector:
                     return False
                 buffer.append((piece, start, data))
 
+        # cached writes are for the old file ranges
+        if not self.storagewrapper.flush_write_cache():
+            return False
         files_updated = False        
         try:
             for f in xrange(self.numfiles):
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""Buffering for length-prefixed peer wire messages"""
+
+from collections import deque
+
+#: messages up to this long are returned as strings, since copying them is cheaper than a buffer object
+SMALL_MESSAGE = 64
+
+class MessageBuffer:
+    """Holds data that came in from the network, as the original strings, until
+    it is taken as messages.  A message that lies inside one string is returned as
+    a read-only buffer object pointing into that string, so large messages (piece
+    blocks) are never copied here.  Only messages that span several reads get
+    joined together, once.  A buffer keeps the whole string it points into alive,
+    so anything that holds on to one should copy it first."""
+    def __init__(self):
+        #: the strings that we have received, oldest first
+        self.chunks = deque()
+        #: how much of self.chunks[0] has already been taken
+        self.offset = 0
+        #: total number of bytes that have not been taken yet
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, s):
+        if s:
+            self.chunks.append(s)
+            self.length += len(s)
+
+    def take(self, n):
+        """Remove the next n bytes
+        @returns:  the bytes, as a string or a buffer object"""
+        assert 0 < n <= self.length
+        #lengths from the wire are longs, and __len__ has to return an int
+        n = int(n)
+        chunks = self.chunks
+        chunk = chunks[0]
+        offset = self.offset
+        available = len(chunk) - offset
+        self.length -= n
+        if available >= n:
+            if offset == 0 and n == available:
+                m = chunk
+            elif n <= SMALL_MESSAGE:
+                m = chunk[offset:offset+n]
+            else:
+                m = buffer(chunk, offset, n)
+            if available == n:
+                chunks.popleft()
+                self.offset = 0
+            else:
+                self.offset = offset + n
+            return m
+        #it spans several reads, so join the pieces
+        if offset:
+            parts = [chunk[offset:]]
+        else:
+            parts = [chunk]
+        chunks.popleft()
+        needed = n - available
+        while needed > 0:
+            chunk = chunks[0]
+            if len(chunk) <= needed:
+                parts.append(chunk)
+                chunks.popleft()
+                needed -= len(chunk)
+                self.offset = 0
+            else:
+                parts.append(chunk[:needed])
+                self.offset = needed
+                needed = 0
+        return ''.join(parts)
+
+    def getvalue(self):
+        """@returns:  everything that has not been taken yet, without removing it"""
+        if not self.chunks:
+            return ''
+        chunks = list(self.chunks)
+        chunks[0] = chunks[0][self.offset:]
+        return ''.join(chunks)
+
+if __name__ == "__main__":
+    #benchmark:  stream piece messages over a loopback socket, and frame them the old way
+    #(join and re-slice strings, then copy the payload) and with MessageBuffer
+    import time
+    import socket
+    import random
+    import threading
+    from binascii import b2a_hex
+
+    BLOCK_SIZE = 16384
+    NUM_BLOCKS = 20000
+    block = chr(7) + '\x00' * 8 + 'x' * BLOCK_SIZE
+    message = '\x00\x00\x40\x09' + block
+
+    def toint(s):
+        return long(b2a_hex(s), 16)
+
+    def send_all(sock):
+        data = message * 64
+        for i in xrange(NUM_BLOCKS / 64):
+            sock.sendall(data)
+        sock.close()
+
+    class OldFraming:
+        """_read2 from before MessageBuffer"""
+        def __init__(self, got_piece):
+            self.got_piece = got_piece
+            self.buffer = []
+            self.bufferlen = 0
+            self.next_len, self.next_func = 4, self.read_len
+        def read_len(self, s):
+            return toint(s), self.read_message
+        def read_message(self, s):
+            self.got_piece(s[9:])
+            return 4, self.read_len
+        def read(self, s):
+            while True:
+                p = self.next_len-self.bufferlen
+                if s:
+                    if p > len(s):
+                        self.buffer.append(s)
+                        self.bufferlen += len(s)
+                        return
+                    self.bufferlen = len(s)-p
+                    self.buffer.append(s[:p])
+                    m = ''.join(self.buffer)
+                    if p == len(s):
+                        self.buffer = []
+                    else:
+                        self.buffer=[s[p:]]
+                    s = ''
+                elif p <= 0:
+                    s = self.buffer[0]
+                    self.bufferlen = len(s)-self.next_len
+                    m = s[:self.next_len]
+                    if p == 0:
+                        self.buffer = []
+                    else:
+                        self.buffer = [s[self.next_len:]]
+                    s = ''
+                else:
+                    return
+                self.next_len, self.next_func = self.next_func(m)
+
+    class NewFraming:
+        def __init__(self, got_piece):
+            self.got_piece = got_piece
+            self.buffer = MessageBuffer()
+            self.next_len, self.next_func = 4, self.read_len
+        def read_len(self, s):
+            return toint(s), self.read_message
+        def read_message(self, s):
+            self.got_piece(buffer(s, 9))
+            return 4, self.read_len
+        def read(self, s):
+            self.buffer.append(s)
+            while len(self.buffer) >= self.next_len:
+                self.next_len, self.next_func = self.next_func(self.buffer.take(self.next_len))
+
+    for framingClass in (OldFraming, NewFraming):
+        received = [0]
+        def got_piece(piece):
+            received[0] += len(piece)
+        framing = framingClass(got_piece)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sender.connect(listener.getsockname())
+        receiver = listener.accept()[0]
+        listener.close()
+        thread = threading.Thread(target = send_all, args = (sender,))
+        thread.setDaemon(True)
+        startTime = time.time()
+        thread.start()
+        while True:
+            #vary the read size, like real connections do
+            data = receiver.recv(random.choice((4096, 16384, 65536)))
+            if not data:
+                break
+            framing.read(data)
+        elapsed = time.time() - startTime
+        thread.join()
+        receiver.close()
+        assert received[0] == NUM_BLOCKS / 64 * 64 * BLOCK_SIZE
+        print "%12s:  %8.1f MB/s" % (framingClass.__name__, received[0] / 1048576.0 / elapsed)
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""Checks the existing data of several torrents at once when they are started"""
+
+from threading import Thread, Lock
+from Queue import Queue
+from hashlib import sha1
+
+from twisted.internet import reactor
+
+from BitTorrent.clock import clock
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+DEBUG = False
+
+class HashCheckPool:
+    """Hash checks existing data for any number of torrents at once, in a pool of
+    threads.  Each job is a run of consecutive pieces that is read with a single
+    sequential Storage.read.  File reads and sha1 of large buffers release the GIL,
+    so the threads really do check in parallel (and a frozen Windows build does not
+    have to spawn extra processes).  Results are handed back to the reactor thread."""
+    def __init__(self, numThreads = 2, readSize = 4*1048576):
+        self.readSize = readSize
+        self.queue = Queue()
+        self.threads = []
+        self.lock = Lock()
+        #: statistics, for the throughput report
+        self.bytesChecked = 0L
+        self.piecesChecked = 0
+        self.startTime = None
+        for i in xrange(max(1, numThreads)):
+            t = Thread(target = self._run, name = "HashCheck%s" % (i))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def check(self, storage, pieceSize, pieces, piecelen, lastlen, resultfunc, failfunc, flag):
+        """Queue pieces of one torrent to be checked
+        @param storage:  the torrent's Storage
+        @param pieces:  indices of the pieces to check, in the order to check them
+        @param piecelen:  function that returns the length of a piece
+        @param lastlen:  length of the last piece of the torrent (data that is really the last
+        piece, but at a different position, gets recognized by the hash of this prefix)
+        @param resultfunc:  called in the reactor thread with a list of (piece, prefix hash, hash)
+        @param failfunc:  called in the reactor thread with the error if the data could not be read
+        @param flag:  Event that is set if the torrent is stopped"""
+        if self.startTime is None:
+            self.startTime = clock()
+        run = []
+        runLength = 0
+        for i in pieces:
+            #start a new run if this piece is not next to the last one, or the run is big enough
+            if run and (i != run[-1] + 1 or runLength + piecelen(i) > self.readSize):
+                self.queue.put(HashCheckJob(self, storage, pieceSize, run, piecelen, lastlen, resultfunc, failfunc, flag))
+                run = []
+                runLength = 0
+            run.append(i)
+            runLength += piecelen(i)
+        if run:
+            self.queue.put(HashCheckJob(self, storage, pieceSize, run, piecelen, lastlen, resultfunc, failfunc, flag))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                job.run()
+            except Exception, e:
+                log_ex(e, "Unhandled error while hash checking")
+
+    def _add_stats(self, numPieces, numBytes):
+        self.lock.acquire()
+        self.piecesChecked += numPieces
+        self.bytesChecked += numBytes
+        self.lock.release()
+
+    def get_throughput(self):
+        """@returns:  MB/s checked since the first job was queued"""
+        if self.startTime is None:
+            return 0.0
+        elapsed = max(clock() - self.startTime, 0.001)
+        return self.bytesChecked / 1048576.0 / elapsed
+
+    def stop(self):
+        for t in self.threads:
+            self.queue.put(None)
+        self.threads = []
+
+class HashCheckJob:
+    """A run of consecutive pieces from one torrent"""
+    def __init__(self, pool, storage, pieceSize, pieces, piecelen, lastlen, resultfunc, failfunc, flag):
+        self.pool = pool
+        self.storage = storage
+        self.pieceSize = pieceSize
+        self.pieces = pieces
+        self.piecelen = piecelen
+        self.lastlen = lastlen
+        self.resultfunc = resultfunc
+        self.failfunc = failfunc
+        self.flag = flag
+
+    def run(self):
+        #the torrent was stopped, so dont bother
+        if self.flag.isSet():
+            reactor.callFromThread(self.resultfunc, [(i, None, None) for i in self.pieces])
+            return
+        lengths = [self.piecelen(i) for i in self.pieces]
+        total = sum(lengths)
+        try:
+            data = self.storage.read(self.pieceSize * self.pieces[0], total)
+        except IOError, e:
+            reactor.callFromThread(self.failfunc, e)
+            return
+        buf = data[:]
+        results = []
+        offset = 0
+        for i, length in zip(self.pieces, lengths):
+            prefixLen = min(self.lastlen, length)
+            sh = sha1(buffer(buf, offset, prefixLen))
+            sp = sh.digest()
+            sh.update(buffer(buf, offset + prefixLen, length - prefixLen))
+            results.append((i, sp, sh.digest()))
+            offset += length
+        data.release()
+        if DEBUG:
+            print 'checked pieces %s-%s' % (self.pieces[0], self.pieces[-1])
+        self.pool._add_stats(len(self.pieces), total)
+        reactor.callFromThread(self.resultfunc, results)
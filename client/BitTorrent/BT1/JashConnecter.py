@@ -131,9 +131,11 @@ class Connection:
                 return 0
             index, begin, piece = s
             self.lastActive = time.time()
-            self.partial_message = ''.join((
+            #piece is an array, a string, or a buffer over a memory mapped file (see MappedStorage).
+            #adding it to a buffer copies it straight into the message
+            self.partial_message = buffer(''.join((
                             tobinary(len(piece) + 9), PIECE,
-                            tobinary(index), tobinary(begin), piece.tostring() ))
+                            tobinary(index), tobinary(begin) ))) + piece
             log_msg('%s sending chunk %s %s %s' % (self.ccount,index,begin,begin+len(piece)), 4, "btprotocol")
 
         if bytes < len(self.partial_message):
@@ -307,7 +309,9 @@ class JashConnecter:
                 log_msg('%s bad piece number (PIECE)' % (c.ccount), 0, "btprotocol")
                 protocol.close()
                 return
-            if c.download.got_piece(i, toint(message[5:9]), message[9:]):
+            #the block is handed on without copying it out of the received data.
+            #StorageWrapper.piece_came_in copies it before keeping it
+            if c.download.got_piece(i, toint(message[5:9]), buffer(message, 9)):
                 c.lastActive = time.time()
                 self.got_piece(i)
         else:
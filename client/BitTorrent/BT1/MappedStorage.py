@@ -0,0 +1,308 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""Storage that reads and writes through memory mapped windows of each file,
+instead of seeking and reading MAXREADSIZE chunks through file handles.
+Selected with the use_mmap setting."""
+
+import os
+import mmap
+from array import array
+from weakref import WeakKeyDictionary
+
+from BitTorrent.BT1.Storage import Storage
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+DEBUG = False
+
+class MappedPiece:
+    """Looks like the PieceBuffer that Storage.read returns, but holds buffers over the
+    mapped windows instead of a copy of the data.  Slices are buffers too (unless they
+    span windows or files), so uploads copy the data once, straight from the mapping,
+    when the message is built.  getarray() copies, for things that keep the data around."""
+    def __init__(self, pos):
+        #: where the data starts in the Storage
+        self.pos = pos
+        #: buffers over the mapped windows, in order
+        self.parts = []
+        self.length = 0
+
+    def append(self, part):
+        self.parts.append(part)
+        self.length += len(part)
+
+    def __len__(self):
+        return self.length
+
+    def __getslice__(self, a, b):
+        if b > self.length:
+            b = self.length
+        if b < 0:
+            b += self.length
+        a = max(0, a)
+        b = max(a, b)
+        if len(self.parts) == 1:
+            return buffer(self.parts[0], a, b - a)
+        pieces = []
+        offset = 0
+        for part in self.parts:
+            end = offset + len(part)
+            if end > a and offset < b:
+                pieces.append(part[max(a - offset, 0):b - offset])
+            offset = end
+        return ''.join(pieces)
+
+    def detach(self):
+        """Copy the data out of the mapping, because it is about to be overwritten"""
+        self.parts = [''.join([str(part) for part in self.parts])]
+
+    def getarray(self):
+        r = array('c')
+        for part in self.parts:
+            r.fromstring(part)
+        return r
+
+    def release(self):
+        self.parts = []
+        self.length = 0
+
+class MappedStorage(Storage):
+    """Same interface as Storage (so StorageWrapper does not care which one it gets).
+    Files are mapped in windows of mmap_window_size MB, so huge files do not use up
+    the address space, and at most mmap_max_windows windows are kept mapped.
+    read returns MappedPieces, so a window that was dropped stays mapped until the
+    pieces read from it are released (eg, until a peer is sent the piece it is uploading),
+    and a MappedPiece that is still in use is detached before its data is overwritten
+    (eg, when StorageWrapper moves another piece into its place).
+    File handles are still opened (and locked) by Storage, the windows just map them.
+    Writes past the current end of a file go through the file handle, since a mapping
+    cannot grow the file."""
+    def __init__(self, files, piece_length, doneflag, config,
+                 disabled_files = None):
+        Storage.__init__(self, files, piece_length, doneflag, config, disabled_files)
+        windowSize = max(1, config.get('mmap_window_size', 16)) * 1048576
+        #windows have to start at a multiple of the allocation granularity
+        self.window_size = windowSize - windowSize % mmap.ALLOCATIONGRANULARITY
+        self.max_windows = max(1, config.get('mmap_max_windows', 16))
+        #: mapping from file name to {window start: (mmap, writable)}
+        self.maps = {}
+        #: (file, window start) for every open window, least recently used first
+        self.window_list = []
+        #: MappedPieces that were read, and have not been detached or garbage collected yet
+        self.pieces = WeakKeyDictionary()
+
+    def _drop_window(self, m, writable):
+        #not closed, since MappedPieces may still point into it.  It is unmapped once they are gone
+        if writable:
+            m.flush()
+
+    def _close_windows(self, file):
+        for start, (m, writable) in self.maps.pop(file, {}).items():
+            self.window_list.remove((file, start))
+            self._drop_window(m, writable)
+
+    def _close(self, file):
+        #the windows map this handle, so they have to go first
+        self._close_windows(file)
+        Storage._close(self, file)
+
+    def _get_window(self, file, pos, end, for_write):
+        """@returns:  (mmap, window start, end of the part of [pos, end) inside the window),
+        or None if the file is too short to map that much"""
+        start = pos - pos % self.window_size
+        stop = min(end, start + self.window_size)
+        maps = self.maps.get(file)
+        if maps and maps.has_key(start):
+            m, writable = maps[start]
+            if len(m) >= stop - start and (writable or not for_write):
+                if self.window_list[-1] != (file, start):
+                    self.window_list.remove((file, start))
+                    self.window_list.append((file, start))
+                return m, start, stop
+            #the file grew, or we need to write now
+            del maps[start]
+            self.window_list.remove((file, start))
+            self._drop_window(m, writable)
+        #NOTE:  this might reopen the file for writing, which closes all of its windows
+        h = self._get_file_handle(file, for_write)
+        size = os.fstat(h.fileno()).st_size
+        if size < stop:
+            return None
+        if for_write:
+            access = mmap.ACCESS_WRITE
+        else:
+            access = mmap.ACCESS_READ
+        m = mmap.mmap(h.fileno(), min(self.window_size, size - start), access = access, offset = start)
+        self.maps.setdefault(file, {})[start] = (m, for_write)
+        self.window_list.append((file, start))
+        if len(self.window_list) > self.max_windows:
+            oldFile, oldStart = self.window_list.pop(0)
+            oldMap, writable = self.maps[oldFile].pop(oldStart)
+            self._drop_window(oldMap, writable)
+        return m, start, stop
+
+    def _detach_pieces(self, pos, end):
+        for piece in self.pieces.keys():
+            if piece.pos < end and piece.pos + piece.length > pos:
+                piece.detach()
+                del self.pieces[piece]
+
+    def read(self, pos, amount, flush_first = False):
+        r = MappedPiece(pos)
+        self.lock.acquire()
+        try:
+            self.pieces[r] = True
+        finally:
+            self.lock.release()
+        for file, pos, end in self._intervals(pos, amount):
+            if DEBUG:
+                print 'reading '+file+' from '+str(pos)+' to '+str(end)
+            self.lock.acquire()
+            try:
+                try:
+                    while pos < end:
+                        window = self._get_window(file, pos, end, False)
+                        if not window:
+                            raise IOError('error reading data from '+file)
+                        m, start, stop = window
+                        r.append(buffer(m, pos-start, stop-pos))
+                        pos = stop
+                    if flush_first and self.whandles.has_key(file):
+                        for m, writable in self.maps.get(file, {}).values():
+                            if writable:
+                                m.flush()
+                except (IOError, OSError, mmap.error, ValueError):
+                    raise IOError('error reading data from '+ file)
+            finally:
+                self.lock.release()
+        return r
+
+    def write(self, pos, s):
+        # might raise an IOError
+        self.lock.acquire()
+        try:
+            self._detach_pieces(pos, pos + len(s))
+        finally:
+            self.lock.release()
+        total = 0
+        for file, begin, end in self._intervals(pos, len(s)):
+            if DEBUG:
+                print 'writing '+file+' from '+str(begin)+' to '+str(end)
+            self.lock.acquire()
+            try:
+                try:
+                    pos = begin
+                    while pos < end:
+                        window = self._get_window(file, pos, end, True)
+                        if not window:
+                            #past the end of the file, so write the rest through the handle
+                            h = self._get_file_handle(file, True)
+                            h.seek(pos)
+                            h.write(s[total + pos - begin: total + end - begin])
+                            h.flush()
+                            break
+                        m, start, stop = window
+                        data = s[total + pos - begin: total + stop - begin]
+                        #mmap slice assignment only takes strings, and s may be a PieceBuffer or MappedPiece
+                        if not isinstance(data, str):
+                            data = str(buffer(data))
+                        m[pos-start:stop-start] = data
+                        pos = stop
+                except (OSError, mmap.error, ValueError), e:
+                    raise IOError('error writing data to '+file+': '+str(e))
+            finally:
+                self.lock.release()
+            total += end - begin
+
+    def top_off(self):
+        Storage.top_off(self)
+        #so the growth is visible to the next mapping
+        self.lock.acquire()
+        try:
+            for file in self.whandles.keys():
+                self.handles[file].flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        # may raise IOError or OSError
+        self.lock.acquire()
+        try:
+            for maps in self.maps.values():
+                for m, writable in maps.values():
+                    if writable:
+                        m.flush()
+        finally:
+            self.lock.release()
+        Storage.flush(self)
+
+    def close(self):
+        for file in self.maps.keys():
+            try:
+                self._close_windows(file)
+            except Exception, e:
+                log_ex(e, "Failed to flush mapped windows")
+        Storage.close(self)
+
+if __name__ == "__main__":
+    #benchmark:  upload random pieces from a file through StorageWrapper.get_piece, with Storage
+    #and MappedStorage, the way Uploader (with buffer_reads) and JashConnecter.send_partial do
+    import sys
+    import time
+    import random
+    import tempfile
+    from threading import Event
+    from sha import sha
+    from BitTorrent.BT1.JashConnecter import tobinary, PIECE
+    from BitTorrent.BT1.StorageWrapper import StorageWrapper
+    from BitTorrent.BT1.ReadCache import PieceReadCache
+
+    FILE_SIZE = 256 * 1048576
+    PIECE_LENGTH = 262144
+    BLOCK_SIZE = 16384
+    NUM_PIECES = 2000
+    #the defaults from download_bt1 and BitTorrentClient, including the 32 MB read cache
+    config = {'max_files_open': 50, 'lock_files': 0, 'lock_while_reading': 0,
+              'mmap_window_size': 16, 'mmap_max_windows': 16, 'buffer_reads': 1,
+              'alloc_type': 'normal', 'double_check': 1, 'triple_check': 0,
+              'write_buffer_size': 4, 'hash_reorder_size': 128, 'auto_flush': 0,
+              'read_cache_size': 32}
+    if len(sys.argv) > 1:
+        fileName = sys.argv[1]
+    else:
+        fileName = os.path.join(tempfile.gettempdir(), "mmap_benchmark.dat")
+        f = open(fileName, "wb")
+        for i in xrange(FILE_SIZE / 1048576):
+            f.write(os.urandom(1048576))
+        f.close()
+    size = os.path.getsize(fileName)
+    numPieces = size / PIECE_LENGTH
+    size = numPieces * PIECE_LENGTH
+    f = open(fileName, "rb")
+    hashes = [sha(f.read(PIECE_LENGTH)).digest() for i in xrange(numPieces)]
+    f.close()
+    random.seed(0)
+    pieces = [random.randrange(numPieces) for i in xrange(NUM_PIECES)]
+    def failed(reason):
+        raise Exception(reason)
+    for storageClass in (Storage, MappedStorage):
+        storage = storageClass([(fileName, size)], PIECE_LENGTH, Event(), config)
+        wrapper = StorageWrapper(storage, 2 ** 14, hashes, PIECE_LENGTH, lambda: None, failed,
+                                 backfunc = lambda func, delay = 0: None, config = config,
+                                 read_cache = PieceReadCache(config['read_cache_size'] * 1048576))
+        assert wrapper.old_style_init()
+        sent = 0
+        startTime = time.time()
+        startCPU = sum(os.times()[:2])
+        for index in pieces:
+            piecebuf = wrapper.get_piece(index, 0, -1)
+            for begin in xrange(0, PIECE_LENGTH, BLOCK_SIZE):
+                piece = piecebuf[begin:begin+BLOCK_SIZE]
+                message = buffer(''.join((tobinary(len(piece) + 9), PIECE,
+                                          tobinary(index), tobinary(begin)))) + piece
+                sent += len(message)
+            piecebuf.release()
+        elapsed = time.time() - startTime
+        cpu = sum(os.times()[:2]) - startCPU
+        wrapper.read_cache.forget(wrapper)
+        storage.close()
+        print "%15s:  %8.1f MB/s, %5.2f CPU seconds" % (storageClass.__name__, sent / 1048576.0 / elapsed, cpu)
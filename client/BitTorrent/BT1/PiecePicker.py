@@ -3,6 +3,7 @@
 
 import time
 from random import randrange, shuffle
+from itertools import ifilter
 
 from BitTorrent.clock import clock
 
@@ -46,12 +47,17 @@ from BitTorrent.clock import clock
 #      note that seeds do NOT count in this calculation, JUST peers
 #
 #  yes, this is sort of crazy, but this is how I found the code, and I spent an hour decoding this, so I wrote some docs for my future self
-#  This class is a good candidate for rewriting, especially because it is particularly inefficient.
-#  Part of the reason for this inefficiency is that many torrent clients use 'lazy_bitfield', which means they look like peers that are ~99% done, then send extra have messages
-#  thus, for every initial connection, we have to add all the pieces in and shuffle them arround, then undo that operation when we get the last few HAVEs
-#  also, the next operation seems to take a good chunk of time.
-#  really, all we care about is prioritizing rarer pieces, following user priorities, and making sure that you pick pieces sort of randomly
-#  it seems like there should be a simpler way to do that...
+#
+#  The levels are still the same, and every move between levels is O(1) (swap with the last entry of the old level, then insert at a pseudo-random position in the new one).
+#  self.crosscount[n] is how many pieces have exactly n copies, so get_num_copies no longer scans every piece.
+#  Lazy-bitfield peers used to cost thousands of method calls per connection, got_haves/lost_haves do the whole
+#  bitfield at once.  next() scans levels from the most wanted, which ends almost immediately for peers that
+#  have most of the pieces.  For peers that have only a few pieces, it walks their bitfield instead, so the work
+#  is proportional to how many pieces that peer has, not how many the torrent has.
+
+#: next() walks the bitfield of a peer instead of the levels if the peer has fewer pieces than
+#: the number we still want, divided by this
+SPARSE_PEER_FACTOR = 4
 
 class PiecePicker:
     def __init__(self, numpieces,
@@ -65,10 +71,10 @@ class PiecePicker:
         self.started = []
         self.totalcount = 0
         self.numhaves = [0] * numpieces
+        #: crosscount[n] is the number of pieces that exactly n peers have
+        self.crosscount = [numpieces]
         self.priority = [1] * numpieces
         self.removed_partials = {}
-#        self.crosscount = [numpieces]
-#        self.crosscount2 = [numpieces]
         self.has = [0] * numpieces
         self.numgot = 0
         self.done = False
@@ -98,8 +104,11 @@ class PiecePicker:
       curTime = time.time()
       if shouldUpdate or curTime > self.lastUpdate + CACHE_TIME:
         self.lastUpdate = curTime
-        fewestHaves = min(self.numhaves)
-        numRarestPieces = self.numhaves.count(fewestHaves)
+        numRarestPieces = 0
+        for count in self.crosscount:
+          if count > 0:
+            numRarestPieces = count
+            break
         self.numConnectedCopies = (float(self.numpieces) - float(numRarestPieces)) / float(self.numpieces)
         self.numConnectedCopies += self.seeds_connected
       return self.numConnectedCopies
@@ -108,16 +117,12 @@ class PiecePicker:
         self.totalcount+=1
         numint = self.numhaves[piece]
         self.numhaves[piece] += 1
-#        self.crosscount[numint] -= 1
-#        if numint+1==len(self.crosscount):
-#            self.crosscount.append(0)
-#        self.crosscount[numint+1] += 1
+        crosscount = self.crosscount
+        crosscount[numint] -= 1
+        if numint+1 == len(crosscount):
+            crosscount.append(0)
+        crosscount[numint+1] += 1
         if not self.done:
-#            numintplus = numint+self.has[piece]
-#            self.crosscount2[numintplus] -= 1
-#            if numintplus+1 == len(self.crosscount2):
-#                self.crosscount2.append(0)
-#            self.crosscount2[numintplus+1] += 1
             numint = self.level_in_interests[piece]
             self.level_in_interests[piece] += 1
         if self.superseed:
@@ -134,12 +139,9 @@ class PiecePicker:
         self.totalcount-=1
         numint = self.numhaves[piece]
         self.numhaves[piece] -= 1
-#        self.crosscount[numint] -= 1
-#        self.crosscount[numint-1] += 1
+        self.crosscount[numint] -= 1
+        self.crosscount[numint-1] += 1
         if not self.done:
-#            numintplus = numint+self.has[piece]
-#            self.crosscount2[numintplus] -= 1
-#            self.crosscount2[numintplus-1] += 1
             numint = self.level_in_interests[piece]
             self.level_in_interests[piece] -= 1
         if self.superseed:
@@ -149,6 +151,69 @@ class PiecePicker:
             return
         self._shift_over(piece, self.interests[numint], self.interests[numint - 1])
 
+    def got_haves(self, have):
+        """got_have for every piece in a peer's bitfield"""
+        if self.superseed:
+            for piece in _set_bits(have):
+                self.got_have(piece)
+            return
+        self._move_all(_set_bits(have), 1)
+
+    def lost_haves(self, have):
+        """lost_have for every piece in a peer's bitfield"""
+        if self.superseed:
+            for piece in _set_bits(have):
+                self.lost_have(piece)
+            return
+        self._move_all(_set_bits(have), -1)
+
+    def _move_all(self, pieces, delta):
+        #OPT:  same as got_have/lost_have and _shift_over, with everything in locals,
+        #since this is called for every piece of every peer that connects or disconnects
+        numhaves = self.numhaves
+        crosscount = self.crosscount
+        level_in_interests = self.level_in_interests
+        parray = self.pos_in_interests
+        has = self.has
+        priority = self.priority
+        interests = self.interests
+        done = self.done
+        count = 0
+        for piece in pieces:
+            count += 1
+            numint = numhaves[piece]
+            numhaves[piece] = numint + delta
+            crosscount[numint] -= 1
+            if numint + delta == len(crosscount):
+                crosscount.append(0)
+            crosscount[numint + delta] += 1
+            if done:
+                continue
+            numint = level_in_interests[piece]
+            level_in_interests[piece] = numint + delta
+            if has[piece] or priority[piece] == -1:
+                continue
+            if numint + delta == len(interests):
+                interests.append([])
+            l1 = interests[numint]
+            l2 = interests[numint + delta]
+            p = parray[piece]
+            q = l1[-1]
+            l1[p] = q
+            parray[q] = p
+            del l1[-1]
+            newp = (piece * 13 * len(l1)) % (len(l2)+1)
+            if newp == len(l2):
+                parray[piece] = newp
+                l2.append(piece)
+            else:
+                old = l2[newp]
+                parray[old] = len(l2)
+                l2.append(old)
+                l2[newp] = piece
+                parray[piece] = newp
+        self.totalcount += count * delta
+
     def _shift_over(self, piece, l1, l2):
         assert self.superseed or (not self.has[piece] and self.priority[piece] >= 0)
         parray = self.pos_in_interests
@@ -162,7 +227,11 @@ class PiecePicker:
         #newp = randrange(len(l2)+1)
         #instead, approximate random position my using the remainder of the piece number
         #this line is 20x faster than the other
-        newp = (piece * 13 * len(l1)) % (len(l2)+1)
+        self._insert(piece, l2, (piece * 13 * len(l1)) % (len(l2)+1))
+
+    def _insert(self, piece, l2, newp):
+        """put piece at position newp of l2, moving whatever was there to the end"""
+        parray = self.pos_in_interests
         if newp == len(l2):
             parray[piece] = len(l2)
             l2.append(piece)
@@ -181,13 +250,11 @@ class PiecePicker:
         self.got_seed()
         self.totalcount -= self.numpieces
         self.numhaves = [i-1 for i in self.numhaves]
+        del self.crosscount[0]
         if self.superseed or not self.done:
             self.level_in_interests = [i-1 for i in self.level_in_interests]
             if self.interests:
                 del self.interests[0]
-#        del self.crosscount[0]
-#        if not self.done:
-#            del self.crosscount2[0]
 
     def lost_seed(self):
         self.seeds_connected -= 1
@@ -218,13 +285,6 @@ class PiecePicker:
         self.numgot += 1
         if self.numgot == self.numpieces:
             self.done = True
-#            self.crosscount2 = self.crosscount
-#        else:
-#            numhaves = self.numhaves[piece]
-#            self.crosscount2[numhaves] -= 1
-#            if numhaves+1 == len(self.crosscount2):
-#                self.crosscount2.append(0)
-#            self.crosscount2[numhaves+1] += 1
         self._remove_from_interests(piece)
 
     def next(self, haves, wantfunc, complete_first = False):
@@ -247,15 +307,48 @@ class PiecePicker:
                       (0, self.cutoff) ]
         else:
             r = [ (0, min(bestnum,len(self.interests))) ]
-        for lo,hi in r:
-            for i in xrange(lo,hi):
-                for j in self.interests[i]:
-                    if haves[j] and wantfunc(j):
-                        return j
+        numfalse = getattr(haves, 'numfalse', None)
+        if ( numfalse is not None and
+             (len(haves) - numfalse) * SPARSE_PEER_FACTOR < self.numpieces - self.numgot ):
+            j = self._next_sparse(haves, wantfunc, r)
+            if j is not None:
+                return j
+        else:
+            has_piece = haves.__getitem__
+            for lo,hi in r:
+                for i in xrange(lo,hi):
+                    for j in ifilter(has_piece, self.interests[i]):
+                        if wantfunc(j):
+                            return j
         if best is not None:
             return best
         return None
 
+    def _next_sparse(self, haves, wantfunc, r):
+        """Same answer as scanning the levels in r, but only looks at the pieces that the peer has"""
+        has = self.has
+        priority = self.priority
+        level_in_interests = self.level_in_interests
+        pos_in_interests = self.pos_in_interests
+        candidates = [j for j in _set_bits(haves) if not has[j] and priority[j] != -1]
+        for lo,hi in r:
+            best = None
+            bestlevel = hi
+            bestpos = 0
+            for j in candidates:
+                level = level_in_interests[j]
+                if level < lo or level > bestlevel:
+                    continue
+                if level == bestlevel and (best is None or pos_in_interests[j] > bestpos):
+                    continue
+                if wantfunc(j):
+                    best = j
+                    bestlevel = level
+                    bestpos = pos_in_interests[j]
+            if best is not None:
+                return best
+        return None
+
     def am_I_complete(self):
         return self.done
     
@@ -290,17 +383,7 @@ class PiecePicker:
             while len(self.interests) < level+1:
                 self.interests.append([])
             l2 = self.interests[level]
-            parray = self.pos_in_interests
-            newp = randrange(len(l2)+1)
-            if newp == len(l2):
-                parray[piece] = len(l2)
-                l2.append(piece)
-            else:
-                old = l2[newp]
-                parray[old] = len(l2)
-                l2.append(old)
-                l2[newp] = piece
-                parray[piece] = newp
+            self._insert(piece, l2, randrange(len(l2)+1))
             if self.removed_partials.has_key(piece):
                 del self.removed_partials[piece]
                 self.started.append(piece)
@@ -374,4 +457,70 @@ class PiecePicker:
         del self.seed_connections[connection]
         self.past_ips[connection.get_ip()] = olddl
         if self.seed_got_haves[olddl] == 1:
-            self.seed_got_haves[olddl] = 0
\ No newline at end of file
+            self.seed_got_haves[olddl] = 0
+
+
+def _set_bits(have):
+    """@returns:  the indices that are set in a Bitfield"""
+    return have.set_indices()
+
+if __name__ == "__main__":
+    #benchmark:  a 10k piece torrent with 200 peers, some of which use lazy bitfields
+    import random
+    from BitTorrent.bitfield import Bitfield
+
+    NUM_PIECES = 10000
+    NUM_PEERS = 200
+    NUM_REQUESTS = 20000
+    random.seed(0)
+    peers = []
+    for i in xrange(NUM_PEERS):
+        have = Bitfield(NUM_PIECES)
+        fraction = random.random()
+        #a quarter of the peers are seeds that pretend to be missing 1% of the pieces at first
+        if i % 4 == 0:
+            fraction = 1.0
+        for j in xrange(NUM_PIECES):
+            if random.random() < fraction:
+                have[j] = True
+        lazy = []
+        if have.complete():
+            lazy = random.sample(xrange(NUM_PIECES), NUM_PIECES / 100)
+            for j in lazy:
+                have[j] = False
+        peers.append((have, lazy))
+
+    picker = PiecePicker(NUM_PIECES)
+    startTime = time.time()
+    for have, lazy in peers:
+        picker.got_haves(have)
+        for j in lazy:
+            have[j] = True
+            picker.got_have(j)
+        if have.complete():
+            picker.became_seed()
+    connectTime = time.time() - startTime
+
+    wanted = [True] * NUM_PIECES
+    def want(piece):
+        return wanted[piece]
+    startTime = time.time()
+    for i in xrange(NUM_REQUESTS):
+        have = peers[random.randrange(NUM_PEERS)][0]
+        piece = picker.next(have, want)
+        if piece is not None and random.random() < 0.1:
+            wanted[piece] = False
+            picker.complete(piece)
+        picker.get_num_copies()
+    nextTime = time.time() - startTime
+
+    startTime = time.time()
+    for have, lazy in peers:
+        if have.complete():
+            picker.lost_seed()
+        else:
+            picker.lost_haves(have)
+    disconnectTime = time.time() - startTime
+    print "connect %d peers:  %.3f s" % (NUM_PEERS, connectTime)
+    print "%d x next() + get_num_copies():  %.3f s" % (NUM_REQUESTS, nextTime)
+    print "disconnect %d peers:  %.3f s" % (NUM_PEERS, disconnectTime)
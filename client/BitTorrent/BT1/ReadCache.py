@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""Cache of recently uploaded pieces, shared by every torrent"""
+
+from array import array
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+DEBUG = False
+
+class CachedPiece:
+    """Looks like the PieceBuffer that Storage.read returns, but belongs to the cache,
+    so release() does nothing.  Also a node in the cache's recency list.
+    data is an array, or a MappedPiece (see MappedStorage), whose slices are buffers."""
+    def __init__(self, data, key = None):
+        self.data = data
+        #: (owner, piece index)
+        self.key = key
+        #: neighbours in the recency list
+        self.prev = None
+        self.next = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getslice__(self, a, b):
+        return self.data[a:b]
+
+    def getarray(self):
+        if isinstance(self.data, array):
+            return self.data
+        return self.data.getarray()
+
+    def release(self):
+        pass
+
+class PieceReadCache:
+    """LRU cache of whole, checked pieces, with a budget in bytes.  When a peer asks
+    for any part of a piece, the whole piece is read (and cached), since other
+    parts of it are usually requested next, by that peer or others.
+    Only used from the reactor thread."""
+    def __init__(self, maxBytes = 32*1048576):
+        self.maxBytes = maxBytes
+        #: mapping from (owner, piece index) to CachedPiece
+        self.pieces = {}
+        #: sentinel for the recency list of self.pieces.  head.next is the most recently used
+        self.head = CachedPiece(None)
+        self.head.prev = self.head.next = self.head
+        self.cachedBytes = 0
+        #: mapping from owner to [hits, misses]
+        self.stats = {}
+
+    def get(self, owner, index):
+        """@returns:  the CachedPiece, or None if it is not cached"""
+        key = (owner, index)
+        piece = self.pieces.get(key)
+        stats = self.stats.setdefault(owner, [0, 0])
+        if piece is None:
+            stats[1] += 1
+            return None
+        stats[0] += 1
+        self._unlink(piece)
+        self._push_front(piece)
+        return piece
+
+    def _unlink(self, piece):
+        piece.prev.next = piece.next
+        piece.next.prev = piece.prev
+
+    def _push_front(self, piece):
+        piece.prev = self.head
+        piece.next = self.head.next
+        self.head.next.prev = piece
+        self.head.next = piece
+
+    def add(self, owner, index, data):
+        """@param data:  the whole piece, as an array or MappedPiece
+        @returns:  the CachedPiece"""
+        key = (owner, index)
+        piece = CachedPiece(data, key)
+        if len(data) > self.maxBytes:
+            return piece
+        if self.pieces.has_key(key):
+            self._remove(key)
+        #evict from the least recently used end
+        while self.pieces and self.cachedBytes + len(data) > self.maxBytes:
+            self._remove(self.head.prev.key)
+        self.pieces[key] = piece
+        self._push_front(piece)
+        self.cachedBytes += len(data)
+        return piece
+
+    def _remove(self, key):
+        piece = self.pieces.pop(key)
+        self._unlink(piece)
+        self.cachedBytes -= len(piece)
+
+    def forget(self, owner):
+        """Drop every piece from owner (eg, because the torrent was stopped)
+        @returns:  (hits, misses) for owner"""
+        for key in [key for key in self.pieces.keys() if key[0] is owner]:
+            self._remove(key)
+        return tuple(self.stats.pop(owner, [0, 0]))
+
+    def get_hit_rate(self, owner):
+        """@returns:  fraction of requests from owner that were served from the cache"""
+        hits, misses = self.stats.get(owner, [0, 0])
+        if hits + misses <= 0:
+            return 0.0
+        return float(hits) / float(hits + misses)
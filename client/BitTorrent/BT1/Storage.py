@@ -159,8 +159,12 @@ class Storage:
 
     def sync(self):
         # may raise IOError or OSError
-        for file in self.whandles.keys():
-            self._sync(file)
+        self.lock.acquire()
+        try:
+            for file in self.whandles.keys():
+                self._sync(file)
+        finally:
+            self.lock.release()
 
 
     def set_readonly(self, f=None):
@@ -168,8 +172,12 @@ class Storage:
             self.sync()
             return
         file = self.files[f][0]
-        if self.whandles.has_key(file):
-            self._sync(file)
+        self.lock.acquire()
+        try:
+            if self.whandles.has_key(file):
+                self._sync(file)
+        finally:
+            self.lock.release()
             
 
     def get_total_length(self):
@@ -321,10 +329,12 @@ class Storage:
             if DEBUG:
                 print 'writing '+file+' from '+str(pos)+' to '+str(end)
             self.lock.acquire()
-            h = self._get_file_handle(file, True)
-            h.seek(begin)
-            h.write(s[total: total + end - begin])
-            self.lock.release()
+            try:
+                h = self._get_file_handle(file, True)
+                h.seek(begin)
+                h.write(s[total: total + end - begin])
+            finally:
+                self.lock.release()
             total += end - begin
 
     def top_off(self):
@@ -344,6 +354,17 @@ class Storage:
             self.handles[file].flush()
             self.lock.release()
 
+    def fsync(self):
+        # may raise IOError or OSError
+        self.flush()
+        for file in self.whandles.keys():
+            self.lock.acquire()
+            try:
+                if self.handles.has_key(file):
+                    fsync(self.handles[file])
+            finally:
+                self.lock.release()
+
     def close(self):
         for file, f in self.handles.items():
             try:
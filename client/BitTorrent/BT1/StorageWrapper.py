@@ -2,6 +2,7 @@
 # see LICENSE.txt for license information
 
 from BitTorrent.bitfield import Bitfield
+from BitTorrent.BT1.MappedStorage import MappedPiece
 from sha import sha
 from BitTorrent.clock import clock
 from random import randrange
@@ -66,7 +67,8 @@ class StorageWrapper:
             piece_size, finished, failed, 
             statusfunc = dummy_status, flag = fakeflag(), check_hashes = True,
             data_flunked = lambda x: None, backfunc = None,
-            config = {}, unpauseflag = fakeflag(True) ):
+            config = {}, unpauseflag = fakeflag(True), hashcheck_pool = None,
+            write_cache = None, read_cache = None ):
         self.storage = storage
         self.request_size = long(request_size)
         self.hashes = hashes
@@ -81,6 +83,9 @@ class StorageWrapper:
         self.backfunc = backfunc
         self.config = config
         self.unpauseflag = unpauseflag
+        self.hashcheck_pool = hashcheck_pool
+        self.write_cache = write_cache
+        self.read_cache = read_cache
         
         self.alloc_type = config.get('alloc_type','normal')
         self.double_check = config.get('double_check', 0)
@@ -122,6 +127,12 @@ class StorageWrapper:
         self.write_buf_size = 0L
         self.write_buf = {}   # structure:  piece: [(start, data), ...]
         self.write_buf_list = []
+        self.hash_reorder_max = config.get('hash_reorder_size', 128)*1024L
+        self.piece_hashers = {}   # structure:  piece: [sha, next offset, {begin: data}, bytes held]
+        self.check_pooled = False   # whether hashcheck_pool is checking the existing data
+        self.check_pending = 0
+        if self.write_cache:
+            self.write_cache.register(storage, self._write_cache_failed)
 
         self.initialize_tasks = [
             ['checking existing data', 0, self.init_hashcheck, self.hashcheckfunc],
@@ -137,6 +148,8 @@ class StorageWrapper:
         self.backfunc(self._bgsync,max(self.config['auto_flush']*60,60))
 
     def old_style_init(self):
+        # results from the pool arrive through the reactor, which this loop blocks
+        self.hashcheck_pool = None
         while self.initialize_tasks:
             msg, done, init, next = self.initialize_tasks.pop(0)
             if init():
@@ -183,6 +196,9 @@ class StorageWrapper:
             msg, done, init, next = self.initialize_tasks.pop(0)
             if init():
                 self.initialize_status(activity = msg, fractionDone = done)
+                if self.check_pooled:
+                    # _hashcheck_results reports progress, and continues when the pool is done
+                    return
                 self.initialize_next = next
 
         self.backfunc(self._initialize, 0.01)
@@ -230,6 +246,8 @@ class StorageWrapper:
         self.check_numchecked = 0.0
         self.lastlen = self._piecelen(len(self.hashes) - 1)
         self.numchecked = 0.0
+        if self.check_total > 0 and self.check_hashes and self.hashcheck_pool:
+            self._hashcheck_start_pool()
         return self.check_total > 0
 
     def _markgot(self, piece, pos):
@@ -248,6 +266,11 @@ class StorageWrapper:
     def hashcheckfunc(self):
         if self.flag.isSet():
             return None
+        if self.check_pooled:
+            # the pool checks everything in the background, just report progress
+            if self.check_pending <= 0:
+                return None
+            return (self.numchecked / self.check_total)
         if not self.check_list:
             return None
         
@@ -267,24 +290,69 @@ class StorageWrapper:
             sh.update(d2[:])
             d2.release()
             s = sh.digest()
-            if s == self.hashes[i]:
-                self._markgot(i, i)
-            elif ( self.check_targets.get(s)
-                   and self._piecelen(i) == self._piecelen(self.check_targets[s][-1]) ):
-                self._markgot(self.check_targets[s].pop(), i)
-                self.out_of_place += 1
-            elif ( not self.have[-1] and sp == self.hashes[-1]
-                   and (i == len(self.hashes) - 1
-                        or not self._waspre(len(self.hashes) - 1)) ):
-                self._markgot(len(self.hashes) - 1, i)
-                self.out_of_place += 1
-            else:
-                self.places[i] = i
+            self._hashcheck_result(i, sp, s)
         self.numchecked += 1
         if self.amount_left == 0:
             self.finished()
         return (self.numchecked / self.check_total)
 
+    def _hashcheck_result(self, i, sp, s):
+        if s == self.hashes[i]:
+            self._markgot(i, i)
+        elif ( self.check_targets.get(s)
+               and self._piecelen(i) == self._piecelen(self.check_targets[s][-1]) ):
+            self._markgot(self.check_targets[s].pop(), i)
+            self.out_of_place += 1
+        elif ( not self.have[-1] and sp == self.hashes[-1]
+               and (i == len(self.hashes) - 1
+                    or not self._waspre(len(self.hashes) - 1)) ):
+            self._markgot(len(self.hashes) - 1, i)
+            self.out_of_place += 1
+        else:
+            self.places[i] = i
+
+    def _hashcheck_start_pool(self):
+        self.check_pooled = True
+        self.check_pending = self.check_total
+        self.check_failed = False
+        self.hashcheck_pool.check(self.storage, self.piece_size, self.check_list,
+                                  self._piecelen, self.lastlen,
+                                  self._hashcheck_results, self._hashcheck_failed,
+                                  self.flag)
+        self.check_list = []
+
+    def _hashcheck_results(self, results):
+        """called in the reactor thread with a batch of results from the pool"""
+        self.check_pending -= len(results)
+        if self.flag.isSet() or self.check_failed:
+            self._hashcheck_pool_done()
+            return
+        for i, sp, s in results:
+            if s is None:
+                continue
+            self._hashcheck_result(i, sp, s)
+            self.numchecked += 1
+        if self.check_pending > 0:
+            self.initialize_status(fractionDone = self.numchecked / self.check_total)
+            return
+        if self.amount_left == 0:
+            self.finished()
+        self._hashcheck_pool_done()
+
+    def _hashcheck_failed(self, e):
+        if self.check_failed:
+            return
+        self.check_failed = True
+        self.check_pending = 0
+        self.failed('IO Error: ' + str(e))
+        self._hashcheck_pool_done()
+
+    def _hashcheck_pool_done(self):
+        # the rest of the initialize tasks wait for this, instead of polling the pool
+        if self.check_pooled and self.check_pending <= 0:
+            self.check_pooled = False
+            self.backfunc(self._initialize)
+
 
     def init_movedata(self):
         if self.flag.isSet():
@@ -500,6 +568,8 @@ class StorageWrapper:
 
     def write_raw(self, index, begin, data):
         try:
+            if self.write_cache:
+                self.write_cache.flush_range(self.storage, self.piece_size * index + begin, len(data))
             self.storage.write(self.piece_size * index + begin, data)
             return True
         except IOError, e:
@@ -508,6 +578,13 @@ class StorageWrapper:
 
 
     def _write_to_buffer(self, piece, start, data):
+        if self.write_cache:
+            try:
+                self.write_cache.write(self.storage, self.piece_size * self.places[piece] + start, data)
+                return True
+            except IOError, e:
+                self.failed('IO Error: ' + str(e))
+                return False
         if not self.write_buf_max:
             return self.write_raw(self.places[piece], start, data)
         self.write_buf_size += len(data)
@@ -537,7 +614,32 @@ class StorageWrapper:
                 return False
         return True
 
+    def flush_write_cache(self):
+        if not self.write_cache:
+            return True
+        try:
+            self.write_cache.flush_range(self.storage)
+            return True
+        except IOError, e:
+            self.failed('IO Error: ' + str(e))
+            return False
+
+    def _write_cache_failed(self, e):
+        self.failed('IO Error: ' + str(e))
+
+    def close(self):
+        if self.write_cache:
+            try:
+                self.write_cache.unregister(self.storage)
+            except IOError, e:
+                self.failed('IO Error: ' + str(e))
+        if self.read_cache:
+            hits, misses = self.read_cache.forget(self)
+            if hits + misses > 0:
+                log_msg('read cache served %s of %s uploaded pieces' % (hits, hits + misses), 3)
+
     def sync(self):
+        self.flush_write_cache()
         spots = {}
         for p in self.write_buf_list:
             spots[self.places[p]] = p
@@ -656,7 +758,7 @@ class StorageWrapper:
             old = self.read_raw(self.places[index], begin, len(piece))
             if old is None:
                 return True
-            if old[:].tostring() != piece:
+            if old.getarray().tostring() != str(piece):
                 try:
                     self.failed_pieces[index][self.download_history[index][begin]] = 1
                 except:
@@ -664,8 +766,13 @@ class StorageWrapper:
             old.release()
         self.download_history.setdefault(index,{})[begin] = source
         
+        # piece may be a buffer into a whole chunk of received data (see Framing), and the
+        # write cache and hash reorder buffer keep it, so copy just the block
+        if isinstance(piece, buffer):
+            piece = str(piece)
         if not self._write_to_buffer(index, begin, piece):
             return True
+        self._hash_block(index, begin, piece)
         
         self.amount_obtained += len(piece)
         self.dirty.setdefault(index,[]).append((begin, len(piece)))
@@ -683,12 +790,17 @@ class StorageWrapper:
         if not self._flush_buffer(index):
             return True
         length = self._piecelen(index)
-        data = self.read_raw(self.places[index], 0, length,
-                                 flush_first = self.triple_check)
-        if data is None:
-            return True
-        hash = sha(data[:]).digest()
-        data.release()
+        hasher = self.piece_hashers.pop(index, None)
+        if hasher and hasher[1] == length and not self.triple_check:
+            hash = hasher[0].digest()
+        else:
+            # blocks came in too far out of order, or triple_check wants to see what is on disk
+            data = self.read_raw(self.places[index], 0, length,
+                                     flush_first = self.triple_check)
+            if data is None:
+                return True
+            hash = sha(data[:]).digest()
+            data.release()
         if hash != self.hashes[index]:
 
             self.amount_obtained -= length
@@ -730,6 +842,34 @@ class StorageWrapper:
         return True
 
 
+    def _hash_block(self, piece, begin, data):
+        # hash blocks in order as they arrive, so the piece does not have to be read back
+        # from disk to check it.  A few out of order blocks are held until the gap is filled.
+        if not self.hash_reorder_max:
+            return
+        hasher = self.piece_hashers.get(piece)
+        if hasher is None:
+            if self.piece_hashers.has_key(piece):
+                return      # already gave up on this piece
+            hasher = [sha(), 0, {}, 0]
+            self.piece_hashers[piece] = hasher
+        if begin == hasher[1]:
+            hasher[0].update(data)
+            hasher[1] += len(data)
+            held = hasher[2]
+            while held.has_key(hasher[1]):
+                data = held.pop(hasher[1])
+                hasher[3] -= len(data)
+                hasher[0].update(data)
+                hasher[1] += len(data)
+        elif ( begin > hasher[1] and not hasher[2].has_key(begin)
+               and hasher[3] + len(data) <= self.hash_reorder_max ):
+            hasher[2][begin] = data
+            hasher[3] += len(data)
+        else:
+            # too far out of order (or sent twice), read it back when it is complete
+            self.piece_hashers[piece] = None
+
     def request_lost(self, index, begin, length):
         assert not (begin, length) in self.inactive_requests[index]
         insort(self.inactive_requests[index], (begin, length))
@@ -744,6 +884,8 @@ class StorageWrapper:
     def get_piece(self, index, begin, length):
         if not self.have[index]:
             return None
+        if self.read_cache:
+            return self._get_cached_piece(index, begin, length)
         data = None
         if not self.waschecked[index]:
             data = self.read_raw(self.places[index], 0, self._piecelen(index))
@@ -770,12 +912,52 @@ class StorageWrapper:
         data = self.read_raw(self.places[index], begin, length)
         if data is None:
             return None
-        s = data.getarray()
+        if isinstance(data, MappedPiece):
+            # a buffer over the mapping, so the upload copies the data only once
+            s = data[0:length]
+        else:
+            s = data.getarray()
         data.release()
         return s
 
+    def _get_cached_piece(self, index, begin, length):
+        # the whole piece is read and cached, other peers probably want it too
+        piecelen = self._piecelen(index)
+        if length == -1:
+            if begin > piecelen:
+                return None
+            whole = begin == 0
+            length = piecelen-begin
+        elif begin + length > piecelen:
+            return None
+        else:
+            whole = False
+        piece = self.read_cache.get(self, index)
+        if piece is None:
+            data = self.read_raw(self.places[index], 0, piecelen)
+            if data is None:
+                return None
+            if not self.waschecked[index]:
+                if sha(data[:]).digest() != self.hashes[index]:
+                    data.release()
+                    self.failed('told file complete on start-up, but piece failed hash check')
+                    return None
+                self.waschecked[index] = True
+            if isinstance(data, MappedPiece):
+                # cache the MappedPiece itself, so uploads slice buffers straight out of
+                # the mapping.  MappedStorage detaches it if its data is overwritten
+                piece = self.read_cache.add(self, index, data)
+            else:
+                piece = self.read_cache.add(self, index, data.getarray())
+                data.release()
+        if whole:
+            return piece
+        return piece[begin:begin+length]
+
     def read_raw(self, piece, begin, length, flush_first = False):
         try:
+            if self.write_cache:
+                self.write_cache.flush_range(self.storage, self.piece_size * piece + begin, length)
             return self.storage.read(self.piece_size * piece + begin,
                                                      length, flush_first)
         except IOError, e:
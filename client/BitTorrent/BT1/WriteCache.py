@@ -0,0 +1,305 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""Write-back cache for downloaded data, shared by every torrent"""
+
+import os
+from cStringIO import StringIO
+from threading import Thread, Lock, Condition
+
+from twisted.internet import reactor
+
+from BitTorrent.clock import clock
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+DEBUG = False
+
+#: adjacent blocks are joined into writes of at most this many bytes
+MAX_RUN_SIZE = 1048576
+
+class WriteBackCache:
+    """Holds blocks that were written to any Storage until a background thread
+    writes them out.  Adjacent blocks are joined, so each flush is one large
+    write per run of data, done in offset order, and every file that was written
+    is fsynced once per flush instead of once per write.
+    Anything that reads or writes a Storage directly must call flush_range first
+    (StorageWrapper.read_raw and write_raw do).  That only waits for a write
+    (of at most MAX_RUN_SIZE) that overlaps the range, so reads of other data
+    (like pieces being uploaded) are not held up by the background thread.
+    At most maxBytes are cached or being written at once.  When the disk cannot
+    keep up, write stores the block itself instead of waiting for the background
+    thread, so the reactor is only ever held up by that one block."""
+    def __init__(self, maxBytes = 16*1048576, flushInterval = 5.0, fsync = True):
+        #: blocks are written through instead of cached while more than this is cached or being written.
+        #: The background thread starts writing right away once half of this is waiting
+        self.maxBytes = maxBytes
+        #: how long data may wait before the background thread writes it
+        self.flushInterval = flushInterval
+        #: whether to fsync after each flush
+        self.fsync = fsync
+        #: protects everything below
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)
+        #: notified whenever data that was being written has landed
+        self.written = Condition(self.lock)
+        #: mapping from Storage to {pos: data}
+        self.dirty = {}
+        #: mapping from Storage to a list with a list of (start, end) for each write that is in progress
+        self.inflight = {}
+        #: mapping from Storage to function called with IOErrors from the background thread
+        self.errfuncs = {}
+        self.dirtyBytes = 0L
+        #: how much of the data in self.inflight has not been written yet
+        self.inflightBytes = 0L
+        #: statistics:
+        self.bytesFlushed = 0L
+        self.numFlushes = 0
+        self.numWrites = 0
+        self.totalFlushTime = 0.0
+        self.lastFlushTime = 0.0
+        self.done = False
+        self.thread = Thread(target = self._run, name = "WriteBackCache")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def register(self, storage, errfunc):
+        self.lock.acquire()
+        self.dirty.setdefault(storage, {})
+        self.errfuncs[storage] = errfunc
+        self.lock.release()
+
+    def unregister(self, storage):
+        """Write anything left for storage, then forget about it
+        @raises IOError:  if the data could not be written"""
+        self.flush_range(storage)
+        self.lock.acquire()
+        if self.dirty.has_key(storage):
+            del self.dirty[storage]
+        if self.errfuncs.has_key(storage):
+            del self.errfuncs[storage]
+        self.lock.release()
+
+    def write(self, storage, pos, data):
+        """Cache data to be written to storage at pos
+        @raises IOError:  if the cache is full and the data could not be written"""
+        self.lock.acquire()
+        try:
+            blocks = self.dirty.setdefault(storage, {})
+            old = blocks.get(pos)
+            if old is not None:
+                self.dirtyBytes -= len(old)
+                del blocks[pos]
+            if self.done or self.dirtyBytes + self.inflightBytes + len(data) <= self.maxBytes:
+                blocks[pos] = data
+                self.dirtyBytes += len(data)
+                if self.dirtyBytes > self.maxBytes / 2:
+                    self.wakeup.notify()
+                return
+            #the disk is falling behind.  Rather than make the reactor wait for the
+            #background thread to catch up, write just this block now
+            self.wakeup.notify()
+        finally:
+            self.lock.release()
+        #anything cached for the same range must land first
+        self.flush_range(storage, pos, len(data))
+        storage.write(pos, data)
+        self.numWrites += 1
+        self.bytesFlushed += len(data)
+
+    def _is_inflight(self, storage, pos, end):
+        """@returns:  True if any part of [pos, end) of storage (or from pos onward, if
+        end is None) is being written.  Must hold self.lock"""
+        for ranges in self.inflight.get(storage, ()):
+            for start, stop in ranges:
+                if (end is None or start < end) and stop > pos:
+                    return True
+        return False
+
+    def _mark_inflight(self, storage, blocks):
+        """Note that blocks ({pos: data}) of storage are being written.  Each run of
+        adjacent blocks (up to MAX_RUN_SIZE) is tracked separately, so a reader only
+        waits for the run that it overlaps.
+        @returns:  list of (ranges, {pos: data}) for each run, in order, for _write_blocks.
+        Must hold self.lock"""
+        runs = []
+        if not blocks:
+            return runs
+        inflight = self.inflight.setdefault(storage, [])
+        positions = blocks.keys()
+        positions.sort()
+        for pos in positions:
+            data = blocks[pos]
+            if runs:
+                ranges, runBlocks = runs[-1]
+                start, end = ranges[0]
+            if runs and end == pos and end - start + len(data) <= MAX_RUN_SIZE:
+                ranges[0] = (start, pos + len(data))
+            else:
+                ranges, runBlocks = [(pos, pos + len(data))], {}
+                inflight.append(ranges)
+                runs.append((ranges, runBlocks))
+            runBlocks[pos] = data
+            self.inflightBytes += len(data)
+        return runs
+
+    def _unmark_inflight(self, storage, ranges):
+        self.lock.acquire()
+        try:
+            inflight = self.inflight[storage]
+            for i in range(len(inflight)):
+                if inflight[i] is ranges:
+                    del inflight[i]
+                    break
+            if not inflight:
+                del self.inflight[storage]
+            for start, end in ranges:
+                self.inflightBytes -= end - start
+            self.written.notifyAll()
+        finally:
+            self.lock.release()
+
+    def flush_range(self, storage, pos = 0, length = None):
+        """Make sure that nothing cached overlaps [pos, pos+length) of storage (or
+        all of storage if length is None, which is also fsynced), writing it out if
+        necessary.  Only waits for the background thread if it is writing part of the range.
+        @raises IOError:  if the data could not be written"""
+        if length is None:
+            end = None
+        else:
+            end = pos + length
+        self.lock.acquire()
+        try:
+            #anything in the range that is already being written must land first
+            while self._is_inflight(storage, pos, end):
+                self.written.wait()
+            blocks = self.dirty.get(storage)
+            if not blocks:
+                return
+            if end is None:
+                overlapping = blocks.keys()
+            else:
+                overlapping = [start for start, data in blocks.iteritems()
+                               if start < end and start + len(data) > pos]
+            if not overlapping:
+                return
+            taken = {}
+            for start in overlapping:
+                taken[start] = blocks.pop(start)
+                self.dirtyBytes -= len(taken[start])
+            runs = self._mark_inflight(storage, taken)
+        finally:
+            self.lock.release()
+        self._write_blocks(storage, runs, False, end is None)
+
+    def _flush(self):
+        """Write everything that is cached, one Storage at a time, so that
+        flush_range for the others need not wait.  Called by the background thread."""
+        self.lock.acquire()
+        storages = [storage for storage, blocks in self.dirty.iteritems() if blocks]
+        self.lock.release()
+        for storage in storages:
+            self.lock.acquire()
+            try:
+                #a block that flush_range is writing might be rewritten, and the new data must land last
+                while self.inflight.has_key(storage):
+                    self.written.wait()
+                blocks = self.dirty.get(storage)
+                if not blocks:
+                    continue
+                self.dirty[storage] = {}
+                for data in blocks.itervalues():
+                    self.dirtyBytes -= len(data)
+                runs = self._mark_inflight(storage, blocks)
+            finally:
+                self.lock.release()
+            self._write_blocks(storage, runs, True, True)
+
+    def _write_blocks(self, storage, runs, reportErrors, fsync):
+        """Write each run from _mark_inflight to storage, and stop treating it as in flight"""
+        startTime = clock()
+        try:
+            runs = list(runs)
+            try:
+                while runs:
+                    ranges, blocks = runs[0]
+                    for pos, data in _coalesce(blocks):
+                        storage.write(pos, data)
+                        self.numWrites += 1
+                        self.bytesFlushed += len(data)
+                    del runs[0]
+                    #readers can have it now, they do not need to wait for the rest, or the fsync
+                    self._unmark_inflight(storage, ranges)
+            finally:
+                for ranges, blocks in runs:
+                    self._unmark_inflight(storage, ranges)
+            if fsync and self.fsync:
+                storage.fsync()
+        except (IOError, OSError), e:
+            if not reportErrors:
+                raise IOError(str(e))
+            errfunc = self.errfuncs.get(storage)
+            if errfunc:
+                reactor.callFromThread(errfunc, e)
+            else:
+                log_ex(e, "Failed to write cached data")
+        self.lastFlushTime = clock() - startTime
+        self.totalFlushTime += self.lastFlushTime
+        self.numFlushes += 1
+        if DEBUG:
+            print 'flushed in %.3f seconds' % (self.lastFlushTime)
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            if not self.done and self.dirtyBytes <= self.maxBytes / 2:
+                self.wakeup.wait(self.flushInterval)
+            done = self.done
+            self.lock.release()
+            try:
+                self._flush()
+            except Exception, e:
+                log_ex(e, "Unhandled error while flushing cached data")
+            if done:
+                return
+
+    def get_stats(self):
+        if self.numFlushes:
+            averageFlushTime = self.totalFlushTime / self.numFlushes
+        else:
+            averageFlushTime = 0.0
+        return {'dirty_bytes': self.dirtyBytes, 'inflight_bytes': self.inflightBytes, 'bytes_flushed': self.bytesFlushed,
+                'flushes': self.numFlushes, 'writes': self.numWrites,
+                'last_flush_time': self.lastFlushTime, 'average_flush_time': averageFlushTime}
+
+    def stop(self):
+        """Write everything out and stop the background thread"""
+        self.lock.acquire()
+        self.done = True
+        self.wakeup.notify()
+        self.written.notifyAll()
+        self.lock.release()
+        self.thread.join()
+
+def _coalesce(blocks):
+    """@param blocks:  mapping from position to data
+    @returns:  list of (position, data), in order, with adjacent blocks joined.
+    Blocks may be buffer objects (see Framing), which str.join does not accept."""
+    runs = []
+    positions = blocks.keys()
+    positions.sort()
+    for pos in positions:
+        data = blocks[pos]
+        if runs and runs[-1][0] + runs[-1][1] == pos:
+            runs[-1][1] += len(data)
+            runs[-1][2].append(data)
+        else:
+            runs.append([pos, len(data), [data]])
+    coalesced = []
+    for pos, length, pieces in runs:
+        if len(pieces) == 1:
+            coalesced.append((pos, pieces[0]))
+            continue
+        data = StringIO()
+        for piece in pieces:
+            data.write(piece)
+        coalesced.append((pos, data.getvalue()))
+    return coalesced
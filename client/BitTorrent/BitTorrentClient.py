@@ -83,7 +83,21 @@ defaults.extend( [
     "Number of seconds before a peer connection is closed from inactivity" ),
   #TODO:  move to IOCP reactor for windows and EPoll for linux, then we wont need to limit connections so much
   ( 'global_connection_limit', 800,
-    "No more than this many connections to peers may be opened ever, regardless of how many torrents there are" )
+    "No more than this many connections to peers may be opened ever, regardless of how many torrents there are" ),
+  ( 'max_hashchecks', 4,
+    "Maximum number of torrents that may check their existing data at the same time" ),
+  ( 'hashcheck_threads', 2,
+    "Number of threads used to check existing data (0 = check one piece at a time in the main thread)" ),
+  ( 'hashcheck_read_size', 4,
+    "Maximum MB of consecutive pieces to read from disk at once while checking existing data" ),
+  ( 'write_cache_size', 16,
+    "Maximum MB of downloaded data (from all torrents) to hold in memory while it waits to be written to disk.  Downloading waits for the disk when this is full (0 = use a separate write_buffer_size buffer for each torrent)" ),
+  ( 'write_cache_flush_interval', 5.0,
+    "Maximum number of seconds that downloaded data waits in the write cache" ),
+  ( 'write_cache_fsync', 1,
+    "Whether to fsync files after each flush of the write cache" ),
+  ( 'read_cache_size', 32,
+    "MB of recently uploaded pieces (from all torrents) to keep in memory (0 = read every upload from disk)" )
 ] )
 
 #How many peer connections to put on a single circuit by default.
@@ -739,14 +753,28 @@ class BitTorrentClient(BitBlinder.BitBlinderApplication, GeneratorMixin.Generato
     @param data:  the torrent data
     @type  data:  dictionary"""
     self.TorrentDataBuffer[torrent] = data
+    #write to a temporary file first, so a crash while saving (this happens periodically
+    #for fast resume) cannot leave a truncated record behind
+    fileName = os.path.join(self.dir_datacache, tohex(torrent))
+    tempName = fileName + ".tmp"
+    f = None
     try:
-      f = open(os.path.join(self.dir_datacache, tohex(torrent)),'wb')
+      f = open(tempName, 'wb')
       f.write(bencode(data))
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+      f = None
+      #cannot rename over an existing file on windows
+      if System.IS_WINDOWS and os.path.exists(fileName):
+        os.remove(fileName)
+      os.rename(tempName, fileName)
       success = True
     except:
       success = False
     try:
-      f.close()
+      if f:
+        f.close()
     except:
       pass
     if not success:
@@ -1,78 +1,104 @@
 # Written by Bram Cohen, Uoti Urpala, and John Hoffman
 # see LICENSE.txt for license information
 
-try:
-    sum([1])
-    negsum = lambda a: len(a)-sum(a)
-except:
-    negsum = lambda a: reduce(lambda x,y: x+(not y), a, 0)
-    
-def _int_to_booleans(x):
-    r = []
-    for i in range(8):
-        r.append(bool(x & 0x80))
-        x <<= 1
-    return tuple(r)
+from array import array
 
-lookup_table = []
-reverse_lookup_table = {}
-for i in xrange(256):
-    x = _int_to_booleans(i)
-    lookup_table.append(x)
-    reverse_lookup_table[x] = chr(i)
+#: number of bits set in each byte value
+popcount_table = [sum([(x >> b) & 1 for b in xrange(8)]) for x in xrange(256)]
+#: for each byte value, the offsets (from the most significant bit) of the bits that are set
+offsets_table = [tuple([b for b in xrange(8) if x & (0x80 >> b)]) for x in xrange(256)]
 
 
 class Bitfield:
+    """The pieces that a peer has, packed 8 to a byte in the same order as the
+    bitfield message, so tostring and parsing are just copies"""
     def __init__(self, length = None, bitstring = None, copyfrom = None):
         if copyfrom is not None:
             self.length = copyfrom.length
-            self.array = copyfrom.array[:]
+            self.bits = array('B', copyfrom.bits)
             self.numfalse = copyfrom.numfalse
             return
         if length is None:
             raise ValueError, "length must be provided unless copying from another array"
         self.length = length
+        numbytes = (length + 7) / 8
         if bitstring is not None:
-            extra = len(bitstring) * 8 - length
-            if extra < 0 or extra >= 8:
+            if len(bitstring) != numbytes:
                 raise ValueError
-            t = lookup_table
-            r = []
-            for c in bitstring:
-                r.extend(t[ord(c)])
-            if extra > 0:
-                if r[-extra:] != [0] * extra:
-                    raise ValueError
-                del r[-extra:]
-            self.array = r
-            self.numfalse = negsum(r)
+            self.bits = array('B', bitstring)
+            extra = numbytes * 8 - length
+            if extra and self.bits[-1] & ((1 << extra) - 1):
+                raise ValueError
+            t = popcount_table
+            self.numfalse = length - sum([t[x] for x in self.bits])
         else:
-            self.array = [False] * length
+            self.bits = array('B', [0]) * numbytes
             self.numfalse = length
 
     def __setitem__(self, index, val):
-        val = bool(val)
-        self.numfalse += self.array[index]-val
-        self.array[index] = val
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError, "bitfield index out of range"
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if val:
+            if not byte & mask:
+                self.bits[index >> 3] = byte | mask
+                self.numfalse -= 1
+        elif byte & mask:
+            self.bits[index >> 3] = byte & ~mask
+            self.numfalse += 1
 
     def __getitem__(self, index):
-        return self.array[index]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError, "bitfield index out of range"
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
 
     def __len__(self):
         return self.length
 
     def tostring(self):
-        booleans = self.array
-        t = reverse_lookup_table
-        s = len(booleans) % 8
-        r = [ t[tuple(booleans[x:x+8])] for x in xrange(0, len(booleans)-s, 8) ]
-        if s:
-            r += t[tuple(booleans[-s:] + ([0] * (8-s)))]
-        return ''.join(r)
+        return self.bits.tostring()
 
     def complete(self):
         return not self.numfalse
 
+    def count(self):
+        """@returns:  the number of bits that are set"""
+        return self.length - self.numfalse
+
+    def set_indices(self):
+        """@returns:  list of the indices that are set, in order"""
+        r = []
+        t = offsets_table
+        base = 0
+        for byte in self.bits:
+            if byte:
+                r.extend([base + b for b in t[byte]])
+            base += 8
+        return r
+
+    def difference_indices(self, other):
+        """@returns:  list of the indices that are set here, but not in other
+        (eg, the pieces that a peer has and we do not)"""
+        r = []
+        t = offsets_table
+        base = 0
+        for byte, otherbyte in zip(self.bits, other.bits):
+            byte &= ~otherbyte
+            if byte:
+                r.extend([base + b for b in t[byte & 0xFF]])
+            base += 8
+        return r
+
+    def intersection_count(self, other):
+        """@returns:  the number of indices that are set in both"""
+        t = popcount_table
+        return sum([t[a & b] for a, b in zip(self.bits, other.bits)])
+
 
 def test_bitfield():
     try:
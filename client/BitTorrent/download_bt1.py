@@ -7,6 +7,7 @@ from urlparse import urlparse
 from BT1.btformats import check_message
 from BT1.Choker import Choker
 from BT1.Storage import Storage
+from BT1.MappedStorage import MappedStorage
 from BT1.StorageWrapper import StorageWrapper
 from BT1.FileSelector import FileSelector
 from BT1.Uploader import UploadPeer
@@ -152,6 +153,9 @@ defaults = [
         "whether to enable extra security features intended to prevent abuse"),
     ('auto_kick', 1,
         "whether to allow the client to automatically kick/ban peers that send bad data"),
+    ('hash_reorder_size', 128,
+        'kB of out of order blocks to hold per piece so downloaded pieces can be ' +
+        'hashed as they arrive (0 = read every piece back from disk to check it)'),
     ('double_check', 1,
         "whether to double-check data being written to the disk for errors (may increase CPU load)"),
     ('triple_check', 0,
@@ -160,8 +164,17 @@ defaults = [
         "whether to lock files the client is working with"),
     ('lock_while_reading', 0,
         "whether to lock access to files being read"),
+    ('use_mmap', 0,
+        "whether to read and write files through memory mapped windows instead of file handles"),
+    ('mmap_window_size', 16,
+        "size of each memory mapped window of a file, in megabytes (if use_mmap is set)"),
+    ('mmap_max_windows', 16,
+        "the maximum number of memory mapped windows to keep open at a time (if use_mmap is set)"),
     ('auto_flush', 0,
         "minutes between automatic flushes to disk (0 = disabled)"),
+    ('resume_save_interval', 300,
+        "seconds between saving fast resume data while running, so existing data does not " +
+        "have to be checked again after a crash (0 = only save on shutdown)"),
     ('dedicated_seed_id', '',
         "code to send to tracker identifying as a dedicated seed"),
     ]
@@ -288,6 +301,7 @@ class Torrent:
       if self.checking or self.working:
         if self.checkingHash or self.started:
           self.storagewrapper.sync()
+          self.storagewrapper.close()
           self.storage.close()
           d = self.stop_rerequest(force)
         if self.fileselector and self.started:
@@ -295,6 +309,11 @@ class Torrent:
             self.fileselector.finish()
             #TODO:  I'm pretty sure priority doesnt get saved here anymore, and that nothing passes a torrentData
             torrentdata['resume data'] = self.fileselector.pickle()
+        elif not self.started and not self.failed:
+          #stopped before the data was modified, so the old record is still good
+          old = self.appdataobj.getTorrentData(self.infohash)
+          if old and 'resume data' in old:
+            torrentdata['resume data'] = old['resume data']
         shouldWriteData = self.started or not self.doneflag.set()
         if shouldWriteData:
           try:
@@ -423,6 +442,8 @@ class Torrent:
                  self.config['round_robin_period'] *
                                      self.info['piece length'] / 200000 ) )
         self.rerequest_complete()
+        #so a restart comes straight back as a seed
+        self.save_resume_data()
         self.finfunc()
 #        #TODO:  implement better seeding GUI, so we can ask people if they want to keep seeding instead of just pausing:
 #        self.Pause()
@@ -477,7 +498,11 @@ class Torrent:
 
         try:
             try:
-                self.storage = Storage(self.files, self.info['piece length'],
+                if self.config['use_mmap']:
+                    storageClass = MappedStorage
+                else:
+                    storageClass = Storage
+                self.storage = storageClass(self.files, self.info['piece length'],
                                        self.doneflag, self.config, disabled_files)
             except IOError, e:
                 #self.errorfunc('trouble accessing files - ' + str(e))
@@ -490,7 +515,8 @@ class Torrent:
                 self.pieces, self.info['piece length'], self._finished, self._failed,
                 statusfunc, self.doneflag, self.config['check_hashes'],
                 self._data_flunked, self.rawserver.add_task,
-                self.config, self.unpauseflag)
+                self.config, self.unpauseflag, self.controller.hashcheck_pool,
+                self.controller.write_cache, self.controller.read_cache)
             
         except ValueError, e:
             self._failed('bad data - ' + str(e))
@@ -624,8 +650,32 @@ class Torrent:
             self.set_super_seed()
 
         self.started = True
+        if self.selector_enabled and self.config['resume_save_interval'] > 0:
+            self.rawserver.add_task(self._save_resume_data_task, self.config['resume_save_interval'])
         return True
 
+    def _save_resume_data_task(self):
+        if self.doneflag.isSet():
+            return
+        self.save_resume_data()
+        self.rawserver.add_task(self._save_resume_data_task, self.config['resume_save_interval'])
+
+    def save_resume_data(self):
+        """Write the fast resume record (have bitfield, partial pieces, and file sizes
+        and modification times) for the current state, after flushing everything to disk.
+        Files that are modified after this get checked again on the next start."""
+        if self.doneflag.isSet() or not self.started or self.failed or not self.fileselector:
+            return
+        self.storagewrapper.sync()
+        if self.failed:
+            return
+        torrentdata = {'pause flag': self.unpauseflag.isSet(),
+                       'resume data': self.fileselector.pickle()}
+        try:
+            self.appdataobj.writeTorrentData(self.infohash, torrentdata)
+        except Exception, e:
+            log_ex(e, "Failed to save fast resume data")
+
     def rerequest_complete(self):
         if self.rerequest:
             self.rerequest.finish()
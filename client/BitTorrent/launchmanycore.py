@@ -13,6 +13,9 @@ from natpunch import UPnP_test
 from random import seed
 from socket import error as socketerror
 from threading import Event
+from BT1.HashChecker import HashCheckPool
+from BT1.WriteCache import WriteBackCache
+from BT1.ReadCache import PieceReadCache
 from sys import argv, exit
 import sys, os
 from clock import clock
@@ -58,7 +61,24 @@ class LaunchMany:
             self.doneflag = Event()
 
             self.hashcheck_queue = []
-            self.hashcheck_current = None
+            #: torrents that are checking their existing data right now
+            self.hashcheck_active = []
+            #: when each active torrent started checking, for the throughput log
+            self.hashcheck_start_times = {}
+            self.hashcheck_pool = None
+            if config['hashcheck_threads'] > 0:
+                self.hashcheck_pool = HashCheckPool(config['hashcheck_threads'],
+                                                    config['hashcheck_read_size']*1048576)
+            #: downloaded data from every torrent waits here to be written
+            self.write_cache = None
+            if config['write_cache_size'] > 0:
+                self.write_cache = WriteBackCache(config['write_cache_size']*1048576,
+                                                  config['write_cache_flush_interval'],
+                                                  config['write_cache_fsync'])
+            #: pieces that were recently uploaded, from every torrent
+            self.read_cache = None
+            if config['read_cache_size'] > 0:
+                self.read_cache = PieceReadCache(config['read_cache_size']*1048576)
             
             self.rawserver = JashRawServer()
             upnp_type = UPnP_test(config['upnp_nat_access'])
@@ -107,12 +127,17 @@ class LaunchMany:
       @type force: bool
       Note: force is mainly just passed through to the rerequester atm, but this should be used elsewhere too"""
       self.hashcheck_queue = []
+      if self.hashcheck_pool:
+          self.hashcheck_pool.stop()
       dList = []
       for hash in self.torrent_list:
           d = self.downloads[hash].shutdown(force=force)
           if d:
             dList.append(d)
       dList.append(self.rawserver.shutdown())
+      if self.write_cache:
+          log_msg("Write cache stats:  %s" % (self.write_cache.get_stats()), 3)
+          self.write_cache.stop()
       if self.dht:
         self.dht.stop()
       if self.scanEvent and self.scanEvent.active():
@@ -300,19 +325,29 @@ class LaunchMany:
     def hashchecksched(self, hash = None):
         if hash:
             self.hashcheck_queue.append(hash)
-        if not self.hashcheck_current:
+        while self.hashcheck_queue and len(self.hashcheck_active) < max(1, self.config['max_hashchecks']):
             self._hashcheck_start()
 
     def _hashcheck_start(self):
-        self.hashcheck_current = self.hashcheck_queue.pop(0)
-        self.downloads[self.hashcheck_current].hashcheck_start(self.hashcheck_callback)
+        hash = self.hashcheck_queue.pop(0)
+        self.hashcheck_active.append(hash)
+        self.hashcheck_start_times[hash] = clock()
+        def done():
+            self.hashcheck_callback(hash)
+        self.downloads[hash].hashcheck_start(done)
 
-    def hashcheck_callback(self):
-        self.downloads[self.hashcheck_current].hashcheck_callback()
-        if self.hashcheck_queue:
-            self._hashcheck_start()
-        else:
-            self.hashcheck_current = None
+    def hashcheck_callback(self, hash):
+        self._hashcheck_finished(hash)
+        self.downloads[hash].hashcheck_callback()
+        self.hashchecksched()
+
+    def _hashcheck_finished(self, hash):
+        if hash in self.hashcheck_active:
+            self.hashcheck_active.remove(hash)
+        startTime = self.hashcheck_start_times.pop(hash, None)
+        if startTime is not None and self.hashcheck_pool:
+            log_msg("Finished checking %s in %.1f seconds (%.1f MB/s overall)" % \
+                    (Basic.clean(self.downloads[hash].getFilename()), clock() - startTime, self.hashcheck_pool.get_throughput()), 3)
 
     def died(self, hash):
         if hash in self.torrent_cache:
@@ -323,10 +358,10 @@ class LaunchMany:
     def was_stopped(self, hash):
         if hash in self.hashcheck_queue:
             self.hashcheck_queue.remove(hash)
-        if self.hashcheck_current == hash:
-            self.hashcheck_current = None
-            if self.hashcheck_queue:
-                self._hashcheck_start()
+        if hash in self.hashcheck_active:
+            self.hashcheck_active.remove(hash)
+            self.hashcheck_start_times.pop(hash, None)
+            self.hashchecksched()
 
     def failed(self, s):
         log_ex(s, 'generic BitTornado failure')
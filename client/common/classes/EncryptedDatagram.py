@@ -1,17 +1,11 @@
 #!/usr/bin/python
 
-import types
 import os
-import hmac
 import struct
-import cStringIO
-from hashlib import sha256
-
-from M2Crypto import EVP
 
 from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
 from common import Globals
-from common.utils import Basic
+from common.classes import StreamCipher
 
 IV_LENGTH = 16
 MESSAGE_FORMAT = "!%ss"%(Globals.SYMMETRIC_KEY_BYTES) 
@@ -31,6 +25,9 @@ class SymmetricKey():
     @type authBlob: binary packed by self.pack()"""
     self.alg = 'aes_256_cfb'
     self.key = key
+    #: the StreamCipher.  Kept if make_sym_key is called again, but rekeying it
+    #: creates new cipher contexts and (since the hmac key changes too) a new hmac context
+    self.stream = None
   
   def make_sym_key(self, randomData=None):
     if not randomData:
@@ -39,13 +36,13 @@ class SymmetricKey():
       self.randomData = randomData
     self.hmacKey = self.randomData
     self.iv = self.randomData[:IV_LENGTH]
-    self.decryptCipher = EVP.Cipher(self.alg, self.randomData, self.iv, 0)
-    self.encryptCipher = EVP.Cipher(self.alg, self.randomData, self.iv, 1)
+    if self.stream:
+      self.stream.rekey(self.randomData, self.iv, self.hmacKey)
+    else:
+      self.stream = StreamCipher.StreamCipher(self.randomData, self.iv, self.hmacKey, self.alg)
       
   def reset(self):
-    #self.key.IV = self.iv
-    self.decryptCipher = EVP.Cipher(self.alg, self.randomData, self.iv, 0)
-    self.encryptCipher = EVP.Cipher(self.alg, self.randomData, self.iv, 1)
+    self.stream.reset()
   
   def pack(self):
     return struct.pack(MESSAGE_FORMAT, self.randomData)
@@ -62,7 +59,7 @@ class SymmetricKey():
   def make_hmac(self, msg):
     """creates an hmac out of msg using key
     @msg: message to mac"""
-    return hmac.new(self.hmacKey, msg, sha256).digest()
+    return self.stream.make_hmac(msg)
 
 class ClientSymKey(SymmetricKey):
   def __init__(self, key):
@@ -70,65 +67,32 @@ class ClientSymKey(SymmetricKey):
     self.make_sym_key()
     
   def encrypt(self, msg):
-    Basic.validate_type(msg, types.StringType)
-    #make hmac
-    mac = self.make_hmac(msg)
-    inbuf = cStringIO.StringIO(mac + msg)
-    outbuf = cStringIO.StringIO()
-    outbuf.write(self.encryptCipher.update(inbuf.read()))
-    outbuf.write(self.encryptCipher.final()) #no idea what this does because it is undocumented
     encryptedKeyConstructor = self.key.encrypt(self.randomData)
     encryptedKeyConstructor = struct.pack('!%ss'% BANK_KEY_LENGTH, encryptedKeyConstructor)
-    msg = encryptedKeyConstructor+outbuf.getvalue()
-    return msg
+    return encryptedKeyConstructor + self.stream.encrypt(msg)
     
   def decrypt(self, msg):
-    Basic.validate_type(msg, types.StringType)
-    #decrypt the message
-    inbuf = cStringIO.StringIO(msg)
-    outbuf = cStringIO.StringIO()
-    outbuf.write(self.decryptCipher.update(inbuf.read()))
-    outbuf.write(self.decryptCipher.final())
-    msg = outbuf.getvalue()
-    mac = msg[:32]
-    msg = msg[32:]
-    #validate the HMAC
-    if self.make_hmac(msg) != mac:
-      raise Exception('HMAC does not authenticate, is something bad going on?')
-    return msg
+    return self.stream.decrypt(msg)
     
 class ServerSymKey(SymmetricKey):
+  """Decrypts datagrams from ClientSymKeys.  Each datagram carries its own key, so
+  every datagram needs new cipher and hmac contexts, but the same ServerSymKey can be
+  used to decrypt any number of them, and the payload is decrypted without copying it."""
   def __init__(self, key):
     SymmetricKey.__init__(self, key)
     
   def encrypt(self, msg):
     """expects decrypt to be called first to initialize the keys"""
-    Basic.validate_type(msg, types.StringType)
-    #make hmac
-    mac = self.make_hmac(msg)
-    inbuf = cStringIO.StringIO(mac + msg)
-    outbuf = cStringIO.StringIO()
-    outbuf.write(self.encryptCipher.update(inbuf.read()))
-    outbuf.write(self.encryptCipher.final()) #no idea what this does because it is undocumented
-    return outbuf.getvalue()
+    return self.stream.encrypt(msg)
     
   def decrypt(self, msg):
-    Basic.validate_type(msg, types.StringType)
-    #decrypt the message
-    encRandomData, msg = Basic.read_message('!%ss'%( BANK_KEY_LENGTH), msg)
-    randomData = self.key.decrypt(encRandomData[0])
+    """@type msg:  string or buffer"""
+    if len(msg) < BANK_KEY_LENGTH:
+      raise Exception("Message too short:  %s bytes" % (len(msg)))
+    randomData = self.key.decrypt(msg[:BANK_KEY_LENGTH])
     self.make_sym_key(randomData)
-    inbuf = cStringIO.StringIO(msg)
-    outbuf = cStringIO.StringIO()
-    outbuf.write(self.decryptCipher.update(inbuf.read()))
-    outbuf.write(self.decryptCipher.final())
-    msg = outbuf.getvalue()
-    mac = msg[:32]
-    msg = msg[32:]
-    #validate the HMAC
-    if self.make_hmac(msg) != mac:
-      raise Exception('HMAC does not authenticate, is something bad going on?')
-    return msg
+    #decrypt the rest of the message without copying it
+    return self.stream.decrypt(buffer(msg, BANK_KEY_LENGTH))
 
 if __name__=="__main__":
   from common.classes import PrivateKey
@@ -143,3 +107,7 @@ if __name__=="__main__":
   msg = bkey.encrypt(msg)
   msg = ckey.decrypt(msg)
   print msg
+  #the same server key can decrypt datagrams from any number of clients
+  for i in range(3):
+    ckey = ClientSymKey(key)
+    print bkey.decrypt(ckey.encrypt('datagram %s' % (i)))
@@ -58,7 +58,8 @@ class Logger:
       self.logFiles[logName] = open(os.path.join(Globals.LOG_FOLDER, fileName), 'wb')
       if logName in self.tempLogs:
         self.logFiles[logName].write(self.tempLogs[logName])
-        self.loggingEventLevels[logName] = self.DEFAULT_LOG_CUTOFF
+        #dont override a level that was configured for this log
+        self.loggingEventLevels.setdefault(logName, self.DEFAULT_LOG_CUTOFF)
         self.tempLogs[logName] = ""
     if None in self.tempLogs:
       self.logFiles[defaultLogName].write(self.tempLogs[None])
@@ -73,6 +74,14 @@ class Logger:
     for logName, level in loggingEventLevels.iteritems():
       self.loggingEventLevels[logName] = level
 
+  def is_logging(self, debugval=0, log=None):
+    """@returns:  whether log_msg would log a message with this debugval to log.
+    Lets callers skip formatting messages that would just be thrown away."""
+    currentLevel = self.loggingEventLevels.get(log, self.DEFAULT_LOG_CUTOFF)
+    if currentLevel is None:
+      return False
+    return currentLevel >= debugval
+
   def log_msg(self, msg, debugval=0, log=None, popLevels=0):
     """logs a message (msg) to both the console and a file (determined by log) if
     debugval is greater than the current logging level.  Is thread safe."""
@@ -46,6 +46,22 @@ class PrivateKey(PublicKey.PublicKey):
     else:
       return M2Crypto.m2.rsa_private_decrypt(self.key.rsa, msg, M2Crypto.RSA.no_padding)
     
+  def decrypt_batch(self, msgs):
+    """Decrypt many blinded messages without padding, as the bank does when
+    signing ACoins.  OpenSSL already uses the CRT parameters of the key for
+    each private key operation, so this just avoids the per-call overhead.
+    @param msgs: messages to be decrypted
+    @type msgs: list of strings
+    @return: list of decrypted strings"""
+    rsa = self.key.rsa
+    decrypt = M2Crypto.m2.rsa_private_decrypt
+    noPadding = M2Crypto.RSA.no_padding
+    results = []
+    for msg in msgs:
+      Basic.validate_type(msg, types.StringType)
+      results.append(decrypt(rsa, msg, noPadding))
+    return results
+    
   def sign(self, msg):
     """Sign the msg with key, return the result as string"""
     return self.key.sign(Crypto.make_hash(msg), 'sha256')
@@ -79,3 +95,10 @@ if __name__ == "__main__":
   result = k.encrypt(unblindedSig, False)
   print msg
   print result[-len(msg):]
+  #the same thing, for a batch of messages:
+  msgs = ["hello %s" % (i) for i in range(100)]
+  factors = k.get_blinding_factors(40*8, len(msgs))
+  sigs = k.decrypt_batch(k.blind_batch(msgs, factors))
+  unblindedSigs = k.unblind_batch(sigs, factors)
+  for msg, unblindedSig in zip(msgs, unblindedSigs):
+    assert k.encrypt(unblindedSig, False)[-len(msg):] == msg
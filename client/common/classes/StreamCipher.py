@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# Copyright 2009 Innominet
+"""Encryption and hmac contexts for the symmetric message formats (see SymmetricKey
+and EncryptedDatagram).  The hmac key schedule is done once per key, cipher contexts
+are only created for the direction that is actually used after each reset, and
+messages are never copied through intermediate buffers.  Also accepts buffer objects,
+so callers can decrypt part of a larger message without slicing it first."""
+
+import os
+import hmac
+import struct
+from hashlib import sha256
+
+from M2Crypto import EVP
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+#: length of the sha256 hmac that is prepended to every message
+HMAC_LENGTH = 32
+#: length of the random IV at the start of every sealed message
+SEAL_IV_LENGTH = 16
+#: cipher used for every message
+DEFAULT_ALG = 'aes_256_cfb'
+
+class MessageAuthenticationError(Exception):
+  """The hmac on a message did not match"""
+
+class StreamCipher():
+  """Encrypt and decrypt messages of the form cipher(hmac(msg) + msg).  As with
+  the underlying EVP.Cipher, the stream continues from one message to the next
+  until reset() is called."""
+  def __init__(self, key, iv, hmacKey, alg=DEFAULT_ALG):
+    self.alg = alg
+    #: the EVP.Cipher for each direction, or None until it is used after a reset.
+    #: NOTE:  contexts are never re-initialized through M2Crypto internals, since
+    #: EVP_CipherInit on a live context leaks memory with some versions of openssl
+    self.encryptCipher = None
+    self.decryptCipher = None
+    self.rekey(key, iv, hmacKey)
+
+  def rekey(self, key, iv, hmacKey):
+    """Switch to a new key, reusing the hmac context if the hmac key is the same"""
+    self.key = key
+    self.iv = iv
+    if hmacKey != getattr(self, "hmacKey", None):
+      self.hmacKey = hmacKey
+      #the key schedule is done once here, and copied for each message
+      self._hmac = hmac.new(hmacKey, digestmod=sha256)
+    self.reset()
+
+  def reset(self):
+    """Restart both streams at the iv"""
+    self.encryptCipher = None
+    self.decryptCipher = None
+
+  def make_hmac(self, msg):
+    """@returns:  the sha256 hmac of msg (a string or buffer)"""
+    h = self._hmac.copy()
+    h.update(msg)
+    return h.digest()
+
+  def encrypt(self, msg):
+    """@param msg:  the message to encrypt
+    @type msg:  string or buffer
+    @returns:  the encrypted message, including the hmac"""
+    cipher = self.encryptCipher
+    if cipher is None:
+      cipher = self.encryptCipher = EVP.Cipher(self.alg, self.key, self.iv, 1)
+    #CFB is a stream mode, so this is identical to encrypting mac + msg
+    return cipher.update(self.make_hmac(msg)) + cipher.update(msg) + cipher.final()
+
+  def decrypt(self, encryptedMsg):
+    """@param encryptedMsg:  from encrypt()
+    @type encryptedMsg:  string or buffer
+    @returns:  the message
+    @raises MessageAuthenticationError:  if the hmac does not match"""
+    cipher = self.decryptCipher
+    if cipher is None:
+      cipher = self.decryptCipher = EVP.Cipher(self.alg, self.key, self.iv, 0)
+    msg = cipher.update(encryptedMsg) + cipher.final()
+    mac = msg[:HMAC_LENGTH]
+    msg = msg[HMAC_LENGTH:]
+    if self.make_hmac(msg) != mac:
+      raise MessageAuthenticationError('HMAC does not authenticate, is something bad going on?')
+    return msg
+
+  def seal(self, msg, associatedData=""):
+    """Authenticated encryption (encrypt then mac) with a random iv for each message.
+    Unlike encrypt(), messages do not depend on each other, and associatedData
+    (eg, a header that must be sent in the clear) is authenticated too.
+    @returns:  iv + ciphertext + hmac"""
+    iv = os.urandom(SEAL_IV_LENGTH)
+    cipher = EVP.Cipher(self.alg, self.key, iv, 1)
+    encrypted = cipher.update(msg) + cipher.final()
+    return iv + encrypted + self._make_seal_tag(associatedData, iv, encrypted)
+
+  def unseal(self, sealedMsg, associatedData=""):
+    """@param sealedMsg:  from seal()
+    @returns:  the message
+    @raises MessageAuthenticationError:  if the message or associatedData were changed"""
+    if len(sealedMsg) < SEAL_IV_LENGTH + HMAC_LENGTH:
+      raise MessageAuthenticationError('Sealed message is too short')
+    iv = sealedMsg[:SEAL_IV_LENGTH]
+    encrypted = buffer(sealedMsg, SEAL_IV_LENGTH, len(sealedMsg) - SEAL_IV_LENGTH - HMAC_LENGTH)
+    tag = sealedMsg[-HMAC_LENGTH:]
+    if self._make_seal_tag(associatedData, iv, encrypted) != tag:
+      raise MessageAuthenticationError('HMAC does not authenticate, is something bad going on?')
+    cipher = EVP.Cipher(self.alg, self.key, iv, 0)
+    return cipher.update(encrypted) + cipher.final()
+
+  def _make_seal_tag(self, associatedData, iv, encrypted):
+    h = self._hmac.copy()
+    h.update(struct.pack("!L", len(associatedData)))
+    h.update(associatedData)
+    h.update(iv)
+    h.update(encrypted)
+    return h.digest()
+
+if __name__ == "__main__":
+  #benchmark:  the old way (cStringIO copies and an hmac key schedule per message) vs StreamCipher,
+  #for the sizes of PAR payments, bank relay messages, and ACoin requests
+  import time
+  import cStringIO
+  from common import Globals
+
+  NUM_MESSAGES = 5000
+  key = os.urandom(Globals.SYMMETRIC_KEY_BYTES)
+  iv = os.urandom(16)
+  hmacKey = os.urandom(32)
+
+  def old_round_trip(msg):
+    encryptCipher = EVP.Cipher(DEFAULT_ALG, key, iv, 1)
+    decryptCipher = EVP.Cipher(DEFAULT_ALG, key, iv, 0)
+    mac = hmac.new(hmacKey, msg, sha256).digest()
+    inbuf = cStringIO.StringIO(mac + msg)
+    outbuf = cStringIO.StringIO()
+    outbuf.write(encryptCipher.update(inbuf.read()))
+    outbuf.write(encryptCipher.final())
+    inbuf = cStringIO.StringIO(outbuf.getvalue())
+    outbuf = cStringIO.StringIO()
+    outbuf.write(decryptCipher.update(inbuf.read()))
+    outbuf.write(decryptCipher.final())
+    msg = outbuf.getvalue()
+    assert hmac.new(hmacKey, msg[32:], sha256).digest() == msg[:32]
+    return msg[32:]
+
+  stream = StreamCipher(key, iv, hmacKey)
+  def new_round_trip(msg):
+    stream.reset()
+    return stream.decrypt(stream.encrypt(msg))
+
+  def sealed_round_trip(msg):
+    return stream.unseal(stream.seal(msg))
+
+  for name, size in (("PAR payment", 200), ("bank relay message", 600), ("ACoin request", 4 * 1024), ("large ACoin request", 32 * 1024)):
+    msg = os.urandom(size)
+    for funcName, func in (("old", old_round_trip), ("stream", new_round_trip), ("sealed", sealed_round_trip)):
+      assert func(msg) == msg
+      startTime = time.time()
+      for i in range(NUM_MESSAGES):
+        func(msg)
+      elapsed = time.time() - startTime
+      print "%20s (%6d bytes) %6s:  %8.1f messages/sec" % (name, size, funcName, NUM_MESSAGES / elapsed)
@@ -2,18 +2,12 @@
 
 """Wrapper for M2Crypto (which is a wrapper for openssl)."""
 
-import types
 import os
-import hmac
 import struct
-import cStringIO
-from hashlib import sha256
-
-from M2Crypto import EVP
 
 from common import Globals
 from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
-from common.utils import Basic
+from common.classes import StreamCipher
 
 IV_LENGTH = 16
 HMAC_KEY_LENGTH = 32
@@ -41,13 +35,13 @@ class SymmetricKey():
     self.randomData = randomData
     self.hmacKey  = hmacKey
     self.value = randomData + iv
-    self.reset()
+    #: the hmac context and the current stream.  A new cipher context is created
+    #: after every reset(), only the hmac key schedule is kept for the life of the key
+    self.stream = StreamCipher.StreamCipher(self.randomData, self.iv, self.hmacKey, self.alg)
     
   def reset(self):
-    #self.key.IV = self.iv
-    self.decryptCipher = EVP.Cipher(self.alg, self.randomData, self.iv, 0)
-    self.encryptCipher = EVP.Cipher(self.alg, self.randomData, self.iv, 1)
-    pass
+    """Start encrypting and decrypting from the beginning of the stream again"""
+    self.stream.reset()
   
   def pack(self):
     return struct.pack(MESSAGE_FORMAT, self.randomData, self.iv, self.hmacKey)
@@ -56,35 +50,24 @@ class SymmetricKey():
     return struct.unpack(MESSAGE_FORMAT, msg)
     
   def encrypt(self, msg):
-    Basic.validate_type(msg, types.StringType)
-    #make hmac
-    mac = self.make_hmac(msg)
-    
-    inbuf = cStringIO.StringIO(mac + msg)
-    outbuf = cStringIO.StringIO()
-    outbuf.write(self.encryptCipher.update(inbuf.read()))
-    outbuf.write(self.encryptCipher.final()) #no idea what this does because it is undocumented
-    return outbuf.getvalue()
+    """@type msg:  string or buffer"""
+    return self.stream.encrypt(msg)
   
   def decrypt(self, encryptedMsg):
-    Basic.validate_type(encryptedMsg, types.StringType)
-    #decrypt the message
-    inbuf = cStringIO.StringIO(encryptedMsg)
-    outbuf = cStringIO.StringIO()
-    outbuf.write(self.decryptCipher.update(inbuf.read()))
-    outbuf.write(self.decryptCipher.final())
-    msg = outbuf.getvalue()
-    mac = msg[:32]
-    msg = msg[32:]
-    #validate the HMAC
-    if self.make_hmac(msg) != mac:
-      raise Exception('HMAC does not authenticate, is something bad going on?')
-    return msg
+    """@type encryptedMsg:  string or buffer"""
+    return self.stream.decrypt(encryptedMsg)
+
+  def seal(self, msg, associatedData=""):
+    """Authenticated encryption that does not depend on the stream position, see StreamCipher.seal"""
+    return self.stream.seal(msg, associatedData)
+
+  def unseal(self, sealedMsg, associatedData=""):
+    return self.stream.unseal(sealedMsg, associatedData)
 
   def make_hmac(self, msg):
     """creates an hmac out of msg using key
     @msg: message to mac"""
-    return hmac.new(self.hmacKey, msg, sha256).digest()
+    return self.stream.make_hmac(msg)
 
 
 if __name__=="__main__":
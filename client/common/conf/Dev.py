@@ -57,4 +57,5 @@ CLIENT_EVENT_LOGGING_LEVELS = {
               "portforward": 2,
               "gui":         3,
               "bank":        3,
-              "dht":         4}
+              "dht":         4,
+              "tor_conn":    3}
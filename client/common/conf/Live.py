@@ -55,4 +55,5 @@ CLIENT_EVENT_LOGGING_LEVELS = {
               "portforward": 2,
               "gui":         3,
               "bank":        4,
-              "dht":         4}
+              "dht":         4,
+              "tor_conn":    3}
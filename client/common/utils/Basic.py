@@ -22,6 +22,12 @@ def log_msg(msg, debugval=0, log=None):
   else:
     print(msg)
   
+def is_logging(debugval=0, log=None):
+  """@returns:  whether log_msg would log a message with this debugval to log"""
+  if Globals.logger:
+    return Globals.logger.is_logging(debugval, log)
+  return True
+  
 def log_ex(reason, title, exceptions=None, reasonTraceback=None, excType=None):
   """Use this function for logging everywhere.  Will send to the logger if available."""
   if Globals.logger:
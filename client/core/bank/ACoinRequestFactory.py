@@ -40,10 +40,9 @@ class ACoinRequestProtocol(Int32StringReceiver):
       acoinStrFormat = "%ss" % (Globals.ACOIN_KEY_BYTES)
       format = '!' + (acoinStrFormat * number)
       sigs = list(struct.unpack(format, coins))
-      while len(self.factory.requests) > 0:
-        request = self.factory.requests.pop(0)
-        sig = sigs.pop(0)
-        coin = BankMessages.parse_acoin_response(self.factory.bank, sig, request, ProgramState.DEBUG)
+      requests, self.factory.requests = self.factory.requests, []
+      coins = BankMessages.parse_acoin_responses(self.factory.bank, sigs, requests, ProgramState.DEBUG)
+      for coin in coins:
         if coin:
           self.factory.bank.add_acoin(coin)
         else:
@@ -60,14 +59,11 @@ class ACoinRequestFactory(BankMessages.BankConnectionFactory):
     BankMessages.BankConnectionFactory.__init__(self, bank)
     #: the value for each ACoin to have, individually
     self.value = value
-    #:  a list of all ACoinRequests
-    self.requests = []
     #: how many coins to request
     self.number = number
     interval = self.bank.currentACoinInterval
-    for i in range(0, number):
-      #store the values for later:
-      self.requests.append(BankMessages.make_acoin_request(self.bank, interval, value))
+    #:  a list of all ACoinRequests
+    self.requests = BankMessages.make_acoin_requests(self.bank, interval, value, number)
       
   def clientConnectionFailed(self, connector, reason):
     BankMessages.BankConnectionFactory.clientConnectionFailed(self, connector, reason)
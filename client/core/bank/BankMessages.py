@@ -20,6 +20,8 @@ from core.bank import ACoin
     
 #: how long before we assume the bank message failed (bank is temporarily down)
 TIMEOUT = 45.0
+#: default number of ACoin requests to blind or unblind together
+BLINDING_BATCH_SIZE = 64
 
 def make_acoin_request(bank, interval, value):
   """Create an acoin signing request:
@@ -41,6 +43,27 @@ def make_acoin_request(bank, interval, value):
   msg = bankKey.blind(msg, blindingFactor, Globals.ACOIN_KEY_BYTES)
   return ACoinRequest(blindingFactor, receipt, msg, interval, value)
   
+def make_acoin_requests(bank, interval, value, number, batchSize=BLINDING_BATCH_SIZE):
+  """Create many acoin signing requests at once.  Blinding factors are generated
+  and checked batchSize at a time, see make_acoin_request
+  @param number:  how many requests to make
+  @type  number:  int
+  @param batchSize:  how many requests to blind together
+  @type  batchSize:  int
+  @returns:  list of ACoinRequests"""
+  bankKey = bank.get_acoin_key(value)
+  numRandomBits = Globals.ACOIN_BYTES * 8
+  requests = []
+  while len(requests) < number:
+    count = min(batchSize, number - len(requests))
+    blindingFactors = bankKey.get_blinding_factors(numRandomBits, count)
+    receipts = [Basic.long_to_bytes(random.getrandbits(numRandomBits), Globals.ACOIN_BYTES) for i in range(count)]
+    msgs = [ACoin.ACoin.pack_acoin_for_signing(receipt, interval) for receipt in receipts]
+    msgs = bankKey.blind_batch(msgs, blindingFactors, Globals.ACOIN_KEY_BYTES)
+    for blindingFactor, receipt, msg in zip(blindingFactors, receipts, msgs):
+      requests.append(ACoinRequest(blindingFactor, receipt, msg, interval, value))
+  return requests
+  
 def parse_acoin_response(bank, sig, request, validate=True):
   """Turn a bank response into a valid ACoin.
   @param sig:  the bank response
@@ -64,6 +87,39 @@ def parse_acoin_response(bank, sig, request, validate=True):
       return None
   return coin
   
+def parse_acoin_responses(bank, sigs, requests, validate=True, batchSize=BLINDING_BATCH_SIZE):
+  """Turn many bank responses into ACoins, unblinding batchSize at a time.
+  See parse_acoin_response
+  @param sigs:  the bank responses
+  @type  sigs:  list of str
+  @param requests:  the ACoinRequest that corresponds to each response
+  @type  requests:  list
+  @returns:  list of ACoins (or None for each coin that was not valid)"""
+  assert len(sigs) == len(requests), "need one request per signature"
+  coins = []
+  for start in range(0, len(requests), batchSize):
+    batchRequests = requests[start:start+batchSize]
+    batchSigs = sigs[start:start+batchSize]
+    #all coins in a request have the same value, but be safe and group by key anyway
+    byValue = {}
+    for index, request in enumerate(batchRequests):
+      byValue.setdefault(request.value, []).append(index)
+    unblinded = [None] * len(batchRequests)
+    for value, indices in byValue.iteritems():
+      bankKey = bank.get_acoin_key(value)
+      results = bankKey.unblind_batch([batchSigs[i] for i in indices],
+                                      [batchRequests[i].blindingFactor for i in indices],
+                                      Globals.ACOIN_KEY_BYTES)
+      for i, sig in zip(indices, results):
+        unblinded[i] = sig
+    for request, sig in zip(batchRequests, unblinded):
+      coin = ACoin.ACoin(bank)
+      coin.create(request.value, request.receipt, sig, request.interval)
+      if validate and not coin.is_valid(request.interval):
+        coin = None
+      coins.append(coin)
+  return coins
+  
 class ACoinRequest():
   """Basically a struct to store the values for a single ACoin request"""
   def __init__(self, blindingFactor, receipt, msg, interval, value):
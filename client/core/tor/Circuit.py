@@ -21,6 +21,59 @@ OBSERVE_INTERNAL = True
 #: how often (at a minimum) to query Tor's payments
 CHECK_PAYMENT_INTERVAL = 1.0
 
+def handle_bw_events(traffic):
+  """Same as calling handle_bw_event for each circuit, but for a whole batch of
+  circuits at once (all of the TOKEN_LEVELS events from one second).  The totals for
+  each application, relay, and localBandwidth are only added once, whether Tor is
+  ready for payments is only checked once per application, and circuits without any
+  traffic are not added to BWHistory at all (so idle ones can stop being updated).
+  @param traffic:  list of (circuit, dataRead, dataWritten)"""
+  totalRead = 0
+  totalWritten = 0
+  #: mapping from application to [dataRead, dataWritten]
+  appTotals = {}
+  #: mapping from relay to [dataRead, dataWritten]
+  relayTotals = {}
+  #: mapping from application to whether its circuits can make payments right now
+  paymentsReady = {}
+  for circ, dataRead, dataWritten in traffic:
+    app = circ.app
+    if circ.isBitBlinderCircuit and circ.sendPayments:
+      ready = paymentsReady.get(app)
+      if ready is None:
+        ready = app.is_tor_ready() and not app.paused
+        paymentsReady[app] = ready
+        if not ready:
+          #so the reason gets logged once per batch
+          circ.refill_payments()
+      if ready:
+        circ.refill_payments()
+    if not dataRead and not dataWritten:
+      continue
+    totalRead += dataRead
+    totalWritten += dataWritten
+    if app:
+      totals = appTotals.get(app)
+      if totals:
+        totals[0] += dataRead
+        totals[1] += dataWritten
+      else:
+        appTotals[app] = [dataRead, dataWritten]
+    BWHistory.BWHistory.handle_bw_event(circ, dataRead, dataWritten)
+    for r in circ.currentPath:
+      totals = relayTotals.get(r)
+      if totals:
+        totals[0] += dataRead
+        totals[1] += dataWritten
+      else:
+        relayTotals[r] = [dataRead, dataWritten]
+  if totalRead or totalWritten:
+    BWHistory.localBandwidth.handle_bw_event(totalRead, totalWritten)
+  for app, (dataRead, dataWritten) in appTotals.iteritems():
+    app.handle_bw_event(dataRead, dataWritten)
+  for r, (dataRead, dataWritten) in relayTotals.iteritems():
+    r.handle_bw_event(dataRead, dataWritten)
+
 class Circuit(BWHistory.BWHistory):
   """Represents actual circuits in Tor."""
   def __init__(self, event, app, id, finalPath=None):
@@ -42,6 +42,11 @@ class EventHandler(TorCtl.EventHandler):
                          EVENT_TYPE.WARN]
     #: includes ORCIRCUIT events
     self.allEvents =  self.basicEvents + [EVENT_TYPE.ORCIRCUIT]
+    #: TOKEN_LEVELS events that have not been handled yet.  Mapping from circuit id to
+    #: [reads, writes, reads added, writes added]
+    self.pendingTokenLevels = {}
+    #: the scheduled call to _handle_token_levels, if any events are pending
+    self.tokenLevelsEvent = None
   
   def check_ready(self):
     """poll Tor to see if it is loaded yet.  Calls TorApp.on_ready when Tor finishes bootstrapping"""
@@ -276,7 +281,9 @@ class EventHandler(TorCtl.EventHandler):
         self.torApp.load_relay(ns.idhex)
       else:
         #update the current flags:
-        self.torApp.relays[ns.idhex].desc.flags = ns.flags
+        relay = self.torApp.relays[ns.idhex]
+        relay.desc.flags = ns.flags
+        self.torApp.relayIndex.update(relay)
         if "Running" not in ns.flags:
           log_msg("Router %s is no longer running." % (ns.nickname), 4)
         else:
@@ -298,13 +305,14 @@ class EventHandler(TorCtl.EventHandler):
     @param event: the event structure from the Tor controller
     @type  event:  NewConsensusEvent"""
     log_msg("Received new consensus, updating running relays.", 2)
-    idList = self.torApp.relays.keys()
+    idList = set(self.torApp.relays.keys())
     for ns in event.data:
       if ns.idhex in idList:
         #then it is definitely running:
         log_msg("Router %s is running" % (ns.nickname), 3)
         r = self.torApp.relays[ns.idhex]
         r.desc.flags = ns.flags
+        self.torApp.relayIndex.update(r)
         r.connectionFailures /= 2.0
         idList.remove(ns.idhex)
         #are we in the consensus?
@@ -316,26 +324,55 @@ class EventHandler(TorCtl.EventHandler):
       if "Running" in self.torApp.relays[idhex].desc.flags:
         r = self.torApp.relays[idhex]
         r.desc.flags.remove("Running")
+        self.torApp.relayIndex.update(r)
         r.connectionFailures /= 2.0
         #if we are being marked as down and we werent before:
         if idhex == Globals.FINGERPRINT:
           self.torApp.on_exited_consensus()
           
   def token_level_event(self, event):
-    """Called each second for each Circuit.
+    """Called each second for each Circuit.  Tor sends the events for all circuits
+    in a burst, so they are only collected here, and handled together by
+    _handle_token_levels once the burst has been read.
     @param event: the event structure from the Tor controller
     @type  event:  TokenLevelEvent"""
     self.log_event(event, "TOKEN_LEVELS")
-    circ = BitBlinder.get().get_circuit(event.circ_id)
-    if circ:
-      if circ.is_done():
-        return
-      readTraffic = Globals.BYTES_PER_CELL * (circ.lastPayedReads - (event.reads - event.reads_added))
-      writeTraffic = Globals.BYTES_PER_CELL * (circ.lastPayedWrites - (event.writes - event.writes_added))
-      circ.lastPayedReads = event.reads
-      circ.lastPayedWrites = event.writes
-      circ.handle_token_response(event.reads, event.writes)
-      circ.handle_bw_event(readTraffic, writeTraffic)
+    pending = self.pendingTokenLevels.get(event.circ_id)
+    if pending:
+      #a second event for the same circuit before the batch was handled
+      pending[0] = event.reads
+      pending[1] = event.writes
+      pending[2] += event.reads_added
+      pending[3] += event.writes_added
+    else:
+      self.pendingTokenLevels[event.circ_id] = [event.reads, event.writes, event.reads_added, event.writes_added]
+    if not self.tokenLevelsEvent:
+      self.tokenLevelsEvent = Scheduler.schedule_once(0, self._handle_token_levels)
+      
+  def _handle_token_levels(self):
+    """Update the token levels and bandwidth for every circuit with pending TOKEN_LEVELS events"""
+    self.tokenLevelsEvent = None
+    pending = self.pendingTokenLevels
+    self.pendingTokenLevels = {}
+    bbApp = BitBlinder.get()
+    traffic = []
+    for circId, (reads, writes, readsAdded, writesAdded) in pending.iteritems():
+      try:
+        circ = bbApp.get_circuit(circId)
+        if not circ or circ.is_done():
+          continue
+        readTraffic = Globals.BYTES_PER_CELL * (circ.lastPayedReads - (reads - readsAdded))
+        writeTraffic = Globals.BYTES_PER_CELL * (circ.lastPayedWrites - (writes - writesAdded))
+        circ.lastPayedReads = reads
+        circ.lastPayedWrites = writes
+        circ.handle_token_response(reads, writes)
+        traffic.append((circ, readTraffic, writeTraffic))
+      except Exception, e:
+        log_ex(e, "Failed to handle TOKEN_LEVELS for circuit %s" % (circId))
+    try:
+      Circuit.handle_bw_events(traffic)
+    except Exception, e:
+      log_ex(e, "Failed to handle bandwidth from TOKEN_LEVELS events")
           
   def orcircuit_event(self, event):
     """Called when an ORConnection (a direct connection to another relay)
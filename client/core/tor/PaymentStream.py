@@ -46,7 +46,7 @@ class PaymentStream():
     #: which hop to use as the payment proxy.  1 is the only value that works right now
     self.paymentProxyHop = 1
     #: the public key for the relay that we send payments to
-    self.key = parClient.torApp.relayKeys[self.parClient.circ.finalPath[self.hop-1].desc.idhex]
+    self.key = parClient.torApp.get_relay_key(self.parClient.circ.finalPath[self.hop-1].desc.idhex)
   
   def send_setup(self):
     """Send the initial setup message
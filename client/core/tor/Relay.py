@@ -5,6 +5,7 @@
 import socket
 import struct
 import types
+from bisect import bisect_right
 
 from twisted.internet.abstract import isIPAddress
 
@@ -17,6 +18,19 @@ MAX_VALUES = 100
 #: how much bw to assume when a relay is new and has no default BW
 INITIAL_BW = 100000
 
+def get_exit_port_ranges(exitpolicy):
+  """@returns:  (starts, ends), sorted lists describing the disjoint port ranges that
+  some accept line of exitpolicy covers"""
+  ranges = sorted([(line.port_low, line.port_high) for line in exitpolicy if line.match])
+  starts, ends = [], []
+  for low, high in ranges:
+    if ends and low <= ends[-1] + 1:
+      ends[-1] = max(ends[-1], high)
+    else:
+      starts.append(low)
+      ends.append(high)
+  return starts, ends
+
 class Relay(BWHistory.BWHistory):
   """Represents a relay in the BitBlinder network.
   NOTE:  this should really be a child class of Router from TorCtl, but I didnt want to modify
@@ -30,6 +44,10 @@ class Relay(BWHistory.BWHistory):
     self.connectionFailures = 0
     #: the TorCtl Router object for this relay
     self.desc = None
+    #: whether this is a directory authority (they are never used in paths)
+    self.isAuthority = False
+    #: the ports that the exit policy accepts for some host, from get_exit_port_ranges
+    self.exitPortStarts, self.exitPortEnds = [], []
     
   #TODO:  make this more scientific?  It's pretty rough right now
   def get_p_failure(self):
@@ -47,6 +65,8 @@ class Relay(BWHistory.BWHistory):
   def set_descriptor(self, routerDescriptor):
     """Must be called before most other methods, which all access desc"""
     self.desc = routerDescriptor
+    self.isAuthority = routerDescriptor.nickname.lower().find("innominetauth") != -1
+    self.exitPortStarts, self.exitPortEnds = get_exit_port_ranges(routerDescriptor.exitpolicy)
     
   def on_or_event(self, event):
     """Called by EventHandler when we get an OR event
@@ -102,11 +122,8 @@ class Relay(BWHistory.BWHistory):
   def will_exit_to_port(self, port):
     """@param port:  the port to check against the exit policy
     @returns: True if there is ANY way this router will allow exits to port."""
-    for line in self.desc.exitpolicy:
-      if line.port_low <= port and port <= line.port_high:
-        if line.match:
-          return True
-    return False
+    i = bisect_right(self.exitPortStarts, port) - 1
+    return i >= 0 and port <= self.exitPortEnds[i]
         
   def will_exit_to_host(self, host):
     """@param host:  the address to check against the exit policy
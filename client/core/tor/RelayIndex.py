@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#Copyright 2009 InnomiNet
+"""Index of the relays that can be used in paths, for choosing exits quickly"""
+
+import random
+from bisect import bisect_left
+
+from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+
+#: bit for each relay flag that path selection cares about
+FLAG_BITS = {"Running": 1, "Valid": 2, "Fast": 4, "Stable": 8, "Exit": 16, "Guard": 32}
+#: how many different (port, country, protocol) queries to remember before starting over
+MAX_CACHED_QUERIES = 100
+#: how many times ScoreSampler will pick a removed Relay before rebuilding without them
+MAX_PICK_ATTEMPTS = 20
+
+def get_flag_bits(flags):
+  """@returns:  int with the FLAG_BITS for flags set (other flags are ignored)"""
+  bits = 0
+  for f in flags:
+    bits |= FLAG_BITS.get(f, 0)
+  return bits
+
+class RelayIndex:
+  """Keeps the set of relays that may be used in paths at all (Running, and not
+  authorities), grouped by country, and caches the allowable exits and middle relays
+  for each (port, country, protocol) that a path is built for.  Exits to a particular
+  host are picked from the cached exits for the port on each call, since there are
+  far more hosts than ports.
+  update must be called whenever a relay is added, or its descriptor or flags change.
+  That throws away the cached results, everything else is updated incrementally."""
+  def __init__(self):
+    #: mapping from Relay to its flag bits
+    self.flagBits = {}
+    #: mapping from Relay to the country it is listed under in byCountry
+    self.countries = {}
+    #: Relays that can be used in paths
+    self.usable = set()
+    #: mapping from country code to the usable Relays in that country
+    self.byCountry = {}
+    #: mapping from (port, country, protocol, our relay) to (exits, middles), as lists
+    self.cache = {}
+
+  def update(self, relay):
+    """Call when relay is added, or its descriptor or flags changed"""
+    self.cache.clear()
+    self._remove(relay)
+    bits = get_flag_bits(relay.desc.flags)
+    self.flagBits[relay] = bits
+    if bits & FLAG_BITS["Running"] and not relay.isAuthority:
+      country = relay.desc.country
+      self.usable.add(relay)
+      self.countries[relay] = country
+      self.byCountry.setdefault(country, set()).add(relay)
+
+  def _remove(self, relay):
+    if relay not in self.usable:
+      return
+    self.usable.remove(relay)
+    country = self.countries.pop(relay)
+    relays = self.byCountry[country]
+    relays.remove(relay)
+    if not relays:
+      del self.byCountry[country]
+
+  def has_flags(self, relay, flags):
+    """@returns:  True if relay has all of flags (which must all be in FLAG_BITS)"""
+    bits = get_flag_bits(flags)
+    return self.flagBits.get(relay, 0) & bits == bits
+
+  def get_allowable_relays(self, intHost, port, exitCountry, protocol, ourRelay):
+    """@param intHost:  the address the exit must allow, as an int, or None
+    @param port:  the port the exit must allow, or None
+    @param exitCountry:  the country the exit must be in, or None
+    @param protocol:  TCP or DHT
+    @param ourRelay:  our own Relay (never a middle relay), or None
+    @returns:  (exits, middles), new lists of usable Relays that will and will not exit with these parameters"""
+    key = (port, exitCountry, protocol, ourRelay)
+    result = self.cache.get(key)
+    if not result:
+      if exitCountry:
+        candidates = self.byCountry.get(exitCountry, ())
+      else:
+        candidates = self.usable
+      exits = [r for r in candidates if r.will_exit_to(None, port, protocol)]
+      middles = self.usable.difference(exits)
+      middles.discard(ourRelay)
+      result = (exits, list(middles))
+      if len(self.cache) >= MAX_CACHED_QUERIES:
+        self.cache.clear()
+      self.cache[key] = result
+    exits, middles = result
+    middles = list(middles)
+    #DHT exits do not depend on the host
+    if not intHost or protocol == "DHT":
+      return (list(exits), middles)
+    #any relay that will exit to host:port will exit to port for some host, so only check those
+    hostExits = []
+    for relay in exits:
+      if relay.will_exit_to(intHost, port, protocol):
+        hostExits.append(relay)
+      elif relay is not ourRelay:
+        middles.append(relay)
+    return (hostExits, middles)
+
+class ScoreSampler:
+  """Randomly picks Relays, weighted by score.  The running totals of the scores are
+  computed once, so each pick is a binary search instead of summing and scanning
+  the whole list again for every hop of a path.  Removed Relays are skipped by
+  picking again, since only a few are ever removed (the hops already chosen)."""
+  def __init__(self, relays, scores):
+    """@param relays:  the Relays to pick from
+    @type  relays:  list
+    @param scores:  the weight of each of relays
+    @type  scores:  list (of floats)"""
+    #: the Relays to pick from
+    self.relays = relays
+    #: running totals of scores
+    self.totals = []
+    total = 0.0
+    for score in scores:
+      total += score
+      self.totals.append(total)
+    #: the Relays that must not be picked any more
+    self.removed = set()
+        
+  def remove(self, relay):
+    """Make sure that relay will not be picked again"""
+    self.removed.add(relay)
+      
+  def pick(self):
+    """@returns:  a random Relay that has not been removed, or None if there are none left"""
+    if len(self.removed) >= len(self.relays):
+      return None
+    for i in range(MAX_PICK_ATTEMPTS):
+      index = bisect_left(self.totals, random.random() * self.totals[-1])
+      #should only be past the end because of floating rounding errors
+      relay = self.relays[min(index, len(self.relays)-1)]
+      if relay not in self.removed:
+        return relay
+    #the removed Relays had most of the weight, so start over without them
+    remaining = [(relay, score) for relay, score in zip(self.relays, self._get_scores()) if relay not in self.removed]
+    self.__init__([relay for relay, score in remaining], [score for relay, score in remaining])
+    return self.pick()
+    
+  def _get_scores(self):
+    return [total - previous for total, previous in zip(self.totals, [0.0] + self.totals[:-1])]
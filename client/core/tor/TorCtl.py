@@ -39,6 +39,7 @@ import socket
 import binascii
 import types
 import time
+from collections import deque
 from TorUtil import *
 
 from twisted.python.failure import Failure
@@ -48,6 +49,7 @@ from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 
 from common import Globals
 from common.utils.Basic import log_msg, log_ex, _ # pylint: disable-msg=W0611
+from common.utils.Basic import is_logging
 from core import ProgramState
 
 console_data_string = ''
@@ -75,9 +77,15 @@ class TorClientFactory(ReconnectingClientFactory):
   def clientConnectionFailed(self, connector, reason):
     self.retry(connector)
 
+def should_log_data():
+  """@returns:  whether log_data would do anything.  Checked before every control
+  line, since logging each one is far more expensive than handling it."""
+  return trackingConsoleChanges or is_logging(3, "tor_conn")
+
 def log_data(data):
   global console_data_string
-  log_msg(data, 3, "tor_conn")
+  if is_logging(3, "tor_conn"):
+    log_msg(data, 3, "tor_conn")
   if ProgramState.DEBUG:
     if trackingConsoleChanges:
       for filterString in ("250 OK", "TOKEN_LEVELS ", "ORCONN ", "BW ", "SENDPAYMENT ", "ADDTOKENS "):
@@ -115,6 +123,13 @@ rjre_ = re.compile(r"^reject (\S+):([^-]+)(?:-(\d+))?")
 bwre_ = re.compile(r"^bandwidth \d+ \d+ (\d+)")
 upre_ = re.compile(r"^uptime (\d+)")
 hire_ = re.compile(r"^opt hibernating 1")
+#event bodies:
+circre_ = re.compile(r"(\d+)\s+(\S+)(\s\S+)?(\s\S+)?(\s\S+)?(\s\S+)?")
+strmre_ = re.compile(r"(\S+)\s+(\S+)\s+(\S+)\s+(\S*):(\d+)(\sREASON=\S+)?(\sREMOTE_REASON=\S+)?(\sSOURCE=\S+)?(\sSOURCE_ADDR=\S+)?(\sPURPOSE=\S+)?")
+orconnre_ = re.compile(r"(\S+)\s+(\S+)(\sAGE=\S+)?(\sREAD=\S+)?(\sWRITTEN=\S+)?(\sREASON=\S+)?(\sNCIRCS=\S+)?")
+strmbwre_ = re.compile(r"(\d+)\s+(\d+)\s+(\d+)")
+bwevre_ = re.compile(r"(\d+)\s+(\d+)")
+addrmapre_ = re.compile(r'(\S+)\s+(\S+)\s+(\"[^"]+\"|\w+)')
 
 class TorCtlError(Exception):
   "Generic error raised by TorControl code."
@@ -479,11 +494,11 @@ class TorControlProtocol(basic.LineReceiver):
     self.torApp = torApp
     self._handler = None
     self._handleFn = None
-    self._callbackQueue = []
+    #: callbacks for the replies to our commands, in the order they were sent
+    self._callbackQueue = deque()
     self._closedEx = None
     self._closed = 0
     self._closeHandler = None
-    self._debugLog = True
     #CTL:  have to deal with the above variables, most of them are obsolete now
     self._lines = []
     self.multiline = False
@@ -531,7 +546,7 @@ class TorControlProtocol(basic.LineReceiver):
         if self._handler is not None:
           self.handle_event(time.time(), reply)
       else:
-        cb = self._callbackQueue.pop(0)
+        cb = self._callbackQueue.popleft()
         cb(reply)
     except Exception, e:
       errorMsg = "Tor control callback failed"
@@ -588,17 +603,20 @@ class TorControlProtocol(basic.LineReceiver):
 
   def parse_line(self, line):
     if self.multiline:
-      if self._debugLog:
+      if should_log_data():
         log_data(line)
       if line in (".", "650 OK"):
-        self._lines[0] = (self._lines[0][0], self._lines[0][1], unescape_dots("\r\n".join(self.more)))
+        #the data belongs to the most recent key (GETINFO replies can have several multi-line keys)
+        code, s, _ = self._lines[-1]
+        self._lines[-1] = (code, s, unescape_dots("\r\n".join(self.more)))
         isEvent = (self._lines and self._lines[0][0][0] == '6')
         self.multiline = False
         if isEvent: # Need "250 OK" if it's not an event. Otherwise, end
           return isEvent
+        return None
       self.more.append(line)
       return None
-    if self._debugLog:
+    if should_log_data():
        log_data(line)
     if len(line)<4:
       raise ProtocolError("Badly formatted reply line: Too short")
@@ -620,7 +638,7 @@ class TorControlProtocol(basic.LineReceiver):
     return None
 
   def _doSend(self, msg):
-    if self._debugLog:
+    if should_log_data():
       amsg = msg
       lines = amsg.split("\n")
       if len(lines) > 2:
@@ -923,13 +941,16 @@ class EventHandler:
 
   def _decode1(self, body, data):
     """Unpack an event message into a type/arguments-tuple tuple."""
+    #by far the most common event (one per circuit per second), so check for it first
+    if body.startswith("TOKEN_LEVELS "):
+      return TokenLevelEvent("TOKEN_LEVELS", body[13:])
     if " " in body:
       evtype,body = body.split(" ",1)
     else:
       evtype,body = body,""
     evtype = evtype.upper()
     if evtype == "CIRC":
-      m = re.match(r"(\d+)\s+(\S+)(\s\S+)?(\s\S+)?(\s\S+)?(\s\S+)?", body)
+      m = circre_.match(body)
       if not m:
         raise ProtocolError("CIRC event misformatted.")
       ident,status,path,purpose,reason,remote = m.groups()
@@ -950,7 +971,7 @@ class EventHandler:
       event = CircuitEvent(evtype, ident, status, path, reason, remote)
     elif evtype == "STREAM":
       #plog("DEBUG", "STREAM: "+body)
-      m = re.match(r"(\S+)\s+(\S+)\s+(\S+)\s+(\S*):(\d+)(\sREASON=\S+)?(\sREMOTE_REASON=\S+)?(\sSOURCE=\S+)?(\sSOURCE_ADDR=\S+)?(\sPURPOSE=\S+)?", body)
+      m = strmre_.match(body)
       if not m:
         raise ProtocolError("STREAM event misformatted.")
       ident,status,circ,target_host,target_port,reason,remote,source,source_addr,purpose = m.groups()
@@ -963,7 +984,7 @@ class EventHandler:
       event = StreamEvent(evtype, ident, status, circ, target_host,
                int(target_port), reason, remote, source, source_addr, purpose)
     elif evtype == "ORCONN":
-      m = re.match(r"(\S+)\s+(\S+)(\sAGE=\S+)?(\sREAD=\S+)?(\sWRITTEN=\S+)?(\sREASON=\S+)?(\sNCIRCS=\S+)?", body)
+      m = orconnre_.match(body)
       if not m:
         raise ProtocolError("ORCONN event misformatted.")
       target, status, age, read, wrote, reason, ncircs = m.groups()
@@ -981,12 +1002,12 @@ class EventHandler:
       event = ORConnEvent(evtype, status, target, age, read, wrote,
                 reason, ncircs)
     elif evtype == "STREAM_BW":
-      m = re.match(r"(\d+)\s+(\d+)\s+(\d+)", body)
+      m = strmbwre_.match(body)
       if not m:
         raise ProtocolError("STREAM_BW event misformatted.")
       event = StreamBwEvent(evtype, *m.groups())
     elif evtype == "BW":
-      m = re.match(r"(\d+)\s+(\d+)", body)
+      m = bwevre_.match(body)
       if not m:
         raise ProtocolError("BANDWIDTH event misformatted.")
       read, written = map(long, m.groups())
@@ -997,7 +1018,7 @@ class EventHandler:
       event = NewDescEvent(evtype, body.split(" "))
     elif evtype == "ADDRMAP":
       # TODO: Also parse errors and GMTExpiry
-      m = re.match(r'(\S+)\s+(\S+)\s+(\"[^"]+\"|\w+)', body)
+      m = addrmapre_.match(body)
       if not m:
         raise ProtocolError("ADDRMAP event misformatted.")
       fromaddr, toaddr, when = m.groups()
@@ -1097,4 +1118,70 @@ class EventHandler:
   def new_consensus_event(self, event):
     """Called when Tor begins using a new consensus document
     """
-    raise NotImplemented()
\ No newline at end of file
+    raise NotImplemented()
+
+if __name__ == "__main__":
+  #benchmark:  replay a control port transcript (one raw line per line, like "650 BW 100 200")
+  #through TorControlProtocol, and report how many events per second are parsed and dispatched.
+  #Without a transcript, one is generated from typical relay traffic.
+  from common.classes import Logger
+  logger = Logger.Logger()
+  #control port logging is disabled on live builds:
+  logger.set_event_logging_levels({"tor_conn": 2})
+  
+  #check that a reply with several multi-line keys (like get_info for a batch of relays) is parsed into the right keys
+  class NullTransport:
+    def write(self, data):
+      pass
+  protocol = TorControlProtocol(None)
+  protocol.transport = NullTransport()
+  infoResults = []
+  protocol.get_info(["ns/id/A", "desc_short/id/A", "ns/id/B", "desc_short/id/B"]).addCallback(infoResults.append)
+  protocol.dataReceived("250+ns/id/A=\r\nr A\r\ns Running\r\n.\r\n"
+                        "250+desc_short/id/A=\r\nDESC:\r\n..A\r\n.\r\n"
+                        "250+ns/id/B=\r\nr B\r\n.\r\n"
+                        "250+desc_short/id/B=\r\nDESC:\r\nB\r\n.\r\n"
+                        "250 OK\r\n")
+  assert infoResults == [{"ns/id/A": "r A\ns Running\n", "desc_short/id/A": "DESC:\n.A\n",
+                          "ns/id/B": "r B\n", "desc_short/id/B": "DESC:\nB\n"}], infoResults
+  
+  if len(sys.argv) > 1:
+    transcript = [line.rstrip("\r\n") for line in open(sys.argv[1], "rb")]
+  else:
+    transcript = []
+    for second in xrange(20):
+      for circId in xrange(2000):
+        transcript.append("650 TOKEN_LEVELS %d %d %d 5 5" % (circId, 100 + second, 200 + second))
+      transcript.append("650 BW 102400 204800")
+      for streamId in xrange(50):
+        transcript.append("650 STREAM %d SUCCEEDED %d 10.0.0.%d:80" % (streamId, streamId, streamId % 250))
+        transcript.append("650 CIRC %d BUILT $AAAA~relay1,$BBBB~relay2 PURPOSE=GENERAL" % (streamId))
+      transcript.append("250 OK")
+  data = "\r\n".join(transcript) + "\r\n"
+  
+  class CountingHandler(EventHandler):
+    def orcircuit_event(self, event):
+      pass
+    def token_level_event(self, event):
+      pass
+    def __init__(self):
+      EventHandler.__init__(self)
+      self.numEvents = 0
+      for name in self._map1.keys():
+        self._map1[name] = self.count_event
+    def count_event(self, event):
+      self.numEvents += 1
+    
+  handler = CountingHandler()
+  protocol = TorControlProtocol(None)
+  protocol.set_event_handler(handler)
+  #a reply callback for each command reply in the transcript
+  for line in transcript:
+    if line[:3] == "250" and line[3:4] == " ":
+      protocol._callbackQueue.append(lambda reply: None)
+  startTime = time.time()
+  #as it would arrive from the socket:
+  for i in xrange(0, len(data), 16384):
+    protocol.dataReceived(data[i:i+16384])
+  elapsed = time.time() - startTime
+  print "%d lines, %d events in %.2f seconds:  %.0f events/sec" % (len(transcript), handler.numEvents, elapsed, handler.numEvents / elapsed)